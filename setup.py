@@ -53,6 +53,7 @@ setup(
     download_url='https://github.com/arista-eosplus/ztpserver/tarball/v1.0.0',
     license='BSD-3',
     install_requires=INSTALL_REQUIREMENTS,
+    extras_require={'sendfile': ['pysendfile']},
     packages=['ztpserver'],
     scripts=glob('bin/*'),
     data_files=[
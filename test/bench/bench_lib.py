@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+import gc
+import json
+import logging
+import sys
+import time
+
+logging.getLogger('ztpserver').addHandler(logging.NullHandler())
+logging.disable(logging.CRITICAL)
+
+def timed(func, repeat=10, number=1):
+    ''' Runs func number times per sample for repeat samples and returns
+    the min/mean/max time per call in milliseconds
+    '''
+
+    samples = list()
+    gc.collect()
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        samples.append((time.time() - start) * 1000.0 / number)
+
+    return dict(min=min(samples),
+                mean=sum(samples) / len(samples),
+                max=max(samples),
+                repeat=repeat,
+                number=number)
+
+def report(name, results, stream=None):
+    ''' Writes the benchmark results as a JSON document '''
+
+    stream = stream or sys.stdout
+    json.dump(dict(benchmark=name, results=results), stream,
+              indent=2, sort_keys=True)
+    stream.write('\n')
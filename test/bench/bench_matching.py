@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+''' Compares Pattern.match_node against the greedy interface assignment
+it replaced for chassis nodes of increasing size.
+'''
+import random
+
+from ztpserver.topology import Node, Pattern, InterfacePatternError
+
+from bench_lib import timed, report
+
+def greedy_match_node(pattern, node):
+    ''' The greedy interface assignment used before 1.2 '''
+
+    patterns = list()
+    for entry in pattern.interfaces:
+        patterns.extend(entry['patterns'])
+
+    for interface, neighbors in node.neighbors.items():
+        matched_index = None
+        for index, item in enumerate(patterns):
+            try:
+                if item.match(interface, neighbors):
+                    matched_index = index
+                    break
+            except InterfacePatternError:
+                return False
+        if matched_index is not None:
+            del patterns[matched_index]
+
+    for item in patterns:
+        if not item.is_wildcard():
+            return False
+    return True
+
+def create_chassis(ports, shuffle=False):
+    ''' Returns a node with one spine neighbor per port.  If shuffle is
+    True the node's interfaces are in random order.
+    '''
+
+    order = list(range(1, ports + 1))
+    if shuffle:
+        random.Random(ports).shuffle(order)
+
+    node = Node('001c73%06x' % ports)
+    for index in order:
+        node.add_neighbor('Ethernet%d' % index,
+                          [dict(device='spine%d' % (index % 4),
+                                port='Ethernet%d' % index)])
+    return node
+
+def create_pattern(ports, any_device=False):
+    ''' Returns a pattern requiring a spine on the first half of the
+    ports.  If any_device is True the pattern also requires a neighbor on
+    each of the four spines on any interface.
+    '''
+
+    interfaces = [{'Ethernet1-%d' % (ports / 2): 'regex(\'spine\')'}]
+    if any_device:
+        for index in range(4):
+            interfaces.append({'any': 'spine%d' % index})
+    interfaces.append({'any': 'any'})
+    return Pattern('chassis%d' % ports, interfaces=interfaces)
+
+def main():
+    results = dict()
+    for ports in [16, 32, 64, 128]:
+        for shuffle in [False, True]:
+            for any_device in [False, True]:
+                node = create_chassis(ports, shuffle)
+                pattern = create_pattern(ports, any_device)
+                name = '%d%s%s' % (ports,
+                                   '-shuffled' if shuffle else '',
+                                   '-any-device' if any_device else '')
+                results[name] = dict(
+                    greedy=timed(lambda: greedy_match_node(pattern, node)),
+                    greedy_result=greedy_match_node(pattern, node),
+                    matching=timed(lambda: pattern.match_node(node)),
+                    matching_result=pattern.match_node(node))
+    report('match_node', results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+''' Compares loading a synthetic neighbordb with the pure Python YAML
+parser plus the unicode conversion pass against the serializer.
+'''
+import yaml
+
+import ztpserver.serializers
+
+from ztpserver.serializers import Serializer
+
+from bench_lib import timed, report
+
+def create_neighbordb(patterns):
+    ''' Returns the YAML contents of a neighbordb with the given number
+    of patterns
+    '''
+
+    entries = list()
+    for index in range(patterns):
+        entries.append(dict(name='pattern%d' % index,
+                            definition='tor%d' % (index % 16),
+                            node='001c73%06x' % index,
+                            variables=dict(spine='regex(\'spine\\d+\')'),
+                            interfaces=[{'Ethernet1': 'spine1:Ethernet%d' %
+                                                      (index % 64)},
+                                        {'Ethernet2': '$spine:any'},
+                                        {'any': 'any'}]))
+    return yaml.dump(dict(patterns=entries), default_flow_style=False)
+
+def legacy_loads(contents):
+    ''' The YAML deserialization used before libyaml support '''
+
+    return Serializer._convert_from_unicode(yaml.safe_load(contents))
+
+def main():
+    results = dict(libyaml=ztpserver.serializers.LIBYAML_AVAILABLE)
+    for patterns in [1000, 10000]:
+        contents = create_neighbordb(patterns)
+        loads = lambda: ztpserver.serializers.loads(contents,
+                                                    'application/yaml')
+        assert legacy_loads(contents) == loads()
+        results['%d-patterns' % patterns] = dict(
+            size=len(contents),
+            legacy=timed(lambda: legacy_loads(contents), repeat=3),
+            loads=timed(loads, repeat=3))
+    report('yaml_loads', results)
+
+if __name__ == '__main__':
+    main()
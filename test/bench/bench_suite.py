@@ -0,0 +1,305 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+''' Benchmarks the server hot paths at several scales and writes the
+results as JSON, so the results of two releases can be compared with
+--compare.  Run with 'make bench'.
+'''
+import os
+import sys
+import copy
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+
+import yaml
+
+import ztpserver
+import ztpserver.config
+import ztpserver.controller
+import ztpserver.neighbordb
+import ztpserver.serializers
+
+from webob import Request
+
+from ztpserver.constants import CONTENT_TYPE_JSON, CONTENT_TYPE_YAML
+from ztpserver.neighbordb import load_topology
+from ztpserver.resources import ResourcePool
+from ztpserver.topology import Node
+
+from bench_lib import timed, report
+
+PATTERN_SCALES = [100, 1000, 10000]
+POOL_SCALES = [1000, 50000]
+
+QUICK_PATTERN_SCALES = [100, 1000]
+QUICK_POOL_SCALES = [1000]
+
+# neighbors of the nodes used by the benchmarks, which match pattern1
+NEIGHBORS = {'Ethernet1': [dict(device='spine1', port='Ethernet2')],
+             'Ethernet2': [dict(device='spine3', port='Ethernet7')],
+             'Management1': [dict(device='mgmt', port='Ethernet1')]}
+
+DEFINITION = dict(name='tor',
+                  actions=[dict(name='configure management',
+                                action='add_config',
+                                attributes=dict(
+                                    url='files/templates/ma1.template',
+                                    variables=dict(
+                                        ipaddress='allocate(\'mgmt\')'))),
+                           dict(name='install image',
+                                action='install_image',
+                                attributes=dict(
+                                    url='files/images/EOS.swi',
+                                    version='4.12.0'))])
+
+def create_neighbordb(patterns, ranged=False):
+    ''' Returns a neighbordb with the given number of global patterns.
+    A node with NEIGHBORS is evaluated against every pattern.  If ranged
+    is True the interface patterns use interface ranges instead of
+    interface names.
+    '''
+
+    (first, second) = ('Ethernet1', 'Ethernet2')
+    if ranged:
+        (first, second) = ('Ethernet1,49-52', 'Ethernet2-48')
+
+    entries = list()
+    for index in range(patterns):
+        entries.append(dict(name='pattern%d' % index,
+                            definition='tor',
+                            variables=dict(spine='regex(\'spine\\d+\')'),
+                            interfaces=[{first: 'spine%d:Ethernet%d' %
+                                                (index % 4,
+                                                 index % 48 + 1)},
+                                        {second: '$spine:any'},
+                                        {'any': 'any'}]))
+    return dict(patterns=entries)
+
+def create_pool(entries, kind):
+    ''' Returns the contents of a resource pool with about the given
+    number of entries '''
+
+    if kind == 'cidr':
+        prefixlen = 32
+        while (1 << (32 - prefixlen)) - 2 < entries:
+            prefixlen -= 1
+        return dict(type='cidr', pool='10.0.0.0/%d' % prefixlen)
+    return dict(('10.%d.%d.%d/24' % (i >> 16, (i >> 8) & 255, i & 255), None)
+                for i in range(entries))
+
+def create_node(systemmac):
+    return Node(systemmac, neighbors=copy.deepcopy(NEIGHBORS))
+
+def macs():
+    return ('0050%08x' % index for index in itertools.count())
+
+
+def bench_load_topology(scales):
+    results = dict()
+    for patterns in scales:
+        for (suffix, ranged) in [('', False), ('-ranged', True)]:
+            contents = create_neighbordb(patterns, ranged)
+            repeat = 3
+            copies = [copy.deepcopy(contents) for _ in range(repeat)]
+            results['%d-patterns%s' % (patterns, suffix)] = \
+                timed(lambda: load_topology(contents=copies.pop()),
+                      repeat=repeat)
+    return results
+
+def bench_match_node(scales):
+    results = dict()
+    for patterns in scales:
+        topology = load_topology(contents=create_neighbordb(patterns))
+        node = create_node('005000000001')
+        assert topology.evaluate_node(node)
+        results['%d-patterns' % patterns] = dict(
+            evaluate=timed(lambda: topology.evaluate_node(node), repeat=3),
+            memoized=timed(lambda: topology.match_node(node), number=1000))
+    return results
+
+def bench_allocate(scales, data_root):
+    results = dict()
+    pool = ResourcePool()
+    for entries in scales:
+        for kind in ['value', 'cidr']:
+            name = '%s-%d' % (kind, entries)
+            filename = os.path.join(data_root, 'resources', name)
+            with open(filename, 'w') as fhandle:
+                yaml.safe_dump(create_pool(entries, kind), fhandle,
+                               default_flow_style=False)
+
+            nodes = (create_node(mac) for mac in macs())
+            allocated = create_node('005000000000')
+            pool.allocate(name, allocated)
+            results[name] = dict(
+                allocate=timed(lambda: pool.allocate(name, next(nodes)),
+                               repeat=5, number=100),
+                lookup=timed(lambda: pool.lookup(name, allocated),
+                             repeat=5, number=100))
+    return results
+
+def bench_serializers(scales):
+    results = dict()
+    node = json.dumps(create_node('005000000001').serialize())
+    results['node-json'] = timed(
+        lambda: ztpserver.serializers.dumps(
+            ztpserver.serializers.loads(node, CONTENT_TYPE_JSON),
+            CONTENT_TYPE_JSON), number=1000)
+
+    for patterns in scales:
+        contents = ztpserver.serializers.dumps(create_neighbordb(patterns),
+                                               CONTENT_TYPE_YAML)
+        results['neighbordb-yaml-%d-patterns' % patterns] = timed(
+            lambda: ztpserver.serializers.dumps(
+                ztpserver.serializers.loads(contents, CONTENT_TYPE_YAML),
+                CONTENT_TYPE_YAML), repeat=3)
+    return results
+
+def bench_nodes(scales, data_root):
+    results = dict()
+    systemmacs = macs()
+    for patterns in scales:
+        with open(os.path.join(data_root, 'neighbordb'), 'w') as fhandle:
+            yaml.safe_dump(create_neighbordb(patterns), fhandle,
+                           default_flow_style=False)
+        ztpserver.neighbordb.topology_cache.clear()
+
+        router = ztpserver.controller.Router()
+        posted = list()
+
+        def post():
+            systemmac = next(systemmacs)
+            request = Request.blank('/nodes', method='POST',
+                                    content_type=CONTENT_TYPE_JSON,
+                                    body=json.dumps(dict(
+                                        systemmac=systemmac,
+                                        neighbors=NEIGHBORS)))
+            response = request.get_response(router)
+            assert response.status_code == 201, response.status
+            posted.append(systemmac)
+
+        def get(systemmac):
+            response = Request.blank('/nodes/%s' % systemmac) \
+                              .get_response(router)
+            assert response.status_code == 200, response.status
+
+        # compiles neighbordb
+        post()
+        get(posted[0])
+
+        rendered = list(posted)
+        results['%d-patterns' % patterns] = dict(
+            post=timed(post, repeat=5, number=10),
+            get=timed(lambda: get(posted.pop()), repeat=5, number=10),
+            get_cached=timed(lambda: get(rendered[0]), repeat=5,
+                             number=100))
+    return results
+
+
+def compare(baseline, results, stream=None, prefix=''):
+    ''' Writes the ratio of the mean times in results to the mean times
+    in baseline for every benchmark present in both '''
+
+    stream = stream or sys.stdout
+    for key in sorted(results):
+        value = results[key]
+        previous = baseline.get(key) if hasattr(baseline, 'get') else None
+        if previous is None or not hasattr(value, 'get'):
+            continue
+        if 'mean' in value and 'mean' in previous:
+            ratio = value['mean'] / previous['mean'] \
+                    if previous['mean'] else float('inf')
+            stream.write('%-60s %10.3fms %10.3fms %6.2fx\n' %
+                         (prefix + key, previous['mean'], value['mean'],
+                          ratio))
+        else:
+            compare(previous, value, stream, '%s%s.' % (prefix, key))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', '-o', help='write the results to '
+                        'this file instead of stdout')
+    parser.add_argument('--compare', '-c', metavar='BASELINE',
+                        help='compare the mean times with the results in '
+                        'BASELINE')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run the smaller scales')
+    args = parser.parse_args()
+
+    patterns = QUICK_PATTERN_SCALES if args.quick else PATTERN_SCALES
+    pools = QUICK_POOL_SCALES if args.quick else POOL_SCALES
+
+    data_root = tempfile.mkdtemp(prefix='ztps-bench-')
+    try:
+        for folder in ['definitions', 'nodes', 'resources']:
+            os.mkdir(os.path.join(data_root, folder))
+        with open(os.path.join(data_root, 'definitions', 'tor'), 'w') as fd:
+            yaml.safe_dump(DEFINITION, fd, default_flow_style=False)
+        with open(os.path.join(data_root, 'resources', 'mgmt'), 'w') as fd:
+            yaml.safe_dump(create_pool(10000, 'cidr'), fd,
+                           default_flow_style=False)
+        ztpserver.config.runtime.set_value('data_root', data_root, 'default')
+
+        results = dict(
+            load_topology=bench_load_topology(patterns),
+            match_node=bench_match_node(patterns),
+            allocate=bench_allocate(pools, data_root),
+            serializers=bench_serializers(patterns),
+            nodes=bench_nodes(patterns, data_root))
+    finally:
+        shutil.rmtree(data_root)
+
+    results['environment'] = dict(
+        version=ztpserver.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        libyaml=ztpserver.serializers.LIBYAML_AVAILABLE,
+        quick=args.quick)
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            report('suite', results, stream)
+    else:
+        report('suite', results)
+
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)['results']
+        compare(baseline, results, sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,7 @@
 # pylint: disable=C0102,C0103,E1103,W0142,W0613
 #
 
+import os
 import unittest
 import json
 
@@ -44,13 +45,17 @@ import ztpserver.neighbordb
 import ztpserver.topology
 import ztpserver.controller
 import ztpserver.config
+import ztpserver.metrics
+import ztpserver.profiler
 import ztpserver.repository
+import ztpserver.resources
 
 from ztpserver.controller import DEFINITION_FN, PATTERN_FN
 
 from ztpserver.repository import FileObjectNotFound, FileObjectError
 
-from server_test_lib import remove_all, random_string
+from server_test_lib import remove_all, random_string, add_folder
+from server_test_lib import WORKINGDIR
 from server_test_lib import ztp_headers, write_file
 from server_test_lib import create_definition, create_attributes, create_node
 from server_test_lib import create_bootstrap_conf
@@ -76,6 +81,18 @@ class RouterUnitTests(unittest.TestCase):
                 self.assertIsNone(router.map.match(environ=request.environ),
                                   msg)
 
+    @patch('ztpserver.controller.create_repository')
+    def test_controllers_share_repository(self, m_create_repository):
+        router = ztpserver.controller.Router()
+
+        bootstrap = router.controller(ztpserver.controller.BootstrapController)
+        nodes = router.controller(ztpserver.controller.NodesController)
+
+        self.assertEqual(m_create_repository.call_count, 1)
+        self.assertIs(bootstrap.repository, nodes.repository)
+        self.assertIs(router.controller(ztpserver.controller.NodesController),
+                      nodes)
+
     def test_bootstrap_collection(self):
         url = '/bootstrap'
         self.match_routes(url, 'GET', 'POST,PUT,DELETE')
@@ -115,6 +132,17 @@ class RouterUnitTests(unittest.TestCase):
         url = '/nodes/%s/startup-config' % random_string()
         self.match_routes(url, 'GET,PUT', 'POST,DELETE')
 
+    def test_metrics(self):
+        url = '/metrics'
+        self.match_routes(url, 'GET', 'POST,PUT,DELETE')
+
+    def test_admin_profile(self):
+        self.match_routes('/admin/profile', 'GET', 'POST,PUT,DELETE')
+        self.match_routes('/admin/profile/download', 'GET',
+                          'POST,PUT,DELETE')
+        self.match_routes('/admin/profile/start', 'POST', 'GET,PUT,DELETE')
+        self.match_routes('/admin/profile/stop', 'POST', 'GET,PUT,DELETE')
+
 
 class BootstrapControllerUnitTests(unittest.TestCase):
 
@@ -130,8 +158,8 @@ class BootstrapControllerUnitTests(unittest.TestCase):
         resp = controller.index(None)
 
         self.assertTrue(m_substitute.called)
-        self.assertEqual(resp['content_type'], 'text/x-python')
-        self.assertEqual(resp['body'], m_substitute.return_value)
+        self.assertEqual(resp.content_type, 'text/x-python')
+        self.assertEqual(resp.body, m_substitute.return_value)
 
     def test_index_bootstrap_not_found_failure(self):
         cfg = {'return_value.get_file.side_effect': FileObjectError}
@@ -304,6 +332,104 @@ class FilesControllerIntegrationTests(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
 
 
+class MetricsControllerIntegrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.m_repository = Mock()
+        ztpserver.controller.create_repository = self.m_repository
+
+        self.timings = ztpserver.metrics.timings
+        ztpserver.metrics.timings = ztpserver.metrics.Registry()
+
+    def tearDown(self):
+        ztpserver.metrics.timings = self.timings
+        remove_all()
+
+    def test_get_metrics(self):
+        write_file('10.1.0.1: null\n10.1.0.2: null\n', 'pool')
+        self.m_repository.return_value.expand.return_value = WORKINGDIR
+        self.m_repository.return_value.get_file.return_value.name = \
+            write_file('x' * 16)
+
+        router = ztpserver.controller.Router()
+        Request.blank('/files/%s' % random_string()).get_response(router)
+        resp = Request.blank('/metrics').get_response(router)
+
+        self.m_repository.return_value.expand.assert_called_with('resources')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/plain')
+        self.assertIn('version=0.0.4', resp.headers['Content-Type'])
+
+        lines = resp.body.splitlines()
+        self.assertIn('ztps_requests_total{action="show",'
+                      'controller="FilesController",status="200"} 1', lines)
+        self.assertIn('ztps_response_bytes_total{action="show",'
+                      'controller="FilesController"} 16', lines)
+        self.assertIn('ztps_resource_pool_free{pool="pool"} 2', lines)
+
+
+class ProfileControllerIntegrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.m_repository = Mock()
+        ztpserver.controller.create_repository = self.m_repository
+
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value('data_root', WORKINGDIR,
+                                           'default')
+        ztpserver.profiler.profiler = ztpserver.profiler.SamplingProfiler()
+        self.router = ztpserver.controller.Router()
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value('data_root', self.data_root,
+                                           'default')
+        ztpserver.profiler.profiler = ztpserver.profiler.SamplingProfiler()
+        remove_all()
+
+    def request(self, url, method='GET', remote_addr='127.0.0.1'):
+        request = Request.blank(url, method=method,
+                                environ=dict(REMOTE_ADDR=remote_addr))
+        return request.get_response(self.router)
+
+    def test_profile_window(self):
+        resp = self.request('/admin/profile/start?interval=2', 'POST')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.body)['interval'], 2)
+
+        for _ in range(4):
+            self.request('/files/%s' % random_string())
+        self.assertEqual(ztpserver.profiler.profiler.profiled, 2)
+
+        resp = self.request('/admin/profile/stop', 'POST')
+        self.assertFalse(json.loads(resp.body)['active'])
+
+        resp = self.request('/admin/profile/download')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/octet-stream')
+        filename = ztpserver.profiler.profiler.filename
+        self.assertTrue(filename.startswith(os.path.join(WORKINGDIR,
+                                                         'profiles')))
+        self.assertEqual(resp.body, open(filename, 'rb').read())
+
+    def test_profile_start_invalid_interval(self):
+        resp = self.request('/admin/profile/start?interval=x', 'POST')
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(ztpserver.profiler.profiler.active)
+
+    def test_profile_download_missing(self):
+        resp = self.request('/admin/profile/download')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_profile_forbidden(self):
+        for url, method in [('/admin/profile', 'GET'),
+                            ('/admin/profile/start', 'POST'),
+                            ('/admin/profile/stop', 'POST'),
+                            ('/admin/profile/download', 'GET')]:
+            resp = self.request(url, method, remote_addr='10.0.0.1')
+            self.assertEqual(resp.status_code, 403)
+        self.assertFalse(ztpserver.profiler.profiler.active)
+
+
 class ActionsControllerIntegrationTests(unittest.TestCase):
 
     def setUp(self):
@@ -347,6 +473,19 @@ class NodesControllerUnitTests(unittest.TestCase):
         self.m_repository = Mock()
         ztpserver.controller.create_repository = self.m_repository
 
+    def test_fsm_timings(self):
+        ztpserver.metrics.begin()
+
+        controller = ztpserver.controller.NodesController()
+        controller.first = Mock(return_value=(dict(), 'second'))
+        controller.second = Mock(return_value=(dict(status=201), None))
+        resp = controller.fsm('first')
+
+        records = ztpserver.metrics.end()
+        self.assertEqual(resp, dict(status=201))
+        self.assertEqual([(kind, name) for (kind, name, _) in records],
+                         [('fsm', 'first'), ('fsm', 'second')])
+
     def test_required_attributes_success(self):
         request = Mock(json={'systemmac': random_string()})
         response = dict()
@@ -509,12 +648,12 @@ class NodesControllerUnitTests(unittest.TestCase):
         controller = ztpserver.controller.NodesController()
         self.assertRaises(Exception, controller.post_config, dict())
 
-    @patch('ztpserver.neighbordb.load_topology')
-    def test_post_node_success_single_match(self, m_load_topology):
+    @patch('ztpserver.neighbordb.get_topology')
+    def test_post_node_success_single_match(self, m_get_topology):
         request = Mock(json=dict(neighbors=dict()))
         node = Mock(systemmac=random_string())
 
-        m_load_topology.return_value.match_node.return_value = [Mock()]
+        m_get_topology.return_value.match_node.return_value = [Mock()]
 
         controller = ztpserver.controller.NodesController()
 
@@ -524,12 +663,12 @@ class NodesControllerUnitTests(unittest.TestCase):
         self.assertIsInstance(resp, dict)
         self.assertEqual(resp['status'], 201)
 
-    @patch('ztpserver.neighbordb.load_topology')
-    def test_post_node_success_multiple_matches(self, m_load_topology):
+    @patch('ztpserver.neighbordb.get_topology')
+    def test_post_node_success_multiple_matches(self, m_get_topology):
         request = Mock(json=dict(neighbors=dict()))
         node = Mock(systemmac=random_string())
 
-        m_load_topology.return_value.match_node.return_value = [Mock(), Mock(), Mock()]
+        m_get_topology.return_value.match_node.return_value = [Mock(), Mock(), Mock()]
 
         controller = ztpserver.controller.NodesController()
         (resp, state) = controller.post_node(dict(), request=request, node=node)
@@ -538,27 +677,27 @@ class NodesControllerUnitTests(unittest.TestCase):
         self.assertIsInstance(resp, dict)
         self.assertEqual(resp['status'], 201)
 
-    @patch('ztpserver.neighbordb.load_topology')
-    def test_post_node_failure_no_matches(self, m_load_topology):
+    @patch('ztpserver.neighbordb.get_topology')
+    def test_post_node_failure_no_matches(self, m_get_topology):
         request = Mock(json=dict(neighbors=dict()))
         node = Mock(systemmac=random_string())
 
-        m_load_topology.return_value.match_node.return_value = list()
+        m_get_topology.return_value.match_node.return_value = list()
 
         controller = ztpserver.controller.NodesController()
         self.assertRaises(IndexError, controller.post_node, dict(),
                           request=request, node=node)
 
 
-    @patch('ztpserver.neighbordb.load_topology')
-    def test_post_node_no_definition_in_pattern(self, m_load_topology):
+    @patch('ztpserver.neighbordb.get_topology')
+    def test_post_node_no_definition_in_pattern(self, m_get_topology):
         request = Mock(json=dict(neighbors=dict()))
         node = Mock(systemmac=random_string())
 
         pattern = Mock()
         del pattern.definition
 
-        m_load_topology.return_value.match_node.return_value = [pattern]
+        m_get_topology.return_value.match_node.return_value = [pattern]
 
         controller = ztpserver.controller.NodesController()
         self.assertRaises(AttributeError, controller.post_node, dict(),
@@ -788,8 +927,8 @@ class NodesControllerPostFsmIntegrationTests(unittest.TestCase):
         self.assertEqual(resp.status_code, 201)
         self.assertEqual(resp.location, location)
 
-    @patch('ztpserver.neighbordb.load_topology')
-    def test_post_node_success(self, m_load_topology):
+    @patch('ztpserver.neighbordb.get_topology')
+    def test_post_node_success(self, m_get_topology):
         node = create_node()
 
         definition = create_definition()
@@ -799,7 +938,7 @@ class NodesControllerPostFsmIntegrationTests(unittest.TestCase):
         self.m_repository.configure_mock(**cfg)
 
         cfg = {'return_value.match_node.return_value': [Mock()]}
-        m_load_topology.configure_mock(**cfg)
+        m_get_topology.configure_mock(**cfg)
 
         request = Request.blank('/nodes', body=node.as_json(), method='POST',
                                 headers=ztp_headers())
@@ -817,6 +956,225 @@ class NodesControllerPostFsmIntegrationTests(unittest.TestCase):
         self.assertEqual(resp.location, location)
 
 
+    @patch('ztpserver.neighbordb.get_topology')
+    def test_match_nodes(self, m_get_topology):
+        nodes = [create_node().as_dict() for _ in range(3)]
+        pattern = Mock(definition=random_string())
+        pattern.name = random_string()
+        m_get_topology.return_value.match_node.return_value = [pattern]
+
+        body = '\n'.join(json.dumps(node) for node in nodes)
+        request = Request.blank('/nodes/match', body=body, method='POST')
+        resp = request.get_response(ztpserver.controller.Router())
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        results = [json.loads(line) for line in resp.body.splitlines()]
+        self.assertEqual([r['systemmac'] for r in results],
+                         [node['systemmac'] for node in nodes])
+        for result in results:
+            self.assertEqual(result['pattern'], pattern.name)
+            self.assertEqual(result['definition'], pattern.definition)
+
+    def test_match_nodes_invalid_body(self):
+        request = Request.blank('/nodes/match', body='{', method='POST')
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, 400)
+
+class BootstrapControllerCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        remove_all()
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value('data_root', WORKINGDIR,
+                                           'default')
+        ztpserver.controller.create_repository = \
+            ztpserver.repository.create_repository
+        ztpserver.controller.bootstrap_cache = \
+            ztpserver.controller.BootstrapCache()
+
+        add_folder('bootstrap')
+        self.filename = ztpserver.config.runtime.bootstrap.filename
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value('data_root', self.data_root,
+                                           'default')
+        remove_all()
+
+    def write_bootstrap(self, contents):
+        write_file(contents, os.path.join('bootstrap', self.filename))
+
+    def get(self, **kwargs):
+        request = Request.blank('/bootstrap', method='GET', **kwargs)
+        return request.get_response(ztpserver.controller.Router())
+
+    def test_get_bootstrap_cached(self):
+        self.write_bootstrap('SERVER = "$SERVER"\n')
+        cache = ztpserver.controller.bootstrap_cache
+        server_url = ztpserver.config.runtime.default.server_url
+
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.body, 'SERVER = "%s"\n' % server_url)
+        self.assertEqual(cache.misses, 1)
+
+        cached = self.get()
+        self.assertEqual(cached.body, resp.body)
+        self.assertEqual(cached.etag, resp.etag)
+        self.assertEqual(cache.hits, 1)
+
+        resp = self.get(headers={'If-None-Match': '"%s"' % resp.etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_get_bootstrap_gzip(self):
+        self.write_bootstrap('#!/usr/bin/env python\n' * 100)
+
+        resp = self.get(headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertIn('Accept-Encoding', resp.vary)
+        resp.decode_content()
+        self.assertEqual(resp.body, '#!/usr/bin/env python\n' * 100)
+
+        plain = self.get()
+        self.assertIsNone(plain.content_encoding)
+        self.assertNotEqual(plain.etag, resp.etag)
+
+        resp = self.get(headers={'Accept-Encoding': 'gzip',
+                                 'If-None-Match': '"%s"' % resp.etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_get_bootstrap_rerendered(self):
+        self.write_bootstrap('first = "$SERVER"\n')
+        etag = self.get().etag
+
+        self.write_bootstrap('second-script = "$SERVER"\n')
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.body.startswith('second-script'))
+        self.assertNotEqual(resp.etag, etag)
+
+    def test_prime(self):
+        controller = ztpserver.controller.BootstrapController()
+        self.assertFalse(controller.prime())
+
+        self.write_bootstrap('SERVER = "$SERVER"\n')
+        self.assertTrue(controller.prime())
+
+        self.get()
+        self.assertEqual(ztpserver.controller.bootstrap_cache.hits, 1)
+
+
+class NodesControllerDefinitionCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        remove_all()
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value('data_root', WORKINGDIR,
+                                           'default')
+        ztpserver.config.runtime.set_value(\
+            'disable_topology_validation', True, 'default')
+        ztpserver.controller.create_repository = \
+            ztpserver.repository.create_repository
+        ztpserver.controller.definition_cache = \
+            ztpserver.controller.DefinitionCache()
+
+        self.node = create_node()
+        folder = os.path.join('nodes', self.node.systemmac)
+        add_folder(folder)
+        write_file(self.node.as_json(), os.path.join(folder, '.node'))
+        self.definition_fn = os.path.join(folder, DEFINITION_FN)
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value('data_root', self.data_root,
+                                           'default')
+        ztpserver.controller.definition_cache.invalidate()
+        remove_all()
+
+    def write_definition(self, name):
+        definition = create_definition()
+        definition.name = name
+        definition.add_action()
+        write_file(definition.as_yaml(), self.definition_fn)
+
+    def get(self, **kwargs):
+        url = '/nodes/%s' % self.node.systemmac
+        request = Request.blank(url, method='GET', **kwargs)
+        return request.get_response(ztpserver.controller.Router())
+
+    def test_get_definition_cached(self):
+        self.write_definition('first')
+        cache = ztpserver.controller.definition_cache
+
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['name'], 'first')
+        self.assertEqual(cache.misses, 1)
+
+        cached = self.get()
+        self.assertEqual(cached.body, resp.body)
+        self.assertEqual(cached.etag, resp.etag)
+        self.assertEqual(cache.hits, 1)
+
+        resp = self.get(headers={'If-None-Match': '"%s"' % resp.etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_get_definition_invalidated(self):
+        self.write_definition('first')
+        etag = self.get().etag
+
+        self.write_definition('second-definition')
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['name'], 'second-definition')
+        self.assertNotEqual(resp.etag, etag)
+
+    def test_get_definition_other_allocation(self):
+        definition = create_definition()
+        definition.add_action(attributes={'ip': "allocate('mgmt')"})
+        write_file(definition.as_yaml(), self.definition_fn)
+        add_folder('resources')
+        write_file('192.168.1.1: null\n192.168.1.2: null\n',
+                   os.path.join('resources', 'mgmt'))
+        cache = ztpserver.controller.definition_cache
+
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        address = resp.json['actions'][0]['attributes']['ip']
+        self.assertIn(address, ['192.168.1.1', '192.168.1.2'])
+
+        # allocating a resource to another node must not invalidate the
+        # cached definition
+        ztpserver.resources.ResourcePool().allocate('mgmt', create_node())
+        cached = self.get()
+        self.assertEqual(cached.etag, resp.etag)
+        self.assertEqual(cache.hits, 1)
+
+        # releasing the resource allocated to this node must
+        ztpserver.resources.ResourcePool().store('mgmt').release(
+            address, self.node.systemmac)
+        resp = self.get()
+        self.assertEqual(resp.json['actions'][0]['attributes']['ip'],
+                         address)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+
+class DefinitionCacheUnitTests(unittest.TestCase):
+
+    def test_maxsize(self):
+        cache = ztpserver.controller.DefinitionCache(maxsize=2)
+        identity = lambda resource, filepaths, pools: resource
+        for resource in ['a', 'b']:
+            cache.put(resource, list(), list(), resource, resource)
+
+        # a is the most recently used entry so b is evicted
+        self.assertEqual(cache.get('a', identity)[0], 'a')
+        cache.put('c', list(), list(), 'c', 'c')
+        self.assertEqual(sorted(cache.entries), ['a', 'c'])
+        self.assertIsNone(cache.get('b', identity))
+
+
 class NodesControllerGetFsmIntegrationTests(unittest.TestCase):
 
     def setUp(self):
@@ -837,13 +1195,12 @@ class NodesControllerGetFsmIntegrationTests(unittest.TestCase):
         self.assertEqual(resp.status_code, 400)
 
 
+    @patch('ztpserver.neighbordb.create_node')
     @patch('ztpserver.neighbordb.load_pattern')
-    def test_get_startup_config_wo_validation(self, m_load_pattern):
+    def test_get_startup_config_wo_validation(self, m_load_pattern, m_create_node):
         ztpserver.config.runtime.set_value(\
             'disable_topology_validation', True, 'default')
 
-        ztpserver.neighbordb.create_node = Mock()
-
         definition = create_definition()
         definition.add_action()
 
@@ -871,10 +1228,9 @@ class NodesControllerGetFsmIntegrationTests(unittest.TestCase):
         self.assertEqual(resp.content_type, 'application/json')
         self.assertIsInstance(json.loads(resp.body), dict)
 
+    @patch('ztpserver.neighbordb.create_node')
     @patch('ztpserver.neighbordb.load_pattern')
-    def test_get_startup_config_w_validation_success(self, m_load_pattern):
-        ztpserver.neighbordb.create_node = Mock()
-
+    def test_get_startup_config_w_validation_success(self, m_load_pattern, m_create_node):
         definition = create_definition()
         definition.add_action()
 
@@ -0,0 +1,272 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#pylint: disable=R0904,C0103
+
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import ztpserver.metrics
+
+from ztpserver.metrics import Counter, Histogram, Registry, PeerExporter
+from ztpserver.metrics import summarize, merge, render, collect
+
+
+class HistogramUnitTests(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0, 3.0):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'], (0.1, 1.0))
+        self.assertEqual(snapshot['counts'], [2, 1, 2])
+        self.assertEqual(snapshot['count'], 5)
+        self.assertAlmostEqual(snapshot['sum'], 5.65)
+
+    def test_observe_threads(self):
+        histogram = Histogram()
+
+        def worker():
+            for _ in range(1000):
+                histogram.observe(0.01)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        histogram.observe(0.01)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 4001)
+        self.assertAlmostEqual(snapshot['sum'], 40.01)
+
+    def test_retire(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        histogram.observe(0.5)
+        self.assertEqual(len(histogram.shards), 1)
+
+        # what happens to the shard of a thread that exits
+        del histogram.local.holder
+        gc.collect()
+
+        self.assertEqual(histogram.shards, list())
+        self.assertEqual(histogram.retired, [0, 1, 0, 0.5])
+
+        histogram.observe(2.0)
+        self.assertEqual(histogram.snapshot()['counts'], [0, 1, 1])
+
+
+class CounterUnitTests(unittest.TestCase):
+
+    def test_increment(self):
+        counter = Counter()
+
+        def worker():
+            for _ in range(1000):
+                counter.increment()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.increment(5)
+
+        self.assertEqual(counter.value(), 4005)
+
+
+class RegistryUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = ztpserver.metrics.timings
+        self.registry = Registry()
+        ztpserver.metrics.timings = self.registry
+
+    def tearDown(self):
+        ztpserver.metrics.timings = self.timings
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('fsm', 'post_node')
+        self.assertIs(self.registry.histogram('fsm', 'post_node'), histogram)
+        self.assertIsNot(self.registry.histogram('fsm', 'node_exists'),
+                         histogram)
+
+    def test_snapshot(self):
+        ztpserver.metrics.observe('fsm', 'post_node', 0.5)
+        ztpserver.metrics.observe('repository', 'read', 0.001)
+
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['fsm']['post_node']['count'], 1)
+        self.assertEqual(snapshot['repository']['read']['count'], 1)
+
+        self.registry.reset()
+        self.assertEqual(self.registry.snapshot(), dict())
+
+    def test_request_records(self):
+        ztpserver.metrics.observe('fsm', 'post_node', 0.5)
+
+        ztpserver.metrics.begin()
+        ztpserver.metrics.observe('fsm', 'do_validation', 0.25)
+        records = ztpserver.metrics.end()
+        ztpserver.metrics.observe('fsm', 'post_node', 0.5)
+
+        self.assertEqual(records, [('fsm', 'do_validation', 0.25)])
+        self.assertEqual(ztpserver.metrics.end(), list())
+
+    def test_export(self):
+        ztpserver.metrics.observe('fsm', 'post_node', 0.5)
+        ztpserver.metrics.increment('ztps_requests_total', status='201')
+        ztpserver.metrics.increment('ztps_requests_total', 2, status='201')
+        ztpserver.metrics.register(lambda: [('ztps_test_total', (), 7)])
+
+        export = self.registry.export()
+        self.assertEqual(len(export['histograms']), 1)
+        self.assertEqual(export['histograms'][0][2][-1], 0.5)
+        self.assertEqual(sorted(export['counters']),
+                         [['ztps_requests_total', [['status', '201']], 3],
+                          ['ztps_test_total', [], 7]])
+
+    def test_merge(self):
+        ztpserver.metrics.observe('fsm', 'post_node', 0.5)
+        ztpserver.metrics.increment('ztps_requests_total', status='201')
+        export = self.registry.export()
+
+        merged = merge([export, export])
+        self.assertEqual(merged['histograms'][0][2][-1], 1.0)
+        self.assertEqual(sum(merged['histograms'][0][2][:-1]), 2)
+        self.assertEqual(merged['counters'],
+                         [['ztps_requests_total', [['status', '201']], 2]])
+
+    def test_render(self):
+        ztpserver.metrics.observe('route', 'NodesController.create', 0.002)
+        ztpserver.metrics.observe('route', 'NodesController.create', 20)
+        ztpserver.metrics.increment('ztps_requests_total', status='201',
+                                    controller='NodesController')
+        gauges = [('ztps_resource_pool_free', 'Free resources',
+                   [('pool', 'mgmt"1')], 10)]
+
+        lines = render(self.registry.export(), gauges).splitlines()
+        label = 'route="NodesController.create"'
+        self.assertIn('# TYPE ztps_request_duration_seconds histogram', lines)
+        self.assertIn('ztps_request_duration_seconds_bucket{%s,le="0.001"} 0'
+                      % label, lines)
+        self.assertIn('ztps_request_duration_seconds_bucket{%s,le="0.0025"} 1'
+                      % label, lines)
+        self.assertIn('ztps_request_duration_seconds_bucket{%s,le="+Inf"} 2'
+                      % label, lines)
+        self.assertIn('ztps_request_duration_seconds_sum{%s} 20.002'
+                      % label, lines)
+        self.assertIn('ztps_request_duration_seconds_count{%s} 2'
+                      % label, lines)
+        self.assertIn('# TYPE ztps_requests_total counter', lines)
+        self.assertIn('ztps_requests_total{controller="NodesController",'
+                      'status="201"} 1', lines)
+        self.assertIn('# TYPE ztps_resource_pool_free gauge', lines)
+        self.assertIn(r'ztps_resource_pool_free{pool="mgmt\"1"} 10', lines)
+
+    def test_summarize(self):
+        records = [('fsm', 'post_node', 0.002),
+                   ('repository', 'read', 0.001),
+                   ('repository', 'read', 0.0005)]
+        self.assertEqual(summarize(records),
+                         'fsm.post_node=2.0ms repository.read=2x1.5ms')
+
+
+class PeerExporterUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = ztpserver.metrics.timings
+        ztpserver.metrics.timings = Registry()
+        self.directory = tempfile.mkdtemp()
+        self.peers = list()
+
+    def tearDown(self):
+        ztpserver.metrics.stop_exporter()
+        for peer in self.peers:
+            peer.stop()
+        shutil.rmtree(self.directory)
+        ztpserver.metrics.timings = self.timings
+
+    def start_peer(self, name):
+        peer = PeerExporter(self.directory)
+        peer.path = os.path.join(self.directory, name)
+        peer.start()
+        self.peers.append(peer)
+        return peer
+
+    def test_collect_without_exporter(self):
+        ztpserver.metrics.increment('ztps_requests_total')
+        self.assertEqual(collect()['counters'],
+                         [['ztps_requests_total', [], 1]])
+
+    def test_collect_peers(self):
+        ztpserver.metrics.start_exporter(self.directory)
+        ztpserver.metrics.increment('ztps_requests_total')
+        ztpserver.metrics.observe('fsm', 'post_node', 0.5)
+
+        # the peers serve the same registry, standing in for two other
+        # workers with the same metrics
+        self.start_peer('1.sock')
+        self.start_peer('2.sock')
+
+        export = collect()
+        self.assertEqual(export['counters'], [['ztps_requests_total', [], 3]])
+        self.assertEqual(export['histograms'][0][2][-1], 1.5)
+
+    def test_collect_stale_peer(self):
+        ztpserver.metrics.start_exporter(self.directory)
+        stale = os.path.join(self.directory, '1.sock')
+        open(stale, 'w').close()
+
+        collect()
+        self.assertFalse(os.path.exists(stale))
+
+    def test_start_exporter_resets(self):
+        ztpserver.metrics.increment('ztps_requests_total')
+        exporter = ztpserver.metrics.start_exporter(self.directory)
+        self.assertTrue(os.path.exists(exporter.path))
+        self.assertEqual(collect()['counters'], list())
+
+        ztpserver.metrics.stop_exporter()
+        self.assertFalse(os.path.exists(exporter.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,19 +29,25 @@
 # OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import os
+import json
+import hashlib
 import unittest
+import threading
 
 import yaml
 
-from mock import patch
+from mock import patch, Mock
 
+import ztpserver.config
 import ztpserver.neighbordb
 
 from ztpserver.topology import Pattern
 from ztpserver.topology import Topology
 
-from server_test_lib import random_string
-from server_test_lib import create_neighbordb
+from server_test_lib import random_string, remove_all, write_file
+from server_test_lib import create_neighbordb, create_pattern, create_node
+from server_test_lib import add_folder, WORKINGDIR
 
 class NeighbordbUnitTests(unittest.TestCase):
 
@@ -88,6 +94,42 @@ class NeighbordbUnitTests(unittest.TestCase):
         result = ztpserver.neighbordb.load_topology()
         self.assertIsInstance(result, Topology)
 
+    @patch('ztpserver.neighbordb.load')
+    def test_load_topology_single_pass(self, m_load):
+        contents = """
+            variables:
+                spine: regex('spine')
+            patterns:
+                - name: tor
+                  interfaces:
+                    - Ethernet1-48: $spine:any
+                    - Ethernet49: spine1:Ethernet1
+                    - any: any
+                - name: node
+                  node: 001c73000001
+                  interfaces:
+                    - Ethernet1: $spine
+        """
+        m_load.return_value = yaml.load(contents)
+        parse_interface = Pattern.parse_interface
+
+        with patch('ztpserver.topology.Pattern.parse_interface') as m_parse:
+            m_parse.side_effect = parse_interface
+            result = ztpserver.neighbordb.load_topology()
+
+        # every interface is parsed once while it is validated
+        self.assertEqual(m_parse.call_count, 4)
+        self.assertEqual(len(result.patterns['globals']), 1)
+        self.assertEqual(result.patterns['nodes'].keys(), ['001c73000001'])
+
+        pattern = result.patterns['globals'][0]
+        items = [entry['patterns'][0] for entry in pattern.interfaces]
+        self.assertEqual(items[0].device_re,
+                         ztpserver.topology.intern_function('regex', 'spine'))
+        self.assertEqual(len(items[0].interface_re), 48)
+        self.assertEqual(pattern.serialize()['interfaces'][1],
+                         {'Ethernet49': 'spine1:Ethernet1'})
+
     def test_load_pattern_minimal(self):
         pattern = ztpserver.neighbordb.load_pattern({'name': random_string()})
         self.assertIsInstance(pattern, Pattern)
@@ -112,5 +154,317 @@ class NeighbordbUnitTests(unittest.TestCase):
         self.assertTrue(result['always_execute'])
 
 
+class InventoryUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        contents = """
+            patterns:
+                - name: spine1
+                  definition: tor
+                  interfaces:
+                    - Ethernet1: spine1:any
+                - name: catch all
+                  definition: default
+                  interfaces:
+                    - any: any
+        """
+        self.topology = ztpserver.neighbordb.load_topology(
+            contents=yaml.load(contents))
+
+        self.nodes = list()
+        for index in range(10):
+            node = create_node()
+            node.systemmac = '001c73%06x' % index
+            node.add_neighbor('Ethernet1', dict(device='spine%d' % (index % 2),
+                                                port='Ethernet%d' % index))
+            self.nodes.append(node.as_dict())
+        self.nodes.append(dict(neighbors=dict()))
+
+    def test_load_inventory(self):
+        contents = '\n'.join(json.dumps(node) for node in self.nodes)
+        self.assertEqual(ztpserver.neighbordb.load_inventory(contents),
+                         self.nodes)
+        self.assertEqual(ztpserver.neighbordb.load_inventory(
+            yaml.dump(self.nodes)), self.nodes)
+
+    def test_load_inventory_failure(self):
+        self.assertRaises(ztpserver.serializers.SerializerError,
+                          ztpserver.neighbordb.load_inventory,
+                          yaml.dump(self.nodes[0]))
+
+    def test_match_inventory(self):
+        results = list(ztpserver.neighbordb.match_inventory(self.nodes,
+                                                            self.topology))
+
+        self.assertEqual([r['index'] for r in results], range(11))
+        self.assertEqual(results[0]['pattern'], 'catch all')
+        self.assertEqual(results[1]['pattern'], 'spine1')
+        self.assertEqual(results[1]['definition'], 'tor')
+        self.assertEqual(results[1]['matches'], ['spine1', 'catch all'])
+        self.assertEqual(results[1]['systemmac'], '001c73000001')
+        self.assertIn('error', results[10])
+
+        # the original node descriptions are not modified
+        self.assertIn('systemmac', self.nodes[0])
+
+    def test_match_inventory_jobs(self):
+        serial = list(ztpserver.neighbordb.match_inventory(self.nodes,
+                                                           self.topology))
+        pool = list(ztpserver.neighbordb.match_inventory(self.nodes,
+                                                         self.topology, 2))
+        self.assertEqual(pool, serial)
+
+
+class TopologyCacheUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ztpserver.neighbordb.TopologyCache()
+        self.ndb = create_neighbordb()
+        self.ndb.add_pattern(create_pattern())
+        self.filename = write_file(self.ndb.as_yaml())
+
+    def tearDown(self):
+        remove_all()
+
+    def test_get_compiles_once(self):
+        first = self.cache.get(self.filename)
+        second = self.cache.get(self.filename)
+
+        self.assertIsInstance(first, Topology)
+        self.assertIs(first, second)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.rebuilds, 1)
+        self.assertIsNotNone(self.cache.stats()['rebuild_time'])
+
+    def test_metrics(self):
+        self.cache.get(self.filename)
+        self.cache.get(self.filename)
+
+        metrics = dict(((name, labels), value)
+                       for (name, labels, value) in self.cache.metrics())
+        self.assertEqual(
+            metrics[('ztps_topology_lookups_total', (('result', 'hit'),))], 1)
+        self.assertEqual(
+            metrics[('ztps_topology_lookups_total', (('result', 'miss'),))], 1)
+        self.assertEqual(metrics[('ztps_topology_rebuilds_total', ())], 1)
+
+    def test_get_rebuilds_on_change(self):
+        first = self.cache.get(self.filename)
+
+        self.ndb.add_pattern(create_pattern())
+        write_file(self.ndb.as_yaml(), self.filename)
+
+        second = self.cache.get(self.filename)
+        self.assertIsNot(first, second)
+        self.assertEqual(len(second.patterns['globals']), 2)
+        self.assertEqual(self.cache.misses, 2)
+
+    @patch('os.stat')
+    def test_get_touched_file_not_rebuilt(self, m_stat):
+        m_stat.return_value = Mock(st_mtime=1, st_size=1)
+        first = self.cache.get(self.filename)
+
+        m_stat.return_value = Mock(st_mtime=2, st_size=1)
+        second = self.cache.get(self.filename)
+
+        self.assertIs(first, second)
+        self.assertEqual(self.cache.rebuilds, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_reload(self):
+        first = self.cache.get(self.filename)
+        second = self.cache.reload(self.filename)
+        self.assertIsNot(first, second)
+        self.assertEqual(self.cache.rebuilds, 2)
+
+    def test_get_missing_file(self):
+        self.assertIsNone(self.cache.get(random_string()))
+
+    def test_get_loads_artifact(self):
+        pattern = create_pattern()
+        pattern.add_interface('Ethernet1-48', 'spine1', 'any')
+        self.ndb.patterns = [pattern]
+        write_file(self.ndb.as_yaml(), self.filename)
+
+        first = self.cache.get(self.filename)
+        artifact = ztpserver.neighbordb.artifact_filename(self.filename)
+        self.assertTrue(os.path.exists(artifact))
+
+        cache = ztpserver.neighbordb.TopologyCache()
+        second = cache.get(self.filename)
+        self.assertEqual(cache.rebuilds, 0)
+        self.assertEqual(cache.artifacts, 1)
+        self.assertEqual([p.name for p in second.patterns['globals']],
+                         [p.name for p in first.patterns['globals']])
+
+        # functions are shared with the rest of the process once loaded
+        item = second.patterns['globals'][0].interfaces[0]['patterns'][0]
+        self.assertIs(item.device_re,
+                      ztpserver.topology.intern_function(
+                          'exact', item.device_re.value))
+
+    def test_get_rejects_pickled_artifact(self):
+        self.cache.get(self.filename)
+        artifact = ztpserver.neighbordb.artifact_filename(self.filename)
+        header = open(artifact).readline()
+
+        # artifacts are never unpickled
+        marker = os.path.join(WORKINGDIR, random_string())
+        payload = "cos\nsystem\n(S'touch %s'\ntR." % marker
+        write_file(header + payload, artifact)
+
+        cache = ztpserver.neighbordb.TopologyCache()
+        self.assertIsInstance(cache.get(self.filename), Topology)
+        self.assertEqual(cache.artifacts, 0)
+        self.assertEqual(cache.rebuilds, 1)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_get_rejects_out_of_date_artifact(self):
+        self.cache.get(self.filename)
+
+        self.ndb.add_pattern(create_pattern())
+        write_file(self.ndb.as_yaml(), self.filename)
+
+        cache = ztpserver.neighbordb.TopologyCache()
+        topology = cache.get(self.filename)
+        self.assertEqual(cache.artifacts, 0)
+        self.assertEqual(cache.rebuilds, 1)
+        self.assertEqual(len(topology.patterns['globals']), 2)
+
+    def test_get_compile_disabled(self):
+        ztpserver.config.runtime.set_value('compile', False, 'neighbordb')
+        try:
+            self.assertIsInstance(self.cache.get(self.filename), Topology)
+        finally:
+            ztpserver.config.runtime.set_value('compile', True, 'neighbordb')
+
+        artifact = ztpserver.neighbordb.artifact_filename(self.filename)
+        self.assertFalse(os.path.exists(artifact))
+
+    def test_get_incremental_reload(self):
+        patterns = [create_pattern(), create_pattern()]
+        patterns[0].add_interface('Ethernet1', 'spine1', 'any')
+        patterns[1].add_interface('Ethernet1', 'spine2', 'any')
+        self.ndb.patterns = patterns
+        write_file(self.ndb.as_yaml(), self.filename)
+        first = self.cache.get(self.filename)
+
+        patterns[1].definition = random_string() * 2
+        write_file(self.ndb.as_yaml(), self.filename)
+        second = self.cache.get(self.filename)
+
+        self.assertEqual(self.cache.diff.changed, [patterns[1].name])
+        self.assertEqual(self.cache.diff.added, [])
+        self.assertEqual(self.cache.diff.removed, [])
+        self.assertIs(second.patterns['globals'][0],
+                      first.patterns['globals'][0])
+        self.assertIsNot(second.patterns['globals'][1],
+                         first.patterns['globals'][1])
+        self.assertEqual(second.patterns['globals'][1].definition,
+                         patterns[1].definition)
+
+    def test_get_provisioned_changes(self):
+        data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value('data_root', WORKINGDIR, 'default')
+
+        old = create_pattern()
+        old.add_interface('Ethernet1', 'any', 'any')
+        self.ndb.patterns = [old]
+        write_file(self.ndb.as_yaml(), self.filename)
+
+        for (systemmac, port) in [('001c73000001', 'Ethernet1'),
+                                  ('001c73000002', 'Ethernet2')]:
+            node = create_node()
+            node.systemmac = systemmac
+            node.add_neighbor('Ethernet1', dict(device='spine1', port=port))
+            folder = add_folder(os.path.join('nodes', systemmac))
+            write_file(node.as_json(), os.path.join(folder, '.node'))
+            write_file(yaml.dump(old.as_dict()),
+                       os.path.join(folder, 'pattern'))
+
+        try:
+            self.cache.get(self.filename)
+
+            new = create_pattern()
+            new.add_interface('Ethernet1', 'spine1', 'Ethernet1')
+            self.ndb.patterns = [new, old]
+            write_file(self.ndb.as_yaml(), self.filename)
+            self.cache.get(self.filename)
+        finally:
+            ztpserver.config.runtime.set_value('data_root', data_root,
+                                               'default')
+
+        self.cache.reporter.join()
+        self.assertEqual(self.cache.diff.added, [new.name])
+        self.assertEqual(self.cache.report,
+                         [('001c73000001', old.name, new.name)])
+
+    def test_provisioned_changes_modified_pattern(self):
+        pattern = create_pattern()
+        pattern.add_interface('Ethernet1', 'any', 'any')
+        self.ndb.patterns = [pattern]
+        write_file(self.ndb.as_yaml(), self.filename)
+        previous = self.cache.get(self.filename)
+
+        node = create_node()
+        node.systemmac = '001c73000001'
+        node.add_neighbor('Ethernet1', dict(device='spine1',
+                                            port='Ethernet1'))
+        folder = add_folder(os.path.join('nodes', node.systemmac))
+        write_file(node.as_json(), os.path.join(folder, '.node'))
+        write_file(yaml.dump(pattern.as_dict()),
+                   os.path.join(folder, 'pattern'))
+
+        pattern.definition = random_string() * 2
+        write_file(self.ndb.as_yaml(), self.filename)
+        topology = ztpserver.neighbordb.TopologyCache().get(self.filename)
+
+        diff = ztpserver.neighbordb.diff_topology(previous, topology)
+        self.assertEqual(diff.changed, [pattern.name])
+
+        # the node still matches the same, but modified, pattern
+        report = ztpserver.neighbordb.provisioned_changes(topology, diff,
+                                                          WORKINGDIR)
+        self.assertEqual(report,
+                         [(node.systemmac, pattern.name, pattern.name)])
+
+    def test_get_provisioned_changes_background(self):
+        self.cache.get(self.filename)
+        self.ndb.add_pattern(create_pattern())
+        write_file(self.ndb.as_yaml(), self.filename)
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def provisioned_changes(*args):
+            started.set()
+            release.wait(5)
+            return [('001c73000001', None, None)]
+
+        # the reload does not wait for the provisioned nodes to be checked
+        with patch('ztpserver.neighbordb.provisioned_changes',
+                   provisioned_changes):
+            topology = self.cache.get(self.filename)
+            self.assertEqual(len(topology.patterns['globals']), 2)
+            self.assertTrue(started.wait(5))
+            self.assertIsNone(self.cache.report)
+            self.assertIs(self.cache.get(self.filename), topology)
+
+            release.set()
+            self.cache.reporter.join()
+        self.assertEqual(self.cache.report, [('001c73000001', None, None)])
+
+    def test_compile_topology(self):
+        topology = ztpserver.neighbordb.compile_topology(self.filename)
+        self.assertIsInstance(topology, Topology)
+
+        digest = hashlib.sha1(open(self.filename).read()).hexdigest()
+        loaded = ztpserver.neighbordb.load_artifact(self.filename, digest)
+        self.assertIsInstance(loaded, Topology)
+        self.assertIsNone(ztpserver.neighbordb.load_artifact(self.filename,
+                                                             random_string()))
+
+
 if __name__ == '__main__':
     unittest.main()
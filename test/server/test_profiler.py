@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#pylint: disable=R0904,C0103
+
+import os
+import pstats
+import unittest
+
+import ztpserver.config
+
+from ztpserver.profiler import SamplingProfiler, ProfilerError, rotate
+
+from server_test_lib import remove_all, write_file, WORKINGDIR
+
+
+def work(value):
+    return sum(range(value))
+
+
+class RotateUnitTests(unittest.TestCase):
+
+    def tearDown(self):
+        remove_all()
+
+    def test_rotate(self):
+        filename = write_file('0', 'profile')
+        write_file('1', 'profile.1')
+        write_file('2', 'profile.2')
+
+        rotate(filename, 3)
+
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(open(filename + '.1').read(), '0')
+        self.assertEqual(open(filename + '.2').read(), '1')
+
+    def test_rotate_missing(self):
+        rotate(os.path.join(WORKINGDIR, 'missing'), 3)
+
+
+class SamplingProfilerUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        config = ztpserver.config.runtime
+        self.data_root = config.default.data_root
+        config.set_value('data_root', WORKINGDIR, 'default')
+        config.set_value('window', 100, 'profiling')
+        config.set_value('files', 2, 'profiling')
+        self.profiler = SamplingProfiler()
+
+    def tearDown(self):
+        config = ztpserver.config.runtime
+        config.set_value('data_root', self.data_root, 'default')
+        for name in ['window', 'files']:
+            config.clear_value(name, 'profiling')
+        remove_all()
+
+    def test_sample(self):
+        self.assertFalse(self.profiler.sample())
+
+        self.profiler.start(3)
+        samples = [self.profiler.sample() for _ in range(7)]
+        self.assertEqual(samples, [True, False, False, True, False, False,
+                                   True])
+
+        self.profiler.stop()
+        self.assertFalse(self.profiler.sample())
+
+    def test_start_default_interval(self):
+        self.profiler.start()
+        self.assertEqual(self.profiler.interval, 100)
+
+    def test_runcall(self):
+        self.profiler.start(1)
+        self.assertEqual(self.profiler.runcall(work, 10), 45)
+        self.assertEqual(self.profiler.runcall(work, 5), 10)
+        self.assertEqual(self.profiler.profiled, 2)
+
+        filename = self.profiler.stop()
+        self.assertEqual(os.path.dirname(filename),
+                         os.path.join(WORKINGDIR, 'profiles'))
+
+        stats = pstats.Stats(filename)
+        calls = [v[0] for k, v in stats.stats.items() if k[2] == 'work']
+        self.assertEqual(calls, [2])
+
+    def test_runcall_window(self):
+        ztpserver.config.runtime.set_value('window', 2, 'profiling')
+        self.profiler.start(1)
+        for _ in range(5):
+            self.profiler.runcall(work, 10)
+
+        filename = self.profiler.filename
+        self.assertTrue(os.path.exists(filename))
+        self.assertTrue(os.path.exists(filename + '.1'))
+        self.assertFalse(os.path.exists(filename + '.2'))
+        self.assertEqual(self.profiler.profiled, 1)
+
+    def test_runcall_exception(self):
+        self.profiler.start(1)
+        self.assertRaises(ZeroDivisionError, self.profiler.runcall,
+                          lambda: 1 / 0)
+        self.assertEqual(self.profiler.profiled, 1)
+
+    def test_download(self):
+        self.assertRaises(ProfilerError, self.profiler.download)
+
+        self.profiler.start(1)
+        self.profiler.runcall(work, 10)
+        contents = self.profiler.download()
+        self.assertEqual(contents, open(self.profiler.filename, 'rb').read())
+        self.assertEqual(self.profiler.profiled, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -41,9 +41,10 @@ from ztpserver.serializers import SerializerError
 
 from ztpserver.repository import FileObject, FileObjectError
 from ztpserver.repository import Repository, RepositoryError
-from ztpserver.repository import FileObjectNotFound
+from ztpserver.repository import FileObjectNotFound, RepositoryCache
+from ztpserver.constants import CONTENT_TYPE_YAML
 
-from server_test_lib import random_string
+from server_test_lib import random_string, write_file, remove_all
 
 class FileObjectUnitTests(unittest.TestCase):
 
@@ -76,6 +77,59 @@ class FileObjectUnitTests(unittest.TestCase):
         self.assertRaises(FileObjectError, obj.write, random_string())
 
 
+class RepositoryCacheUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RepositoryCache(1024)
+        self.filepath = write_file('foo: [1, 2]\n', 'cached.yaml')
+
+    def tearDown(self):
+        remove_all()
+
+    def test_read_cached(self):
+        result = self.cache.read(self.filepath, CONTENT_TYPE_YAML)
+        self.assertEqual(result, {'foo': [1, 2]})
+        result['foo'].append(3)
+
+        with patch('ztpserver.serializers.load') as m_load:
+            result = self.cache.read(self.filepath, CONTENT_TYPE_YAML)
+            self.assertFalse(m_load.called)
+        self.assertEqual(result, {'foo': [1, 2]})
+        self.assertEqual(self.cache.stats()['hit_ratio'], 0.5)
+
+    def test_read_modified(self):
+        self.cache.read(self.filepath, CONTENT_TYPE_YAML)
+        write_file('foo: bar\n', 'cached.yaml')
+        result = self.cache.read(self.filepath, CONTENT_TYPE_YAML)
+        self.assertEqual(result, {'foo': 'bar'})
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_read_cls(self):
+        result = self.cache.read(self.filepath, CONTENT_TYPE_YAML, dict)
+        self.assertEqual(result, {'foo': [1, 2]})
+
+    def test_evict(self):
+        self.cache.maxsize = 15
+        other = write_file('bar: baz\n', 'other.yaml')
+        self.cache.read(self.filepath, CONTENT_TYPE_YAML)
+        self.cache.read(other, CONTENT_TYPE_YAML)
+        self.cache.read(other, CONTENT_TYPE_YAML)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.size, len('bar: baz\n'))
+
+    def test_invalidate_on_write(self):
+        store = Repository(os.path.dirname(self.filepath), cache=self.cache)
+        fobj = store.get_file('cached.yaml')
+        fobj.read(CONTENT_TYPE_YAML)
+        fobj.write({'foo': 'bar'}, CONTENT_TYPE_YAML)
+        self.assertEqual(len(self.cache.entries), 0)
+        self.assertEqual(fobj.read(CONTENT_TYPE_YAML), {'foo': 'bar'})
+
+        store.delete_file('cached.yaml')
+        self.assertEqual(len(self.cache.entries), 0)
+
+
 class RepositoryUnitTests(unittest.TestCase):
 
     @patch('os.makedirs')
@@ -0,0 +1,324 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import unittest
+# pylint: disable=C0103
+#
+import os
+import unittest
+import multiprocessing
+
+import yaml
+
+from mock import patch
+
+import ztpserver.config
+import ztpserver.neighbordb
+
+from ztpserver.resources import PoolStore, ResourcePool, ResourcePoolError
+from ztpserver.resources import RangePool, pool_usage
+
+from server_test_lib import write_file, remove_all, random_string
+from server_test_lib import add_folder
+from server_test_lib import create_node, WORKINGDIR
+
+
+def allocate_many(filepath, owners):
+    store = PoolStore(filepath)
+    for owner in owners:
+        store.allocate(owner)
+
+
+class StrictLoader(yaml.SafeLoader):
+    ''' Rejects duplicate mapping keys like YAML 1.2 loaders '''
+
+    def construct_mapping(self, node, deep=False):
+        keys = set()
+        for (key_node, _) in node.value:
+            key = self.construct_object(key_node, deep=deep)
+            if key in keys:
+                raise yaml.constructor.ConstructorError(
+                    None, None, 'duplicate key %r' % key,
+                    key_node.start_mark)
+            keys.add(key)
+        return yaml.SafeLoader.construct_mapping(self, node, deep)
+
+
+class PoolStoreUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        contents = dict(('10.1.0.%d' % i, None) for i in range(100))
+        self.filepath = write_file(yaml.dump(contents,
+                                             default_flow_style=False),
+                                   'pool')
+        self.store = PoolStore(self.filepath)
+
+    def tearDown(self):
+        remove_all()
+
+    def load(self):
+        return yaml.safe_load(open(self.filepath))
+
+    def test_allocate(self):
+        key = self.store.allocate('node1')
+        self.assertEqual(self.load()[key], 'node1')
+        self.assertEqual(self.store.allocate('node1'), key)
+        self.assertEqual(self.store.lookup('node1'), key)
+        self.assertIsNone(self.store.lookup('node2'))
+
+    def test_allocate_appends(self):
+        size = os.path.getsize(self.filepath)
+        key = self.store.allocate('node1')
+        with open(self.filepath) as fhandle:
+            fhandle.seek(size)
+            self.assertEqual(fhandle.read(), '%s: node1\n' % key)
+
+    def test_allocate_appends_duplicate_keys(self):
+        # appended entries repeat keys, which only loaders keeping the
+        # last duplicate key (such as PyYAML) read correctly
+        key = self.store.allocate('node1')
+        self.assertEqual(self.load()[key], 'node1')
+        self.assertRaises(yaml.constructor.ConstructorError, yaml.load,
+                          open(self.filepath), Loader=StrictLoader)
+
+        self.store.compact()
+        contents = yaml.load(open(self.filepath), Loader=StrictLoader)
+        self.assertEqual(contents[key], 'node1')
+
+    def test_available(self):
+        self.assertEqual(self.store.available(), 100)
+        key = self.store.allocate('node1')
+        self.store.allocate('node2')
+        self.assertEqual(self.store.available(), 98)
+        self.store.release(key)
+        self.assertEqual(self.store.available(), 99)
+
+    def test_allocate_exhausted(self):
+        for index in range(100):
+            self.store.allocate('node%d' % index)
+        self.assertRaises(ResourcePoolError, self.store.allocate, 'node100')
+
+    def test_allocate_compacts(self):
+        keys = set()
+        for index in range(100):
+            keys.add(self.store.allocate('node%d' % index))
+        self.assertEqual(len(keys), 100)
+        self.assertEqual(len(open(self.filepath).readlines()), 200)
+
+        self.store.pool.update(keys.pop(), None)
+        self.store.allocate('node100')
+        self.assertEqual(self.store.appended, 0)
+        self.assertEqual(len(open(self.filepath).readlines()), 100)
+        self.assertEqual(len(set(self.load().values())), 100)
+
+    def test_refresh_appended_entries(self):
+        other = PoolStore(self.filepath)
+        key = self.store.allocate('node1')
+        self.assertEqual(other.lookup('node1'), key)
+        self.assertNotEqual(other.allocate('node2'), key)
+        self.assertEqual(self.store.lookup('node2'), other.lookup('node2'))
+
+    def test_refresh_rewritten_file(self):
+        self.store.allocate('node1')
+        write_file(yaml.dump({'10.2.0.1': 'node2'}), 'pool')
+        self.assertIsNone(self.store.lookup('node1'))
+        self.assertEqual(self.store.lookup('node2'), '10.2.0.1')
+
+    def test_flow_style_pool(self):
+        write_file('{10.3.0.1: null, 10.3.0.2: null}', 'pool')
+        key = self.store.allocate('node1')
+        self.assertEqual(self.load(), {key: 'node1',
+                                       ({'10.3.0.1', '10.3.0.2'} -
+                                        {key}).pop(): None})
+
+    def test_allocate_multiple_processes(self):
+        owners = ['node%d' % i for i in range(80)]
+        workers = [multiprocessing.Process(target=allocate_many,
+                                           args=(self.filepath,
+                                                 owners[i::4]))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        allocated = [v for v in self.load().values() if v is not None]
+        self.assertEqual(sorted(allocated), sorted(owners))
+
+
+class RangePoolUnitTests(unittest.TestCase):
+
+    def create_store(self, contents):
+        filepath = write_file(yaml.dump(contents, default_flow_style=False),
+                              'pool')
+        return PoolStore(filepath)
+
+    def tearDown(self):
+        remove_all()
+
+    def test_cidr_pool(self):
+        store = self.create_store(dict(type='cidr', pool='10.1.0.0/30'))
+        self.assertEqual(store.allocate('node1'), '10.1.0.1')
+        self.assertEqual(store.allocate('node2'), '10.1.0.2')
+        self.assertRaises(ResourcePoolError, store.allocate, 'node3')
+
+        store.release('10.1.0.1')
+        self.assertEqual(store.allocate('node3'), '10.1.0.1')
+        self.assertEqual(store.lookup('node2'), '10.1.0.2')
+
+    def test_cidr_pool_large(self):
+        store = self.create_store(dict(type='cidr', pool='10.0.0.0/8'))
+        keys = [store.allocate('node%d' % i) for i in range(300)]
+        self.assertEqual(keys[0], '10.0.0.1')
+        self.assertEqual(keys[-1], '10.0.1.44')
+
+    def test_cidr_pool_ipv6(self):
+        store = self.create_store(dict(type='cidr', pool='2001:db8::/120'))
+        self.assertEqual(store.allocate('node1'), '2001:db8::')
+        self.assertEqual(store.allocate('node2'), '2001:db8::1')
+
+    def test_range_pool(self):
+        store = self.create_store(dict(type='range', pool='65000-65001,65010',
+                                       allocations={65000: 'node1'}))
+        self.assertEqual(store.allocate('node1'), 65000)
+        self.assertEqual(store.allocate('node2'), 65001)
+        self.assertEqual(store.allocate('node3'), 65010)
+        self.assertRaises(ResourcePoolError, store.allocate, 'node4')
+
+    def test_range_pool_available(self):
+        store = self.create_store(dict(type='range', pool='65000-65009',
+                                       allocations={65000: 'node1'}))
+        self.assertEqual(store.available(), 9)
+        store.allocate('node2')
+        self.assertEqual(store.available(), 8)
+
+    def test_pool_usage(self):
+        write_file(yaml.dump({'10.1.0.1': None, '10.1.0.2': 'node1'}),
+                   'pool')
+        write_file('', '.pool.lock')
+        self.assertEqual(pool_usage(WORKINGDIR), [('pool', 1)])
+        self.assertEqual(pool_usage(os.path.join(WORKINGDIR, 'missing')),
+                         list())
+
+    def test_vlan_pool_invalid(self):
+        self.assertRaises(ResourcePoolError, RangePool,
+                          dict(type='vlan', pool='4000-4095'))
+
+    def test_range_pool_persisted(self):
+        store = self.create_store(dict(type='vlan', pool='100-199'))
+        for index in range(10):
+            store.allocate('node%d' % index)
+
+        contents = yaml.safe_load(open(store.filepath))
+        self.assertEqual(contents['type'], 'vlan')
+        self.assertEqual(contents['allocations'][109], 'node9')
+        self.assertEqual(PoolStore(store.filepath).lookup('node9'), 109)
+
+        store.compact()
+        self.assertEqual(yaml.safe_load(open(store.filepath)), contents)
+
+    def test_range_pool_indented(self):
+        filepath = write_file('type: vlan\n'
+                              'pool: 100-199\n'
+                              'allocations:\n'
+                              '    100: node1\n'
+                              '    101: node2\n', 'pool')
+        store = PoolStore(filepath)
+        self.assertEqual(store.allocate('node3'), 102)
+        self.assertEqual(store.allocate('node4'), 103)
+
+        contents = yaml.safe_load(open(filepath))
+        self.assertEqual(contents['allocations'],
+                         {100: 'node1', 101: 'node2',
+                          102: 'node3', 103: 'node4'})
+        self.assertEqual(PoolStore(filepath).lookup('node4'), 103)
+
+
+class ResourcePoolUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value('data_root', WORKINGDIR,
+                                           'default')
+        add_folder('resources')
+        self.pool = random_string()
+        self.keys = [random_string() for _ in range(10)]
+        write_file(yaml.dump(dict((k, None) for k in self.keys)),
+                   os.path.join('resources', self.pool))
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value('data_root', self.data_root,
+                                           'default')
+        remove_all()
+
+    def test_allocate(self):
+        node = create_node()
+        key = ResourcePool().allocate(self.pool, node)
+        self.assertIn(key, self.keys)
+        self.assertEqual(ResourcePool().lookup(self.pool, node), key)
+
+    def test_allocate_missing_pool(self):
+        node = create_node()
+        self.assertRaises(ResourcePoolError, ResourcePool().allocate,
+                          random_string(), node)
+
+    def test_allocate_all_rollback(self):
+        empty = random_string()
+        write_file(yaml.dump({random_string(): random_string()}),
+                   os.path.join('resources', empty))
+
+        node = create_node()
+        self.assertRaises(ResourcePoolError, ResourcePool().allocate_all,
+                          [self.pool, empty], node)
+        self.assertIsNone(ResourcePool().lookup(self.pool, node))
+
+    def test_allocate_resources(self):
+        node = create_node()
+        attributes = [dict(ip="allocate('%s')" % self.pool),
+                      dict(nested=dict(peer="allocate('%s')" % self.pool),
+                           url=random_string())]
+
+        with patch.object(PoolStore, 'write',
+                          autospec=True,
+                          side_effect=PoolStore.write) as m_write:
+            allocations = ztpserver.neighbordb.allocate_resources(attributes,
+                                                                  node)
+            self.assertEqual(m_write.call_count, 1)
+
+        key = allocations[self.pool]
+        result = ztpserver.neighbordb.resources(attributes[1], node,
+                                                allocations)
+        self.assertEqual(result['nested']['peer'], key)
+        self.assertEqual(result['url'], attributes[1]['url'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -49,5 +49,27 @@ class SerializersUnitTest(unittest.TestCase):
     def test_loads_success(self):
         pass
 
+    def test_loads_yaml_native_str(self):
+        contents = 'name: test\nlist:\n  - {key: value}\n  - 1\n'
+        obj = ztpserver.serializers.loads(contents, 'application/yaml')
+
+        self.assertEqual(obj, {'name': 'test', 'list': [{'key': 'value'}, 1]})
+        for value in [obj.keys()[0], obj['name'], obj['list'][0]['key']]:
+            self.assertIs(type(value), str)
+
+    def test_loads_yaml_non_ascii_failure(self):
+        self.assertRaises(ztpserver.serializers.SerializerError,
+                          ztpserver.serializers.loads,
+                          'name: caf\xc3\xa9\n', 'application/yaml')
+
+    def test_dumps_yaml_round_trip(self):
+        obj = {'name': 'test', 'list': [{'key': 'value'}, 1]}
+        for safe_dump in [True, False]:
+            contents = ztpserver.serializers.dumps(obj, 'application/yaml',
+                                                   safe_dump=safe_dump)
+            self.assertEqual(ztpserver.serializers.loads(contents,
+                                                         'application/yaml'),
+                             obj)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,393 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import time
+import errno
+import shutil
+import signal
+import socket
+import tempfile
+import unittest
+import threading
+import urllib2
+
+from wsgiref.simple_server import WSGIServer
+
+from mock import patch
+
+import ztpserver.config
+
+from ztpserver.server import create_server, serve
+from ztpserver.server import ThreadPoolWSGIServer, PreforkServer
+from ztpserver.wsgiapp import StaticFileApp
+
+from server_test_lib import write_file, remove_all
+
+
+def sleep_app(environ, start_response):
+    time.sleep(0.2)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [threading.current_thread().name]
+
+def pid_app(environ, start_response):
+    if environ['PATH_INFO'] == '/slow':
+        # sleep in short steps so signals do not end the request early
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            time.sleep(0.1)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError('Timed out waiting for %s' % predicate)
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        if exc.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+class CreateServerUnitTests(unittest.TestCase):
+
+    def test_create_server_single(self):
+        httpd = create_server('127.0.0.1', 0, sleep_app)
+        self.assertIsInstance(httpd, WSGIServer)
+        self.assertNotIsInstance(httpd, ThreadPoolWSGIServer)
+        httpd.server_close()
+
+    def test_create_server_threads(self):
+        httpd = create_server('127.0.0.1', 0, sleep_app, threads=4)
+        self.assertIsInstance(httpd, ThreadPoolWSGIServer)
+        self.assertEqual(httpd.threads, 4)
+        httpd.server_close()
+
+
+class ThreadPoolWSGIServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.httpd = create_server('127.0.0.1', 0, sleep_app, threads=4)
+        self.httpd.RequestHandlerClass.log_message = lambda *args: None
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+    def test_concurrent_requests(self):
+        results = list()
+
+        def fetch():
+            results.append(urllib2.urlopen(self.url, timeout=5).read())
+
+        clients = [threading.Thread(target=fetch) for _ in range(4)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r.startswith('ztps-worker-') for r in results))
+        self.assertLess(time.time() - start, 0.6)
+
+    def test_server_close_completes_requests(self):
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.httpd.server_port))
+        sock.sendall('GET / HTTP/1.0\r\n\r\n')
+        time.sleep(0.05)
+
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+        self.assertTrue(sock.recv(1024).startswith('HTTP/1.0 200'))
+        sock.close()
+
+
+class ThreadPoolShutdownTests(unittest.TestCase):
+
+    def test_server_close_queue_full(self):
+        httpd = create_server('127.0.0.1', 0, sleep_app, threads=2,
+                              shutdown_timeout=1)
+        release = threading.Event()
+        httpd.finish_request = lambda request, address: release.wait(10)
+        httpd.shutdown_request = lambda request: None
+
+        try:
+            # both workers are busy and the request queue is full
+            for _ in range(httpd.threads):
+                httpd.process_request(object(), None)
+            wait_for(lambda: httpd.requests.empty())
+            while not httpd.requests.full():
+                httpd.process_request(object(), None)
+
+            start = time.time()
+            httpd.server_close()
+            self.assertLess(time.time() - start, 2)
+            self.assertIsNone(httpd.workers)
+        finally:
+            release.set()
+
+
+class SendfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.contents = os.urandom(200000)
+        filename = write_file(self.contents, 'image.swi', mode='wb')
+        self.httpd = create_server('127.0.0.1', 0, StaticFileApp(filename))
+        self.httpd.RequestHandlerClass.log_message = lambda *args: None
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+        self.calls = list()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+        remove_all()
+
+    def sendfile(self, outfd, infd, offset, count):
+        self.calls.append((offset, count))
+        os.lseek(infd, offset, os.SEEK_SET)
+        return os.write(outfd, os.read(infd, min(count, 65536)))
+
+    def test_sendfile(self):
+        with patch('ztpserver.server.sendfile', self.sendfile):
+            resp = urllib2.urlopen(self.url, timeout=5)
+            self.assertEqual(resp.read(), self.contents)
+        self.assertEqual(self.calls[0], (0, len(self.contents)))
+
+    def test_sendfile_range(self):
+        request = urllib2.Request(self.url,
+                                  headers={'Range': 'bytes=1000-1999'})
+        with patch('ztpserver.server.sendfile', self.sendfile):
+            resp = urllib2.urlopen(request, timeout=5)
+            self.assertEqual(resp.getcode(), 206)
+            self.assertEqual(resp.read(), self.contents[1000:2000])
+        self.assertEqual(self.calls, [(1000, 1000)])
+
+    def test_sendfile_unavailable(self):
+        with patch('ztpserver.server.sendfile', None):
+            resp = urllib2.urlopen(self.url, timeout=5)
+            self.assertEqual(resp.read(), self.contents)
+
+
+class ServeUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        config = ztpserver.config.runtime.server
+        self.config = dict(mode=config.mode, workers=config.workers,
+                           threads=config.threads,
+                           shutdown_timeout=config.shutdown_timeout)
+
+    def tearDown(self):
+        for key, value in self.config.items():
+            ztpserver.config.runtime.set_value(key, value, 'server')
+
+    @patch('ztpserver.server.PreforkServer')
+    @patch('ztpserver.server.create_server')
+    def test_serve_prefork(self, m_create_server, m_prefork):
+        ztpserver.config.runtime.set_value('mode', 'prefork', 'server')
+        ztpserver.config.runtime.set_value('workers', 3, 'server')
+        ztpserver.config.runtime.set_value('threads', 8, 'server')
+        ztpserver.config.runtime.set_value('shutdown_timeout', 7, 'server')
+
+        serve(sleep_app, '127.0.0.1', 8080)
+
+        m_create_server.assert_called_once_with('127.0.0.1', 8080,
+                                                sleep_app, 8, 7)
+        m_prefork.assert_called_once_with(m_create_server.return_value,
+                                          3, 7)
+        m_prefork.return_value.serve_forever.assert_called_once_with()
+        self.assertFalse(m_create_server.return_value.serve_forever.called)
+
+
+class PreforkServerUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PreforkServer(None, 2)
+
+    @patch('ztpserver.server.log')
+    @patch('ztpserver.server.time.sleep')
+    def test_restarted_backoff(self, m_sleep, m_log):
+        for _ in range(10):
+            self.server.restarted(1, 1 << 8, 0.1)
+        delays = [args[0] for (args, _) in m_sleep.call_args_list]
+        self.assertEqual(delays[:4], [0.5, 1, 2, 4])
+        self.assertEqual(delays[-1], self.server.max_restart_delay)
+
+        # a worker that ran long enough resets the delay
+        self.server.restarted(1, 1 << 8, 5)
+        self.assertEqual(m_sleep.call_count, 10)
+        self.server.restarted(1, 1 << 8, 0.1)
+        self.assertEqual(m_sleep.call_args[0][0], 0.5)
+
+    @patch('ztpserver.server.log')
+    @patch('ztpserver.server.time.sleep')
+    def test_restarted_status(self, m_sleep, m_log):
+        self.server.restarted(1, 3 << 8, 5)
+        self.assertIn('exited with status 3', m_log.warning.call_args[0])
+
+        self.server.restarted(1, signal.SIGKILL, 5)
+        self.assertIn('was killed by signal %d' % signal.SIGKILL,
+                      m_log.warning.call_args[0])
+        self.assertFalse(m_sleep.called)
+
+
+class PreforkServerTests(unittest.TestCase):
+    ''' Runs a PreforkServer with 2 workers in a child process '''
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp(prefix='ztps-test-')
+        self.httpd = create_server('127.0.0.1', 0, pid_app)
+        self.httpd.RequestHandlerClass.log_message = lambda *args: None
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_port
+        self.master = None
+
+    def tearDown(self):
+        if self.master is not None:
+            try:
+                os.killpg(self.master, signal.SIGKILL)
+                os.waitpid(self.master, 0)
+            except OSError:
+                pass
+        self.httpd.server_close()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def start(self, shutdown_timeout=5):
+        self.master = os.fork()
+        if self.master:
+            return
+
+        status = 1
+        try:
+            # own process group so tearDown can kill any leftover workers
+            os.setpgid(0, 0)
+            with patch('ztpserver.server.tempfile.mkdtemp',
+                       return_value=self.metrics_dir):
+                PreforkServer(self.httpd, 2, shutdown_timeout).serve_forever()
+            status = 0
+        finally:
+            os._exit(status)     #pylint: disable=W0212
+
+    def workers(self):
+        ''' Returns the pids of the workers serving metrics '''
+
+        try:
+            filenames = os.listdir(self.metrics_dir)
+        except OSError:
+            return set()
+        return set(int(fn.split('.')[0]) for fn in filenames
+                   if fn.endswith('.sock'))
+
+    def wait_master(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            (pid, status) = os.waitpid(self.master, os.WNOHANG)
+            if pid:
+                self.master = None
+                return status
+            time.sleep(0.05)
+        raise AssertionError('Master process did not exit')
+
+    def test_serve_requests(self):
+        self.start()
+        workers = wait_for(lambda: len(self.workers()) == 2 and
+                           self.workers())
+
+        resp = urllib2.urlopen(self.url, timeout=5)
+        self.assertEqual(resp.getcode(), 200)
+        self.assertIn(int(resp.read()), workers)
+
+    def test_restart_worker(self):
+        self.start()
+        workers = wait_for(lambda: len(self.workers()) == 2 and
+                           self.workers())
+
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        wait_for(lambda: len(self.workers() - set([killed])) == 2)
+
+        resp = urllib2.urlopen(self.url, timeout=5)
+        self.assertNotEqual(int(resp.read()), killed)
+
+    def test_terminate(self):
+        self.start()
+        workers = wait_for(lambda: len(self.workers()) == 2 and
+                           self.workers())
+
+        os.kill(self.master, signal.SIGTERM)
+        self.assertEqual(self.wait_master(), 0)
+
+        self.assertFalse(os.path.exists(self.metrics_dir))
+        for pid in workers:
+            self.assertFalse(alive(pid))
+
+    def test_terminate_timeout(self):
+        self.start(shutdown_timeout=1)
+        workers = wait_for(lambda: len(self.workers()) == 2 and
+                           self.workers())
+
+        # a request that outlives the shutdown timeout
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.httpd.server_port))
+        sock.sendall('GET /slow HTTP/1.0\r\n\r\n')
+        time.sleep(0.2)
+
+        start = time.time()
+        os.kill(self.master, signal.SIGTERM)
+        self.assertEqual(self.wait_master(), 0)
+        self.assertLess(time.time() - start, 5)
+
+        self.assertEqual(sock.recv(1024), '')
+        sock.close()
+        self.assertFalse(os.path.exists(self.metrics_dir))
+        for pid in workers:
+            self.assertFalse(alive(pid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,6 +31,7 @@
 #
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 #
+import json
 import unittest
 import traceback
 
@@ -288,6 +289,35 @@ class FunctionsUnitTests(unittest.TestCase):
         func = ztpserver.topology.RegexFunction(value)
         self.assertFalse(func.match(random_string()))
 
+    def test_intern_function(self):
+        value = random_string()
+        func = ztpserver.topology.intern_function('regex', value)
+        self.assertIsInstance(func, ztpserver.topology.RegexFunction)
+        self.assertIs(func, ztpserver.topology.intern_function('regex', value))
+        self.assertIsNot(func,
+                         ztpserver.topology.intern_function('exact', value))
+
+    def test_intern_function_unknown(self):
+        self.assertRaises(KeyError, ztpserver.topology.intern_function,
+                          random_string(), random_string())
+
+    def test_pattern_digest(self):
+        digest = ztpserver.topology.pattern_digest
+        entry = dict(name='tor', definition='tor',
+                     variables=dict(a='1', b='2'),
+                     interfaces=[{'Ethernet1': 'spine1'},
+                                 {'any': dict(device='spine2', port='any')}])
+        reordered = dict(interfaces=[{'Ethernet1': 'spine1'},
+                                     {'any': dict(port='any',
+                                                  device='spine2')}],
+                         variables=dict(b='2', a='1'),
+                         definition='tor', name='tor')
+        self.assertEqual(digest(entry), digest(reordered))
+
+        reordered['interfaces'].reverse()
+        self.assertNotEqual(digest(entry), digest(reordered))
+        self.assertNotEqual(digest(entry), digest(dict(entry, node=None)))
+
 
 class TestPattern(unittest.TestCase):
 
@@ -345,6 +375,64 @@ class PatternUnitTests(unittest.TestCase):
             self.fail('add_interface raised an exception unexpectedly')
 
 
+    def create_node(self, neighbors):
+        node = Node(random_string())
+        for interface, peers in neighbors.items():
+            node.add_neighbor(interface, [dict(device=d, port=p)
+                                          for d, p in peers])
+        return node
+
+    def test_match_node_optimal_assignment(self):
+        # a greedy assignment tries Ethernet1 against 'any: spine1' first,
+        # rejects the neighbor and fails the whole pattern
+        pattern = Pattern(random_string(),
+                          interfaces=[{'any': 'spine1'}, {'any': 'leaf1'}])
+        node = Node(random_string())
+        node.add_neighbor('Ethernet1', [dict(device='leaf1', port='Eth1')])
+        node.add_neighbor('Ethernet2', [dict(device='spine1', port='Eth1')])
+        self.assertTrue(pattern.match_node(node))
+
+    def test_match_node_missing_required(self):
+        pattern = Pattern(random_string(),
+                          interfaces=[{'Ethernet1': 'spine1'},
+                                      {'Ethernet2': 'spine2'}])
+        node = self.create_node({'Ethernet1': [('spine1', 'Ethernet1')]})
+        self.assertFalse(pattern.match_node(node))
+
+    def test_match_node_none_constraint(self):
+        pattern = Pattern(random_string(),
+                          interfaces=[{'Ethernet4': 'none'},
+                                      {'any': 'any'}])
+        node = self.create_node({'Ethernet4': [('spine1', 'Ethernet1')]})
+        self.assertFalse(pattern.match_node(node))
+
+    def test_match_node_claim_consumed(self):
+        pattern = Pattern(random_string(), interfaces=[{'any': 'spine1'}])
+        node = self.create_node({'Ethernet1': [('leaf1', 'Ethernet1')],
+                                 'Ethernet2': [('spine1', 'Ethernet1')]})
+        self.assertTrue(pattern.match_node(node))
+
+        node = self.create_node({'Ethernet1': [('leaf1', 'Ethernet1')]})
+        self.assertFalse(pattern.match_node(node))
+
+    def test_match_node_interface_range(self):
+        pattern = Pattern(random_string(),
+                          interfaces=[{'Ethernet1-2': 'spine1'},
+                                      {'Ethernet3-5': 'none'}])
+        self.assertEqual(len(pattern.interfaces[0]['patterns']), 1)
+
+        node = self.create_node({'Ethernet1': [('spine1', 'Ethernet1')],
+                                 'Ethernet2': [('spine1', 'Ethernet2')]})
+        self.assertTrue(pattern.match_node(node))
+
+        node = self.create_node({'Ethernet1': [('spine1', 'Ethernet1')]})
+        self.assertFalse(pattern.match_node(node))
+
+        node = self.create_node({'Ethernet1': [('spine1', 'Ethernet1')],
+                                 'Ethernet2': [('spine1', 'Ethernet2')],
+                                 'Ethernet3': [('leaf1', 'Ethernet1')]})
+        self.assertFalse(pattern.match_node(node))
+
     def test_add_interface_failure(self):
         kwargs = dict(name=random_string(),
                       definition=random_string(),
@@ -354,6 +442,166 @@ class PatternUnitTests(unittest.TestCase):
         self.assertRaises(PatternError, pattern.add_interface, random_string())
 
 
+class PatternIndexUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ztpserver.topology.PatternIndex()
+
+    def create_node(self, neighbors):
+        nodeattrs = create_node()
+        nodeattrs.neighbors = neighbors
+        kwargs = nodeattrs.as_dict()
+        return Node(kwargs.pop('systemmac'), **kwargs)
+
+    def test_constraints(self):
+        pattern = Pattern(random_string(),
+                          interfaces=[{'Ethernet1': 'spine1:Ethernet2'},
+                                      {'any': 'spine2'},
+                                      {'Ethernet3': 'any'}])
+        self.assertEqual(pattern.constraints(),
+                         frozenset([('interface', 'Ethernet1'),
+                                    ('device', 'spine1'),
+                                    ('port', 'Ethernet2')]))
+
+    def test_candidates_pruned(self):
+        pattern = Pattern(random_string(),
+                          interfaces=[{'Ethernet1': 'spine1:Ethernet2'}])
+        self.index.add(pattern)
+
+        node = self.create_node({'Ethernet1': [dict(device='spine2',
+                                                    port='Ethernet2')]})
+        self.assertEqual(self.index.candidates(node), list())
+
+    def test_candidates_ordered(self):
+        patterns = [Pattern(random_string(),
+                            interfaces=[{'any': 'any'}]),
+                    Pattern(random_string(),
+                            interfaces=[{'Ethernet1': 'spine1:Ethernet2'}]),
+                    Pattern(random_string(),
+                            interfaces=[{'Ethernet1': 'spine2'}]),
+                    Pattern(random_string())]
+        for pattern in patterns:
+            self.index.add(pattern)
+
+        node = self.create_node({'Ethernet1': [dict(device='spine1',
+                                                    port='Ethernet2')]})
+        self.assertEqual(self.index.candidates(node),
+                         [patterns[0], patterns[1], patterns[3]])
+
+    def test_topology_match_node_uses_index(self):
+        topology = Topology()
+        topology.add_pattern('spine1', interfaces=[{'Ethernet1': 'spine1'}])
+        topology.add_pattern('spine2', interfaces=[{'Ethernet1': 'spine2'}])
+
+        node = self.create_node({'Ethernet1': [dict(device='spine2',
+                                                    port='Ethernet1')]})
+        result = topology.match_node(node)
+        self.assertEqual([p.name for p in result], ['spine2'])
+
+
+class TopologyMatchCacheUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = Topology()
+        self.topology.add_pattern('spine1',
+                                  interfaces=[{'Ethernet1': 'spine1'}])
+        self.topology.add_pattern('default', interfaces=[{'any': 'any'}])
+
+    @staticmethod
+    def create_node(systemmac, device):
+        return Node(systemmac,
+                    neighbors={'Ethernet1': [dict(device=device,
+                                                  port='Ethernet1')],
+                               'Ethernet2': [dict(device='spine2',
+                                                  port='Ethernet1')]})
+
+    def test_match_node_cached(self):
+        first = self.topology.match_node(self.create_node('1', 'spine1'))
+        second = self.topology.match_node(self.create_node('2', 'spine1'))
+        other = self.topology.match_node(self.create_node('3', 'spine3'))
+
+        self.assertEqual([p.name for p in first], ['spine1', 'default'])
+        self.assertEqual(second, first)
+        self.assertIsNot(second, first)
+        self.assertEqual([p.name for p in other], ['default'])
+
+        stats = self.topology.match_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_match_node_cached_node_pattern(self):
+        self.topology.add_pattern('node', node='2',
+                                  interfaces=[{'Ethernet2': 'spine2'}])
+
+        first = self.topology.match_node(self.create_node('1', 'spine1'))
+        second = self.topology.match_node(self.create_node('2', 'spine1'))
+
+        self.assertEqual([p.name for p in first], ['spine1', 'default'])
+        self.assertEqual([p.name for p in second], ['node'])
+        self.assertEqual(self.topology.match_stats()['hits'], 0)
+
+    def test_match_node_cache_bounded(self):
+        self.topology.MATCH_CACHE_SIZE = 2
+        for device in ['spine1', 'spine3', 'spine4', 'spine1']:
+            self.topology.match_node(self.create_node('1', device))
+
+        stats = self.topology.match_stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['misses'], 4)
+
+    def test_match_node_cache_invalidated(self):
+        node = self.create_node('1', 'spine3')
+        self.topology.match_node(node)
+        self.topology.add_pattern('spine3',
+                                  interfaces=[{'Ethernet1': 'spine3'}])
+
+        result = self.topology.match_node(node)
+        self.assertEqual([p.name for p in result], ['default', 'spine3'])
+
+
+class CompiledTopologyUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = Topology(variables={'spine': 'spine1'})
+        self.topology.add_pattern('spine', definition='leaf',
+                                  variables={'spine': 'spine1'},
+                                  interfaces=[{'Ethernet1-4': '$spine'},
+                                              {'any': "regex('^spine2$')"}])
+        self.topology.add_pattern('node', node='1',
+                                  interfaces=[{'Ethernet2': 'spine2'}])
+        self.topology.add_pattern('default', interfaces=[{'any': 'any'}])
+
+    def test_round_trip(self):
+        contents = ztpserver.topology.dump_compiled(self.topology)
+        topology = ztpserver.topology.load_compiled(contents)
+
+        self.assertEqual(topology.variables, self.topology.variables)
+        self.assertEqual([p.serialize() for p in topology.get_patterns(
+                              lambda _: True)],
+                         [p.serialize() for p in self.topology.get_patterns(
+                              lambda _: True)])
+        self.assertIsInstance(topology.variables.keys()[0], str)
+
+        for systemmac in ['1', '2']:
+            node = Node(systemmac,
+                        neighbors={'Ethernet3': [dict(device='spine1',
+                                                      port='Ethernet1')],
+                                   'Ethernet5': [dict(device='spine2',
+                                                      port='Ethernet1')]})
+            self.assertEqual([p.name for p in topology.match_node(node)],
+                             [p.name for p in self.topology.match_node(node)])
+
+    def test_round_trip_invalid(self):
+        self.topology.patterns['globals'][0].variables[1] = 'value'
+        self.assertRaises(TopologyError,
+                          ztpserver.topology.dump_compiled, self.topology)
+
+    def test_load_invalid(self):
+        data = json.loads(ztpserver.topology.dump_compiled(self.topology))
+        data['patterns'][0]['interfaces'][0][1][0][3] = ['eval', 'value']
+        for contents in [json.dumps(data), '["patterns"]', 'cos\nsystem']:
+            self.assertRaises(TopologyError,
+                              ztpserver.topology.load_compiled, contents)
+
 class TestInterfacePattern(unittest.TestCase):
 
     def test_create_interface_pattern(self):
@@ -442,6 +690,18 @@ class TestInterfacePattern(unittest.TestCase):
         self.compile_known_function(interface,
                                     ztpserver.topology.ExactFunction)
 
+    def test_compile_shared_functions(self):
+        device = random_string()
+        first = ztpserver.topology.InterfacePattern('Ethernet1', device, 'any')
+        second = ztpserver.topology.InterfacePattern('Ethernet2', device, 'any')
+        self.assertIs(first.device_re, second.device_re)
+        self.assertIs(first.port_re, second.port_re)
+
+    def test_compile_invalid_regex(self):
+        self.assertRaises(ztpserver.topology.InterfacePatternError,
+                          ztpserver.topology.InterfacePattern,
+                          random_string(), 'regex(\'[\')', random_string())
+
     def test_compile_unknown_function(self):
         interface = '%s(\'%s\')' % (random_string(), random_string())
         device = random_string()
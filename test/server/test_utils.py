@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+import collections
+import unittest
+
+from ztpserver.utils import expand_range, parse_range, maximum_matching
+
+
+class ExpandRangeUnitTests(unittest.TestCase):
+
+    def test_expand_range(self):
+        self.assertEqual(expand_range('Ethernet1-3,5'),
+                         ['Ethernet1', 'Ethernet2', 'Ethernet3', 'Ethernet5'])
+
+    def test_expand_range_invalid_prefix(self):
+        self.assertRaises(TypeError, expand_range, '1-3')
+
+    def test_expand_range_subinterfaces(self):
+        self.assertEqual(expand_range('Ethernet1-2,49/1-2'),
+                         ['Ethernet1', 'Ethernet2',
+                          'Ethernet49/1', 'Ethernet49/2'])
+
+
+class ParseRangeUnitTests(unittest.TestCase):
+
+    def test_parse_range_contains(self):
+        ranges = parse_range('Ethernet1-48,49/1-4')
+        self.assertEqual(len(ranges), 52)
+        self.assertTrue('Ethernet1' in ranges)
+        self.assertTrue('Ethernet48' in ranges)
+        self.assertTrue('Ethernet49/4' in ranges)
+        self.assertFalse('Ethernet49' in ranges)
+        self.assertFalse('Ethernet49/5' in ranges)
+        self.assertFalse('Ethernet01' in ranges)
+        self.assertFalse('Management1' in ranges)
+
+    def test_parse_range_merges_overlaps(self):
+        ranges = parse_range('Ethernet1-10,5-12,14')
+        self.assertEqual(len(ranges), 13)
+        self.assertFalse('Ethernet13' in ranges)
+
+    def test_parse_range_invalid(self):
+        self.assertRaises(TypeError, parse_range, 'Ethernet5-1')
+        self.assertRaises(TypeError, parse_range, 'Ethernet1-a')
+
+
+class MaximumMatchingUnitTests(unittest.TestCase):
+
+    def test_maximum_matching_augmenting_path(self):
+        graph = collections.OrderedDict()
+        graph['a'] = [1, 2]
+        graph['b'] = [1]
+        graph['c'] = [2, 3]
+        result = maximum_matching(graph)
+        self.assertEqual(result, {'a': 2, 'b': 1, 'c': 3})
+
+    def test_maximum_matching_partial(self):
+        graph = collections.OrderedDict()
+        graph['a'] = [1]
+        graph['b'] = [1]
+        graph['c'] = list()
+        result = maximum_matching(graph)
+        self.assertEqual(result, {'a': 1})
+
+    def test_maximum_matching_empty(self):
+        self.assertEqual(maximum_matching(dict()), dict())
+
+    def test_maximum_matching_large(self):
+        graph = collections.OrderedDict()
+        for index in range(128):
+            graph[index] = range(index, 128)
+        result = maximum_matching(graph)
+        self.assertEqual(len(result), 128)
+        self.assertEqual(len(set(result.values())), 128)
+
+
+if __name__ == '__main__':
+    unittest.main()
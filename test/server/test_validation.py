@@ -37,10 +37,43 @@ import yaml
 
 #pylint: disable=F0401
 from ztpserver.app import enable_handler_console
+from ztpserver.validators import TopologyValidator
 from neighbordb_test_lib import NodeTest, NeighbordbTest
 
 TEST_DIR = 'test/neighbordb'
 
+class TopologyValidatorUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        harness = yaml.load(open(os.path.join(TEST_DIR,
+                                              'bogus_patterns_test.yml')))
+        self.contents = harness['neighbordb']
+
+    def validate(self, jobs):
+        validator = TopologyValidator(jobs=jobs)
+        result = validator.validate(self.contents)
+        return (result, validator)
+
+    def test_validate_jobs(self):
+        (result, validator) = self.validate(1)
+        (pool_result, pool_validator) = self.validate(3)
+
+        self.assertFalse(result)
+        self.assertEqual(pool_result, result)
+        self.assertTrue(validator.failed_patterns)
+        self.assertEqual(pool_validator.valid_patterns,
+                         validator.valid_patterns)
+        self.assertEqual(pool_validator.failed_patterns,
+                         validator.failed_patterns)
+
+    def test_validate_timings(self):
+        (_, validator) = self.validate(1)
+
+        self.assertEqual(set(validator.timings),
+                         validator.valid_patterns | validator.failed_patterns)
+        for elapsed in validator.timings.values():
+            self.assertGreaterEqual(elapsed, 0)
+
 if __name__ == '__main__':
     #enable_handler_console()
     unittest.main()
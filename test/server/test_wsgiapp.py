@@ -38,7 +38,15 @@ import routes
 
 import webob
 
-from ztpserver.wsgiapp import WSGIController, WSGIRouter
+from mock import patch
+
+import ztpserver.metrics
+
+from ztpserver.metrics import Registry
+from ztpserver.wsgiapp import WSGIController, WSGIRouter, TimingMiddleware
+from ztpserver.wsgiapp import StaticFileApp, FileWrapper
+
+from server_test_lib import write_file, remove_all
 
 class TestWsgiApp(unittest.TestCase):
 
@@ -108,6 +116,109 @@ class TestWsgiApp(unittest.TestCase):
     def test_delete_url_missing(self):
         self.delete_url('/missing', 404)
 
+    def test_controller_reused(self):
+        self.get_url('/tests', 204)
+        self.post_url('/tests', 204)
+        self.assertEqual(len(self.router.controllers), 1)
+
+        controller = self.router.controllers[WSGIController]
+        self.assertIs(self.router.controller(WSGIController), controller)
+
+    def test_controller_actions(self):
+        controller = self.router.controller(WSGIController)
+        self.assertEqual(controller.actions['index'], controller.index)
+        self.assertEqual(controller.actions['create'], controller.create)
+
+class TestTimingMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = ztpserver.metrics.timings
+        ztpserver.metrics.timings = Registry()
+
+        mapper = routes.Mapper()
+        mapper.collection('tests', 'test', controller=WSGIController)
+        self.router = WSGIRouter(mapper)
+
+    def tearDown(self):
+        ztpserver.metrics.timings = self.timings
+
+    def test_route_timings(self):
+        webob.Request.blank('/tests').get_response(self.router)
+        webob.Request.blank('/missing').get_response(self.router)
+
+        observed = ztpserver.metrics.timings.snapshot()['route']
+        self.assertEqual(observed['WSGIController.index']['count'], 1)
+        self.assertEqual(observed['unmatched']['count'], 1)
+
+    @patch('ztpserver.wsgiapp.log')
+    def test_slow_request(self, m_log):
+        def app(environ, start_response):
+            ztpserver.metrics.observe('fsm', 'post_node', 0.002)
+            start_response('201 Created', [])
+            return []
+
+        middleware = TimingMiddleware(app, threshold=1)
+        with patch('time.time', side_effect=[0.0, 0.005]):
+            webob.Request.blank('/nodes', method='POST').get_response(
+                middleware)
+
+        self.assertEqual(m_log.warning.call_count, 1)
+        line = m_log.warning.call_args[0][0] % m_log.warning.call_args[0][1:]
+        self.assertEqual(line, 'slow request: method=POST path=/nodes '
+                         'route=unmatched status=201 elapsed=5.0ms '
+                         'fsm.post_node=2.0ms')
+
+    @patch('ztpserver.wsgiapp.log')
+    def test_fast_request(self, m_log):
+        middleware = TimingMiddleware(self.router.router.app, threshold=1000)
+        webob.Request.blank('/tests').get_response(middleware)
+        self.assertFalse(m_log.warning.called)
+
+class TestStaticFileApp(unittest.TestCase):
+
+    def setUp(self):
+        self.contents = ''.join(chr(i % 256) for i in range(100000))
+        self.filename = write_file(self.contents, 'image.swi', mode='wb')
+        self.app = StaticFileApp(self.filename)
+
+    def tearDown(self):
+        remove_all()
+
+    def request(self, **kwargs):
+        return webob.Request.blank('/', **kwargs).get_response(self.app)
+
+    def test_get_file(self):
+        resp = self.request()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_length, len(self.contents))
+        self.assertEqual(resp.accept_ranges, 'bytes')
+        self.assertIsNotNone(resp.etag)
+        self.assertIsNotNone(resp.last_modified)
+        self.assertEqual(resp.body, self.contents)
+
+    def test_get_file_file_wrapper(self):
+        resp = self.request(environ={'wsgi.file_wrapper': FileWrapper})
+        self.assertIsInstance(resp.app_iter, FileWrapper)
+        self.assertEqual(resp.body, self.contents)
+
+    def test_get_file_range(self):
+        resp = self.request(range=(70000, 90000))
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.content_length, 20000)
+        self.assertEqual(resp.content_range.start, 70000)
+        self.assertEqual(resp.body, self.contents[70000:90000])
+
+    def test_get_file_not_modified(self):
+        etag = self.request().etag
+        resp = self.request(if_none_match='"%s"' % etag)
+        self.assertEqual(resp.status_code, 304)
+
+    def test_get_file_missing(self):
+        app = StaticFileApp(self.filename + '.missing')
+        resp = webob.Request.blank('/').get_response(app)
+        self.assertEqual(resp.status_code, 404)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -34,25 +34,32 @@
 #
 import os
 import sys
+import json
+import time
 import argparse
 
 import logging
 
-from wsgiref.simple_server import make_server
-
 import ztpserver.config
 import ztpserver.controller
 import ztpserver.neighbordb
+import ztpserver.profiler
+import ztpserver.server
 
 from ztpserver.serializers import load
 from ztpserver.validators import TopologyValidator
 from ztpserver.constants import CONTENT_TYPE_YAML
-from ztpserver.neighbordb import default_filename
+from ztpserver.neighbordb import default_filename, compile_topology
+from ztpserver.neighbordb import artifact_filename, get_topology
+from ztpserver.neighbordb import load_inventory, match_inventory
 
 from ztpserver import __version__ as VERSION
 
 DEFAULT_CONF = '/etc/ztpserver/ztpserver.conf'
 
+# number of patterns listed by --validate as the slowest to validate
+SLOWEST_PATTERNS = 10
+
 log = logging.getLogger("ztpserver")
 log.setLevel(logging.DEBUG)
 log.addHandler(logging.NullHandler())
@@ -118,7 +125,10 @@ def start_wsgiapp(conf=None):
     if not python_supported():
         raise SystemExit('ERROR: ZTPServer requires Python 2.7')
 
-    return ztpserver.controller.Router()
+    router = ztpserver.controller.Router()
+    router.controller(ztpserver.controller.BootstrapController).prime()
+    ztpserver.profiler.profiler.configure()
+    return router
 
 def run_server(conf):
     """ The :py:func:`run_server` is called by the main command line routine to
@@ -134,23 +144,31 @@ def run_server(conf):
 
     host = ztpserver.config.runtime.server.interface
     port = ztpserver.config.runtime.server.port
+    mode = ztpserver.config.runtime.server.mode
 
-    httpd = make_server(host, port, app)
-
-    print "Starting server on http://%s:%s" % (host, port)
+    print "Starting server on http://%s:%s (mode: %s)" % (host, port, mode)
 
     try:
-        httpd.serve_forever()
+        ztpserver.server.serve(app, host, port)
     except KeyboardInterrupt:
-        print 'Shutdown'
+        pass
+    print 'Shutdown'
 
-def run_validator(filename=None):
+def run_validator(filename=None, jobs=1):
 
     try:
         print 'Validating file \'%s\'\n' % filename
-        validator = TopologyValidator()
+        validator = TopologyValidator(jobs=jobs)
         filename = filename or default_filename()
-        validator.validate(load(filename, CONTENT_TYPE_YAML))
+
+        start = time.time()
+        contents = load(filename, CONTENT_TYPE_YAML)
+        load_time = time.time() - start
+
+        start = time.time()
+        validator.validate(contents)
+        validate_time = time.time() - start
+
         print 'Valid Patterns (count: %d)' % len(validator.valid_patterns)
         print '--------------------------'
         for index, pattern in enumerate(sorted(validator.valid_patterns)):
@@ -161,12 +179,57 @@ def run_validator(filename=None):
         for index, pattern in enumerate(sorted(validator.failed_patterns)):
             print '[%d] %s' % (index, pattern[1])
         print
+        print 'Timing (jobs: %d)' % jobs
+        print '----------------'
+        print 'load: %.3fs' % load_time
+        print 'validate: %.3fs' % validate_time
+        print
+        slowest = sorted(validator.timings.items(), key=lambda x: x[1],
+                         reverse=True)[:SLOWEST_PATTERNS]
+        print 'Slowest Patterns (count: %d)' % len(slowest)
+        print '----------------------------'
+        for index, (pattern, elapsed) in enumerate(slowest):
+            print '[%d] %s (%.3fms)' % (index, pattern[1], elapsed * 1000)
+        print
 
     except Exception as exc:        #pylint: disable=W0703
         log.exception(exc)
         print 'An unexpected error occurred trying to run the validator'
 
+def run_compiler(filename=None):
+
+    try:
+        filename = filename or default_filename()
+        print 'Compiling file \'%s\'\n' % filename
+        topology = compile_topology(filename)
+        if topology is None:
+            print 'Unable to compile neighbordb (run --validate for details)'
+            return 1
+        print 'Compiled %r' % topology
+        print 'Wrote \'%s\'' % artifact_filename(filename)
+
+    except Exception as exc:        #pylint: disable=W0703
+        log.exception(exc)
+        print 'An unexpected error occurred trying to compile neighbordb'
+        return 1
 
+def run_inventory(filename, jobs=1):
+
+    try:
+        nodes = load_inventory(open(filename).read())
+        topology = get_topology()
+        if topology is None:
+            sys.stderr.write('Unable to load neighbordb\n')
+            return 1
+
+        for result in match_inventory(nodes, topology, jobs):
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+
+    except Exception as exc:        #pylint: disable=W0703
+        log.exception(exc)
+        sys.stderr.write('An unexpected error occurred trying to match '
+                         'the inventory\n')
+        return 1
 
 def main():
     """ The :py:func:`main` is the main entry point for the ztpserver if called
@@ -193,6 +256,26 @@ def main():
                         metavar='FILENAME',
                         help='Runs a validation check on neighbordb')
 
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Number of processes used by --validate '
+                             'and --match-inventory')
+
+    parser.add_argument('--compile',
+                        type=str,
+                        nargs='?',
+                        const='',
+                        metavar='FILENAME',
+                        help='Writes the compiled topology for neighbordb')
+
+    parser.add_argument('--match-inventory',
+                        type=str,
+                        metavar='FILENAME',
+                        help='Matches a list of nodes against neighbordb '
+                             'and prints the results as JSON lines')
+
     parser.add_argument('--debug',
                         action='store_true',
                         help='Enables debug output to the STDOUT')
@@ -207,7 +290,19 @@ def main():
         load_config(args.conf)
         if args.debug:
             start_logging()
-        sys.exit(run_validator(args.validate))
+        sys.exit(run_validator(args.validate, max(1, args.jobs)))
+
+    if args.match_inventory is not None:
+        load_config(args.conf)
+        if args.debug:
+            start_logging()
+        sys.exit(run_inventory(args.match_inventory, max(1, args.jobs)))
+
+    if args.compile is not None:
+        load_config(args.conf)
+        if args.debug:
+            start_logging()
+        sys.exit(run_compiler(args.compile))
 
     return run_server(args.conf)
 
@@ -296,6 +296,20 @@ runtime.add_attribute(BoolAttr(
     default=False
 ))
 
+runtime.add_attribute(IntAttr(
+    name='repository_cache_size',
+    minvalue=0,
+    default=0,
+    environ='ZTPS_REPOSITORY_CACHE_SIZE'
+))
+
+runtime.add_attribute(IntAttr(
+    name='slow_request_threshold',
+    minvalue=0,
+    default=1000,
+    environ='ZTPS_SLOW_REQUEST_THRESHOLD'
+))
+
 # Group: server
 runtime.add_attribute(StrAttr(
     name='interface',
@@ -311,6 +325,37 @@ runtime.add_attribute(IntAttr(
     default=8080
 ))
 
+runtime.add_attribute(StrAttr(
+    name='mode',
+    group='server',
+    choices=['single', 'threads', 'prefork'],
+    default='single',
+    environ='ZTPS_SERVER_MODE'
+))
+
+runtime.add_attribute(IntAttr(
+    name='threads',
+    group='server',
+    minvalue=1,
+    maxvalue=256,
+    default=16
+))
+
+runtime.add_attribute(IntAttr(
+    name='workers',
+    group='server',
+    minvalue=1,
+    maxvalue=64,
+    default=4
+))
+
+runtime.add_attribute(IntAttr(
+    name='shutdown_timeout',
+    group='server',
+    minvalue=0,
+    default=30
+))
+
 
 # Group: files
 runtime.add_attribute(StrAttr(
@@ -369,4 +414,47 @@ runtime.add_attribute(StrAttr(
     environ='ZTPS_NEIGHBORDB_FILENAME'
 ))
 
+runtime.add_attribute(BoolAttr(
+    name='compile',
+    group='neighbordb',
+    default=True,
+    environ='ZTPS_NEIGHBORDB_COMPILE'
+))
+
+runtime.add_attribute(IntAttr(
+    name='inventory_jobs',
+    group='neighbordb',
+    default=1,
+    environ='ZTPS_NEIGHBORDB_INVENTORY_JOBS'
+))
+
+# Group: profiling
+runtime.add_attribute(IntAttr(
+    name='interval',
+    group='profiling',
+    minvalue=0,
+    default=0,
+    environ='ZTPS_PROFILING_INTERVAL'
+))
+
+runtime.add_attribute(IntAttr(
+    name='window',
+    group='profiling',
+    minvalue=1,
+    default=100
+))
+
+runtime.add_attribute(IntAttr(
+    name='files',
+    group='profiling',
+    minvalue=1,
+    default=5
+))
+
+runtime.add_attribute(ListAttr(
+    name='clients',
+    group='profiling',
+    default='127.0.0.1,::1'
+))
+
 
@@ -36,11 +36,14 @@ CONTENT_TYPE_HTML = 'text/html'
 CONTENT_TYPE_OTHER = 'text/plain'
 CONTENT_TYPE_JSON = 'application/json'
 CONTENT_TYPE_YAML = 'application/yaml'
+CONTENT_TYPE_JSON_LINES = 'application/x-ndjson'
+CONTENT_TYPE_PROMETHEUS = 'text/plain; version=0.0.4'
 
 HTTP_STATUS_OK = 200
 HTTP_STATUS_CREATED = 201
 HTTP_STATUS_NO_CONTENT = 204
 HTTP_STATUS_BAD_REQUEST = 400
+HTTP_STATUS_FORBIDDEN = 403
 HTTP_STATUS_NOT_FOUND = 404
 HTTP_STATUS_CONFLICT = 409
 HTTP_STATUS_INTERNAL_SERVER_ERROR = 500
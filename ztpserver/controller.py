@@ -33,28 +33,46 @@
 #
 
 import os
+import gzip
+import collections
+import json
+import hashlib
 import logging
+import threading
+import time
 import urlparse
 
+from StringIO import StringIO
+
 from string import Template
 
 import routes
 
-from webob.static import FileApp
+from webob import Response
 
 import ztpserver.config
+import ztpserver.metrics
 import ztpserver.neighbordb
+import ztpserver.profiler
 
-from ztpserver.wsgiapp import WSGIController, WSGIRouter
+from ztpserver.wsgiapp import WSGIController, WSGIRouter, StaticFileApp
+from ztpserver.serializers import dumps
 
 from ztpserver.neighbordb import create_node, Node
 
 from ztpserver.repository import create_repository
+from ztpserver.resources import ResourcePool, pool_usage
 from ztpserver.repository import FileObjectNotFound, FileObjectError
-from ztpserver.constants import HTTP_STATUS_NOT_FOUND, HTTP_STATUS_CREATED
+from ztpserver.constants import HTTP_STATUS_OK, HTTP_STATUS_NOT_FOUND
+from ztpserver.constants import HTTP_STATUS_CREATED
 from ztpserver.constants import HTTP_STATUS_BAD_REQUEST, HTTP_STATUS_CONFLICT
+from ztpserver.constants import HTTP_STATUS_FORBIDDEN
+from ztpserver.constants import HTTP_STATUS_INTERNAL_SERVER_ERROR
 from ztpserver.constants import CONTENT_TYPE_JSON, CONTENT_TYPE_PYTHON
 from ztpserver.constants import CONTENT_TYPE_YAML, CONTENT_TYPE_OTHER
+from ztpserver.constants import CONTENT_TYPE_JSON_LINES
+from ztpserver.constants import CONTENT_TYPE_PROMETHEUS
+from ztpserver.profiler import ProfilerError
 
 DEFINITION_FN = 'definition'
 STARTUP_CONFIG_FN = 'startup-config'
@@ -63,15 +81,154 @@ NODE_FN = '.node'
 ATTRIBUTES_FN = 'attributes'
 BOOTSTRAP_CONF = 'bootstrap.conf'
 
+# node files the rendered definition returned by GET /nodes/{resource}
+# is derived from
+NODE_INPUTS = [NODE_FN, DEFINITION_FN, PATTERN_FN, ATTRIBUTES_FN,
+               STARTUP_CONFIG_FN]
+
 log = logging.getLogger(__name__)    # pylint: disable=C0103
 
+
+class DefinitionCache(object):
+    ''' Process wide cache of the rendered definitions returned by
+    GET /nodes/{resource}.
+
+    Each entry stores the serialized body along with the identity of every
+    node file it was rendered from, the resources allocated to the node in
+    the pools referenced by the definition and the configuration values
+    used while rendering it.  An entry is only returned if that identity is
+    unchanged.  At most maxsize entries are kept, the least recently used
+    entry being evicted first.
+    '''
+
+    def __init__(self, maxsize=4096):
+        self.entries = collections.OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'DefinitionCache(entries=%d, hits=%d, misses=%d)' % \
+               (len(self.entries), self.hits, self.misses)
+
+    def stats(self):
+        ''' Returns a dict of the current cache statistics '''
+
+        return dict(entries=len(self.entries), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses)
+
+    def get(self, resource, identity):
+        ''' Returns the cached (body, etag) for resource or None.  The
+        identity argument is called with resource, the list of files and
+        the list of pools the entry was rendered from and must return the
+        current identity of those inputs.
+        '''
+
+        with self.lock:
+            entry = self.entries.pop(resource, None)
+            if entry is not None:
+                self.entries[resource] = entry
+        if entry is not None:
+            (filepaths, pools, _identity, body, etag) = entry
+            if identity(resource, filepaths, pools) == _identity:
+                self.hits += 1
+                return (body, etag)
+            log.debug('Cached definition for %s is out of date', resource)
+            self.invalidate(resource)
+        self.misses += 1
+
+    def put(self, resource, filepaths, pools, identity, body):
+        ''' Stores the serialized body for resource and returns its etag '''
+
+        etag = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            self.entries.pop(resource, None)
+            self.entries[resource] = (filepaths, pools, identity, body, etag)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, resource=None):
+        ''' Removes the entry for resource or all entries if resource
+        is None
+        '''
+
+        with self.lock:
+            if resource is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(resource, None)
+
+definition_cache = DefinitionCache()    # pylint: disable=C0103
+
+
+class BootstrapCache(object):
+    ''' Process wide cache of the rendered bootstrap script returned by
+    GET /bootstrap.
+
+    The entry holds the rendered script, a gzip compressed copy of it and
+    a strong etag.  It is keyed on the identity of the bootstrap file and
+    the server_url substituted into it and is rebuilt as soon as either
+    of them changes.
+    '''
+
+    def __init__(self):
+        self.entry = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'BootstrapCache(hits=%d, misses=%d)' % (self.hits, self.misses)
+
+    def stats(self):
+        ''' Returns a dict of the current cache statistics '''
+
+        return dict(entries=int(self.entry is not None), hits=self.hits,
+                    misses=self.misses)
+
+    def get(self, identity):
+        ''' Returns the cached (body, compressed, etag) for identity
+        or None
+        '''
+
+        with self.lock:
+            entry = self.entry
+        if entry is not None and entry[0] == identity:
+            self.hits += 1
+            return entry[1:]
+        self.misses += 1
+
+    def put(self, identity, body):
+        ''' Stores the rendered body and returns (body, compressed, etag) '''
+
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fobj:
+            fobj.write(body)
+        entry = (body, buf.getvalue(), hashlib.sha1(body).hexdigest())
+        with self.lock:
+            self.entry = (identity,) + entry
+        return entry
+
+    def invalidate(self):
+        ''' Removes the cached entry '''
+
+        with self.lock:
+            self.entry = None
+
+bootstrap_cache = BootstrapCache()      # pylint: disable=C0103
+
+
 class BaseController(WSGIController):
 
     FOLDER = None
 
-    def __init__(self, **kwargs):
-        data_root = ztpserver.config.runtime.default.data_root
-        self.repository = create_repository(data_root)
+    def __init__(self, repository=None, **kwargs):
+        if repository is None:
+            data_root = ztpserver.config.runtime.default.data_root
+            repository = create_repository(data_root)
+        self.repository = repository
         super(BaseController, self).__init__()
 
     def expand(self, *args, **kwargs):
@@ -114,7 +271,7 @@ class FilesController(BaseController):
             log.debug('Requesting file: %s', resource)
             filepath = self.expand(resource)
             filename = self.repository.get_file(filepath).name
-            return FileApp(filename)
+            return StaticFileApp(filename)
         except FileObjectNotFound:
             log.error('Requested file %s was not found', resource)
             return self.http_not_found()
@@ -154,9 +311,21 @@ class NodesController(BaseController):
             log.exception('Unable to create node metadata')
             response = self.http_bad_request()
             return self.response(**response)
-        return self.fsm('required_attributes', request=request, node=node)
+        response = self.fsm('required_attributes', request=request, node=node)
+        if node is not None:
+            definition_cache.invalidate(node.systemmac)
+        return response
 
     def show(self, request, resource, *args, **kwargs):
+        cached = definition_cache.get(resource, self.identity)
+        if cached is not None:
+            log.debug('Returning cached definition for %s', resource)
+            (body, etag) = cached
+            return self.definition_response(body, etag)
+
+        filepaths = [self.expand(resource, fn) for fn in NODE_INPUTS]
+        identity = self.identity(resource, filepaths)
+
         try:
             fobj = self.repository.get_file(self.expand(resource, NODE_FN))
             node = fobj.read(CONTENT_TYPE_JSON, Node)
@@ -165,13 +334,94 @@ class NodesController(BaseController):
             log.exception('Unable to load node metadata')
             response = self.http_bad_request()
             return self.response(**response)
-        return self.fsm(state, resource=resource, node=node)
+
+        pools = list()
+        response = self.fsm(state, resource=resource, node=node, pools=pools)
+        if response.get('status') != HTTP_STATUS_OK or 'body' not in response:
+            return response
+
+        # rendering may have allocated resources to the node, so the
+        # allocations are looked up after the definition has been rendered.
+        # The node files must not have changed while rendering.
+        body = dumps(response['body'], response['content_type'])
+        pools = sorted(set(pools))
+        _identity = self.identity(resource, filepaths, pools)
+        if _identity[:len(identity)] != identity:
+            log.debug('Node files changed while rendering %s', resource)
+            return self.definition_response(body)
+
+        etag = definition_cache.put(resource, filepaths, pools, _identity,
+                                    body)
+        return self.definition_response(body, etag)
+
+    def identity(self, resource, filepaths, pools=()):
+        ''' Returns the identity of the files, resource allocations and
+        configuration values a rendered definition depends on.
+
+        Pools are identified by the resource allocated to the node rather
+        than by the pool file, which changes with every allocation made for
+        any other node.
+        '''
+
+        config = ztpserver.config.runtime.default
+        identity = [config.server_url, config.disable_topology_validation]
+        identity.extend(self.repository.stat(fn) for fn in filepaths)
+        identity.extend(self.allocation(resource, pool) for pool in pools)
+        return tuple(identity)
+
+    def allocation(self, resource, pool):
+        ''' Returns a (pool, resource) tuple for the resource allocated to
+        the node in pool.  The resource is None if nothing is allocated.
+        '''
+
+        try:
+            return (pool, ResourcePool().store(pool).lookup(resource))
+        except Exception:       # pylint: disable=W0703
+            log.warning('Unable to look up allocation in pool %s', pool)
+            return (pool, None)
+
+    def definition_response(self, body, etag=None):
+        ''' Returns the response for a rendered definition.  Requests with
+        a matching If-None-Match header receive 304 Not Modified.
+        '''
+
+        return Response(body=body, content_type=CONTENT_TYPE_JSON,
+                        status=HTTP_STATUS_OK, etag=etag,
+                        conditional_response=True)
+
+    def match(self, request, **kwargs):
+        ''' Handles POST /nodes/match
+
+        The body is a list of node descriptions (or a node description per
+        line) which are matched against neighbordb.  The results are
+        streamed back as JSON lines.
+        '''
+
+        try:
+            nodes = ztpserver.neighbordb.load_inventory(request.body)
+        except Exception:           # pylint: disable=W0703
+            log.exception('Unable to load inventory')
+            return self.http_bad_request()
+
+        topology = ztpserver.neighbordb.get_topology()
+        if topology is None:
+            log.error('Unable to match inventory, neighbordb not loaded')
+            return self.http_bad_request()
+
+        jobs = ztpserver.config.runtime.neighbordb.inventory_jobs
+        results = ztpserver.neighbordb.match_inventory(nodes, topology, jobs)
+        app_iter = ('%s\n' % json.dumps(result) for result in results)
+        return Response(app_iter=app_iter, status=HTTP_STATUS_OK,
+                        content_type=CONTENT_TYPE_JSON_LINES)
 
     def get_config(self, request, resource, **kwargs):
         return self.fsm('get_startup_config_file', resource=resource)
 
     def put_config(self, request, resource, *args, **kwargs):
-        return self.fsm('do_put_config', request=request, resource=resource)
+        response = self.fsm('do_put_config', request=request,
+                            resource=resource)
+        definition_cache.invalidate(resource)
+        return response
 
     def fsm(self, next_state, **kwargs):
         ''' Execute the FSM for the request '''
@@ -181,8 +431,14 @@ class NodesController(BaseController):
         try:
             while next_state != None:
                 log.debug('FSM next_state=%s', next_state)
-                method = getattr(self, next_state)
-                (response, next_state) = method(response, **kwargs)
+                state = next_state
+                method = getattr(self, state)
+                start = time.time()
+                try:
+                    (response, next_state) = method(response, **kwargs)
+                finally:
+                    ztpserver.metrics.observe('fsm', state,
+                                              time.time() - start)
             log.debug('FSM completed successfully')
         except Exception:            # pylint: disable=W0703
             log.exception('Unexpected error in FSM')
@@ -278,7 +534,7 @@ class NodesController(BaseController):
     def post_node(self, response, *args, **kwargs):
         try:
             node = kwargs['node']
-            topology = ztpserver.neighbordb.load_topology()
+            topology = ztpserver.neighbordb.get_topology()
             # pylint: disable=E1103
             matches = topology.match_node(node)
             log.info('Node matched %d pattern(s)', len(matches))
@@ -455,11 +711,22 @@ class NodesController(BaseController):
         try:
             definition = response['definition']
             node = kwargs.get('node')
+            pools = kwargs.get('pools')
+
+            # allocate every resource in the definition up front so each
+            # pool is only updated once
+            attributes = [action.get('attributes', dict())
+                          for action in definition.get('actions')]
+            allocations = \
+                ztpserver.neighbordb.allocate_resources(attributes, node)
+
             _actions = list()
             for action in definition.get('actions'):
                 attrs = action.get('attributes', dict())
+                if pools is not None:
+                    pools.extend(ztpserver.neighbordb.resource_pools(attrs))
                 action['attributes'] = \
-                    ztpserver.neighbordb.resources(attrs, node)
+                    ztpserver.neighbordb.resources(attrs, node, allocations)
                 _actions.append(action)
             definition['actions'] = _actions
             response['definition'] = definition
@@ -511,18 +778,181 @@ class BootstrapController(BaseController):
         ''' Handles GET /bootstrap '''
 
         try:
-            filename = self.expand(ztpserver.config.runtime.bootstrap.filename)
-            fobj = self.repository.get_file(filename).read(CONTENT_TYPE_PYTHON)
-            default_server = ztpserver.config.runtime.default.server_url
-            body = Template(fobj).substitute(SERVER=default_server)
-            resp = dict(body=body, content_type=CONTENT_TYPE_PYTHON)
+            entry = self.render()
         except KeyError:
             log.debug('Expected variable was not provided')
-            resp = self.http_bad_request()
+            return self.http_bad_request()
         except (FileObjectNotFound, FileObjectError):
             log.exception('Unable to retrieve bootstrap script')
-            resp = self.http_bad_request()
-        return resp
+            return self.http_bad_request()
+        return self.bootstrap_response(request, *entry)
+
+    def render(self):
+        ''' Returns the rendered bootstrap script as (body, compressed,
+        etag).  The script is only rendered again if the bootstrap file
+        or the server_url has changed since it was last rendered.
+
+        :raises: KeyError, FileObjectNotFound, FileObjectError
+        '''
+
+        filename = self.expand(ztpserver.config.runtime.bootstrap.filename)
+        default_server = ztpserver.config.runtime.default.server_url
+
+        identity = (default_server, self.repository.stat(filename))
+        entry = bootstrap_cache.get(identity)
+        if entry is not None:
+            return entry
+
+        fobj = self.repository.get_file(filename).read(CONTENT_TYPE_PYTHON)
+        body = Template(fobj).substitute(SERVER=default_server)
+        if identity[1] is None:
+            return (body, None, None)
+
+        log.debug('Rendered bootstrap script %s', filename)
+        return bootstrap_cache.put(identity, body)
+
+    def prime(self):
+        ''' Renders the bootstrap script ahead of the first request.
+        Returns True if the script was rendered.
+        '''
+
+        try:
+            self.render()
+            return True
+        except Exception:           # pylint: disable=W0703
+            log.warning('Unable to render bootstrap script at startup')
+            return False
+
+    @classmethod
+    def bootstrap_response(cls, request, body, compressed=None, etag=None):
+        ''' Returns the response for the rendered bootstrap script.  The
+        gzip variant is returned to clients that accept it and requests
+        with a matching If-None-Match header receive 304 Not Modified.
+        '''
+
+        if compressed is None:
+            return Response(body=body, content_type=CONTENT_TYPE_PYTHON,
+                            status=HTTP_STATUS_OK)
+
+        response = Response(content_type=CONTENT_TYPE_PYTHON,
+                            status=HTTP_STATUS_OK, conditional_response=True)
+        response.vary = ('Accept-Encoding',)
+        if cls.accepts_gzip(request):
+            response.body = compressed
+            response.content_encoding = 'gzip'
+            response.etag = '%s-gzip' % etag
+        else:
+            response.body = body
+            response.etag = etag
+        return response
+
+    @staticmethod
+    def accepts_gzip(request):
+        ''' Returns True if the client sent an Accept-Encoding header
+        that allows gzip
+        '''
+
+        if request is None or 'Accept-Encoding' not in request.headers:
+            return False
+        return request.accept_encoding.best_match(['gzip']) == 'gzip'
+
+
+class MetricsController(BaseController):
+
+    FOLDER = 'resources'
+
+    def __repr__(self):
+        return 'MetricsController(folder=%s)' % self.FOLDER
+
+    def index(self, request, **kwargs):
+        ''' Handles GET /metrics '''
+
+        gauges = list()
+        for pool, free in pool_usage(self.repository.expand(self.FOLDER)):
+            gauges.append(('ztps_resource_pool_free',
+                           'Free resources in each resource pool',
+                           [('pool', pool)], free))
+
+        body = ztpserver.metrics.render(ztpserver.metrics.collect(), gauges)
+        body = body.encode('utf-8')
+        return Response(body=body, content_type=CONTENT_TYPE_PROMETHEUS,
+                        charset=None)
+
+
+class ProfileController(BaseController):
+    ''' Starts, stops and downloads the profile of this process.  Only
+    the clients listed in [profiling] clients are allowed '''
+
+    FOLDER = 'profiles'
+
+    def __repr__(self):
+        return 'ProfileController(folder=%s)' % self.FOLDER
+
+    @staticmethod
+    def allowed(request):
+        clients = ztpserver.config.runtime.profiling.clients or list()
+        return request.remote_addr in [c.strip() for c in clients]
+
+    def http_forbidden(self, request):
+        log.warning('Profiling request from %s rejected',
+                    request.remote_addr)
+        return dict(body='', content_type='text/html',
+                    status=HTTP_STATUS_FORBIDDEN)
+
+    def index(self, request, **kwargs):
+        ''' Handles GET /admin/profile '''
+
+        if not self.allowed(request):
+            return self.http_forbidden(request)
+        return dict(body=ztpserver.profiler.profiler.status(),
+                    content_type=CONTENT_TYPE_JSON)
+
+    def start(self, request, **kwargs):
+        ''' Handles POST /admin/profile/start[?interval=N] '''
+
+        if not self.allowed(request):
+            return self.http_forbidden(request)
+
+        interval = request.params.get('interval')
+        if interval is not None:
+            if not interval.isdigit() or not int(interval):
+                return self.http_bad_request()
+            interval = int(interval)
+
+        ztpserver.profiler.profiler.start(interval)
+        return dict(body=ztpserver.profiler.profiler.status(),
+                    content_type=CONTENT_TYPE_JSON)
+
+    def stop(self, request, **kwargs):
+        ''' Handles POST /admin/profile/stop '''
+
+        if not self.allowed(request):
+            return self.http_forbidden(request)
+
+        try:
+            ztpserver.profiler.profiler.stop()
+        except ProfilerError:
+            return dict(body='', content_type='text/html',
+                        status=HTTP_STATUS_INTERNAL_SERVER_ERROR)
+        return dict(body=ztpserver.profiler.profiler.status(),
+                    content_type=CONTENT_TYPE_JSON)
+
+    def download(self, request, **kwargs):
+        ''' Handles GET /admin/profile/download, returning the profile
+        written by this process in the pstats (marshal) format '''
+
+        if not self.allowed(request):
+            return self.http_forbidden(request)
+
+        try:
+            body = ztpserver.profiler.profiler.download()
+        except ProfilerError:
+            return self.http_not_found()
+
+        filename = os.path.basename(ztpserver.profiler.profiler.filename)
+        return Response(body=body, content_type='application/octet-stream',
+                        content_disposition='attachment; filename=%s' %
+                        filename)
 
 
 class Router(WSGIRouter):
@@ -531,6 +961,9 @@ class Router(WSGIRouter):
     def __init__(self):
         # pylint: disable=E1103,W0142
 
+        # shared by all controllers, created with the first controller
+        self.repository = None
+
         mapper = routes.Mapper()
 
         kwargs = {}
@@ -559,6 +992,11 @@ class Router(WSGIRouter):
                                   conditions=dict(method=['GET']))
 
             # configure /nodes
+            router_mapper.connect('match_nodes', '/nodes/match',
+                                  controller=NodesController,
+                                  action='match',
+                                  conditions=dict(method=['POST']))
+
             router_mapper.collection('nodes', 'node',
                                      controller=NodesController,
                                      collection_actions=['create'],
@@ -584,6 +1022,31 @@ class Router(WSGIRouter):
                                      member_actions=['show'],
                                      member_prefix='/{resource}')
 
+            # configure /metrics
+            router_mapper.connect('metrics', '/metrics',
+                                  controller=MetricsController,
+                                  action='index',
+                                  conditions=dict(method=['GET']))
+
+            # configure /admin/profile
+            router_mapper.connect('profile', '/admin/profile',
+                                  controller=ProfileController,
+                                  action='index',
+                                  conditions=dict(method=['GET']))
+
+            router_mapper.connect('profile_download',
+                                  '/admin/profile/download',
+                                  controller=ProfileController,
+                                  action='download',
+                                  conditions=dict(method=['GET']))
+
+            for action in ['start', 'stop']:
+                router_mapper.connect('profile_%s' % action,
+                                      '/admin/profile/%s' % action,
+                                      controller=ProfileController,
+                                      action=action,
+                                      conditions=dict(method=['POST']))
+
             # configure /files
             router_mapper.collection('files', 'file',
                                      controller=FilesController,
@@ -593,3 +1056,10 @@ class Router(WSGIRouter):
 
         super(Router, self).__init__(mapper)
 
+    def create_controller(self, cls):
+        ''' Returns a new controller sharing the router's repository '''
+
+        if self.repository is None:
+            data_root = ztpserver.config.runtime.default.data_root
+            self.repository = create_repository(data_root)
+        return cls(repository=self.repository)
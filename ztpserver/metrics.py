@@ -0,0 +1,530 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+'''
+    MODULE:
+        ztpserver.metrics
+
+    AUTHOR:
+        Arista Networks
+
+    DESCRIPTION:
+        The metrics module keeps in-process counters and timing histograms
+        for the server and renders them in the Prometheus text format.
+        Timings are grouped by kind (route, fsm, repository, topology) and
+        name, and the timings observed while handling a request are also
+        recorded against that request so a slow request can be broken
+        down in a single log line.
+
+        In prefork mode every worker serves its metrics on a unix socket
+        in a directory shared by the workers, so the worker handling a
+        scrape can report the totals of all of them.
+
+    :copyright: Copyright (c) 2014, Arista Networks
+    :license: BSD, see LICENSE for more details
+
+'''
+import os
+import json
+import errno
+import bisect
+import socket
+import logging
+import threading
+
+log = logging.getLogger(__name__)   #pylint: disable=C0103
+
+# upper bounds (in seconds) of the histogram buckets; observations
+# larger than the last bound are counted in an overflow bucket
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# Prometheus metric name, label name and help text of each histogram kind
+HISTOGRAMS = {
+    'route': ('ztps_request_duration_seconds', 'route',
+              'Time spent handling requests'),
+    'fsm': ('ztps_fsm_state_duration_seconds', 'state',
+            'Time spent in each state of the nodes FSM'),
+    'repository': ('ztps_repository_duration_seconds', 'operation',
+                   'Time spent reading files from data_root'),
+    'topology': ('ztps_topology_duration_seconds', 'operation',
+                 'Time spent matching nodes against neighbordb')
+}
+
+# help text of the counters
+COUNTERS = {
+    'ztps_requests_total': 'Requests handled',
+    'ztps_response_bytes_total': 'Response bytes (from Content-Length)',
+    'ztps_topology_lookups_total': 'Lookups of the compiled neighbordb',
+    'ztps_topology_rebuilds_total': 'Compilations of neighbordb',
+    'ztps_topology_artifact_loads_total':
+        'Compiled neighbordb topologies loaded from disk',
+}
+
+# seconds to wait for a peer worker to send its metrics
+PEER_TIMEOUT = 1.0
+
+
+class _ShardHolder(object):
+    ''' Holds a thread's metric shard and folds it back into the metric
+    when the thread goes away '''
+
+    def __init__(self, metric, shard):
+        self.metric = metric
+        self.shard = shard
+
+    def __del__(self):
+        self.metric.retire(self.shard)
+
+
+class Metric(object):
+    ''' Base class of metrics kept as a list of values per thread
+
+    Every thread updates its own shard, so updating a metric never takes a
+    lock.  The shards are only combined when the metric is read.
+    '''
+
+    width = 1
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = list()
+        self.retired = self.empty()
+        self.lock = threading.RLock()
+
+    def empty(self):
+        return [0] * self.width
+
+    def shard(self):
+        shard = self.empty()
+        with self.lock:
+            self.shards.append(shard)
+        self.local.holder = _ShardHolder(self, shard)
+        return shard
+
+    def retire(self, shard):
+        with self.lock:
+            for index, value in enumerate(shard):
+                self.retired[index] += value
+            self.shards = [s for s in self.shards if s is not shard]
+
+    def totals(self):
+        with self.lock:
+            totals = list(self.retired)
+            for shard in self.shards:
+                for index, value in enumerate(shard):
+                    totals[index] += value
+        return totals
+
+
+class Counter(Metric):
+    ''' A monotonically increasing value '''
+
+    def __repr__(self):
+        return 'Counter(value=%s)' % self.value()
+
+    def increment(self, value=1):
+        try:
+            shard = self.local.holder.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[0] += value
+
+    def value(self):
+        return self.totals()[0]
+
+
+class Histogram(Metric):
+    ''' A histogram of durations, kept as the bucket counts followed by
+    the running sum of the observations '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.width = len(self.buckets) + 2
+        super(Histogram, self).__init__()
+
+    def __repr__(self):
+        return 'Histogram(count=%d)' % self.snapshot()['count']
+
+    def empty(self):
+        return [0] * (self.width - 1) + [0.0]
+
+    def observe(self, value):
+        try:
+            shard = self.local.holder.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self):
+        ''' Returns the bucket counts (not cumulative, the last entry being
+        the overflow bucket), count and sum of the observations '''
+
+        totals = self.totals()
+        counts = totals[:-1]
+        return dict(buckets=self.buckets, counts=counts,
+                    count=sum(counts), sum=totals[-1])
+
+
+class Registry(object):
+    ''' Histograms keyed by (kind, name) and counters keyed by (name,
+    labels).  Collectors are called when the registry is exported and
+    return (name, labels, value) tuples for counters kept elsewhere in
+    the process '''
+
+    def __init__(self):
+        self.histograms = dict()
+        self.counters = dict()
+        self.collectors = list()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Registry(histograms=%d, counters=%d)' % \
+               (len(self.histograms), len(self.counters))
+
+    def histogram(self, kind, name):
+        key = (kind, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def counter(self, name, labels=()):
+        key = (name, labels)
+        counter = self.counters.get(key)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(key, Counter())
+        return counter
+
+    def snapshot(self):
+        ''' Returns {kind: {name: histogram snapshot}} '''
+
+        result = dict()
+        for (kind, name), histogram in self.histograms.items():
+            result.setdefault(kind, dict())[name] = histogram.snapshot()
+        return result
+
+    def export(self):
+        ''' Returns the histograms and counters in a form that can be
+        serialized as JSON and combined with :py:func:`merge` '''
+
+        histograms = list()
+        for (kind, name), histogram in self.histograms.items():
+            histograms.append([kind, name, histogram.totals()])
+
+        counters = list()
+        for (name, labels), counter in self.counters.items():
+            counters.append([name, [list(l) for l in labels],
+                             counter.value()])
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    counters.append([name, [list(l) for l in labels], value])
+            except Exception:       #pylint: disable=W0703
+                log.exception('Metrics collector %s failed', collector)
+
+        return dict(histograms=histograms, counters=counters)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict()
+            self.counters = dict()
+
+timings = Registry()        # pylint: disable=C0103
+
+# timings recorded for the request being handled by the current thread
+context = threading.local() # pylint: disable=C0103
+
+
+def begin():
+    ''' Starts recording the timings of a request on the current thread '''
+
+    context.records = list()
+
+def end():
+    ''' Stops recording and returns the (kind, name, elapsed) records of
+    the request handled by the current thread '''
+
+    records = getattr(context, 'records', None)
+    context.records = None
+    return records or list()
+
+def observe(kind, name, elapsed):
+    ''' Records elapsed (in seconds) in the histogram for (kind, name) and
+    against the current request, if any '''
+
+    timings.histogram(kind, name).observe(elapsed)
+    records = getattr(context, 'records', None)
+    if records is not None:
+        records.append((kind, name, elapsed))
+
+def increment(name, value=1, **labels):
+    ''' Adds value to the counter name with the given labels '''
+
+    timings.counter(name, tuple(sorted(labels.items()))).increment(value)
+
+def register(collector):
+    ''' Registers a function returning (name, labels, value) tuples to
+    be exported as counters '''
+
+    timings.collectors.append(collector)
+
+def summarize(records):
+    ''' Returns the records as 'kind.name=Nms' pairs, totalled by name
+    (with the number of observations when there is more than one) '''
+
+    totals = dict()
+    order = list()
+    for kind, name, elapsed in records:
+        key = '%s.%s' % (kind, name)
+        if key not in totals:
+            totals[key] = [0, 0.0]
+            order.append(key)
+        totals[key][0] += 1
+        totals[key][1] += elapsed
+
+    parts = list()
+    for key in order:
+        count, elapsed = totals[key]
+        if count > 1:
+            parts.append('%s=%dx%.1fms' % (key, count, elapsed * 1000))
+        else:
+            parts.append('%s=%.1fms' % (key, elapsed * 1000))
+    return ' '.join(parts)
+
+def merge(exports):
+    ''' Combines the exports of several registries by adding up the
+    histograms and counters with the same key '''
+
+    histograms = dict()
+    counters = dict()
+    for export in exports:
+        for kind, name, totals in export['histograms']:
+            current = histograms.get((kind, name))
+            if current is None:
+                histograms[(kind, name)] = list(totals)
+            else:
+                for index, value in enumerate(totals):
+                    current[index] += value
+        for name, labels, value in export['counters']:
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+
+    return dict(histograms=[[k, n, t] for (k, n), t in histograms.items()],
+                counters=[[n, [list(l) for l in ls], v]
+                          for (n, ls), v in counters.items()])
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n') \
+                         .replace('"', r'\"')
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render(export, gauges=()):
+    ''' Returns the export (and a list of (name, help, labels, value)
+    gauges) in the Prometheus text exposition format '''
+
+    lines = list()
+
+    histograms = dict()
+    for kind, name, totals in export['histograms']:
+        histograms.setdefault(kind, list()).append((name, totals))
+    for kind in sorted(histograms):
+        (metric, label, text) = HISTOGRAMS.get(
+            kind, ('ztps_%s_duration_seconds' % kind, 'name', kind))
+        lines.append('# HELP %s %s' % (metric, text))
+        lines.append('# TYPE %s histogram' % metric)
+        for name, totals in sorted(histograms[kind]):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), totals[:-1]):
+                cumulative += count
+                labels = [(label, name), ('le', bound)]
+                lines.append('%s_bucket%s %d' %
+                             (metric, _labels(labels), cumulative))
+            lines.append('%s_sum%s %s' % (metric, _labels([(label, name)]),
+                                          _number(totals[-1])))
+            lines.append('%s_count%s %d' % (metric, _labels([(label, name)]),
+                                            cumulative))
+
+    counters = dict()
+    for name, labels, value in export['counters']:
+        counters.setdefault(name, list()).append((labels, value))
+    for name in sorted(counters):
+        lines.append('# HELP %s %s' % (name, COUNTERS.get(name, name)))
+        lines.append('# TYPE %s counter' % name)
+        for labels, value in sorted(counters[name]):
+            lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+    seen = set()
+    for name, text, labels, value in gauges:
+        if name not in seen:
+            seen.add(name)
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s gauge' % name)
+        lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+class PeerExporter(object):
+    ''' Serves the export of this process's registry to the other worker
+    processes on a unix socket named after the pid in directory '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, '%d.sock' % os.getpid())
+        self.sock = None
+        self.thread = None
+
+    def __repr__(self):
+        return 'PeerExporter(path=%s)' % self.path
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self.serve,
+                                       args=(self.sock,),
+                                       name='ztps-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self, sock):
+        while True:
+            try:
+                (conn, _) = sock.accept()
+            except socket.error:
+                # the socket was closed by stop()
+                return
+            try:
+                conn.sendall(json.dumps(timings.export()))
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def stop(self):
+        if self.sock is None:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        try:
+            # wakes up the thread blocked in accept()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.sock = None
+
+exporter = None             # pylint: disable=C0103
+
+def _read_peer(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(PEER_TIMEOUT)
+    try:
+        sock.connect(path)
+        chunks = list()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(''.join(chunks))
+    finally:
+        sock.close()
+
+def collect():
+    ''' Returns the export of this process merged with the exports of the
+    other worker processes, if any '''
+
+    exports = [timings.export()]
+    if exporter is None:
+        return exports[0]
+
+    try:
+        filenames = os.listdir(exporter.directory)
+    except OSError:
+        filenames = list()
+
+    for filename in sorted(filenames):
+        path = os.path.join(exporter.directory, filename)
+        if path == exporter.path or not filename.endswith('.sock'):
+            continue
+        try:
+            exports.append(_read_peer(path))
+        except socket.error as exc:
+            if exc.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                # left behind by a worker that did not exit cleanly
+                log.debug('Removing stale metrics socket %s', path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            else:
+                log.warning('Unable to read metrics from %s: %s', path, exc)
+        except ValueError:
+            log.warning('Invalid metrics received from %s', path)
+    return merge(exports)
+
+def start_exporter(directory):
+    ''' Starts serving this process's metrics to the other workers sharing
+    directory.  The registry is reset since it was inherited from the
+    parent process '''
+
+    global exporter         # pylint: disable=W0603
+
+    timings.reset()
+    exporter = PeerExporter(directory)
+    exporter.start()
+    return exporter
+
+def stop_exporter():
+    global exporter         # pylint: disable=W0603
+
+    if exporter is not None:
+        exporter.stop()
+        exporter = None
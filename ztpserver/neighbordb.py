@@ -33,10 +33,16 @@
 # pylint: disable=C0103,W0142
 #
 import os
+import time
+import hashlib
 import logging
+import threading
 import collections
+import multiprocessing
 
+import ztpserver
 import ztpserver.config
+import ztpserver.metrics
 import ztpserver.topology
 
 from ztpserver.topology import Topology, TopologyError
@@ -45,12 +51,20 @@ from ztpserver.topology import Node
 
 from ztpserver.resources import ResourcePool
 
-from ztpserver.constants import CONTENT_TYPE_YAML
-from ztpserver.serializers import load, SerializerError
+from ztpserver.constants import CONTENT_TYPE_YAML, CONTENT_TYPE_JSON
+from ztpserver.serializers import load, loads, SerializerError
 from ztpserver.validators import validate_topology, validate_pattern
 
 log = logging.getLogger(__name__)
 
+# number of nodes sent to a worker at a time by match_inventory
+INVENTORY_CHUNKSIZE = 64
+
+# the first line of a compiled topology is
+# '<ARTIFACT_MAGIC> <ARTIFACT_VERSION> <ztpserver version> <sha1 of source>'
+ARTIFACT_MAGIC = 'ztps-topology'
+ARTIFACT_VERSION = 4
+
 def default_filename():
     ''' Returns the path for neighbordb based on the conf file
     '''
@@ -73,7 +87,12 @@ def load_file(filename, content_type):
     except SerializerError:
         log.exception('Unable to load file %s', filename)
 
-def load_topology(filename=None, contents=None):
+def load_topology(filename=None, contents=None, previous=None):
+    ''' Returns the topology compiled from neighbordb.  If the previously
+    compiled topology is given, patterns that have not changed are reused
+    from it instead of being compiled again.
+    '''
+
     try:
         if filename is None and contents is None:
             contents = load_file(default_filename(), CONTENT_TYPE_YAML)
@@ -82,17 +101,12 @@ def load_topology(filename=None, contents=None):
         elif contents is None:
             log.warning('Creating empty topology object')
 
-        if not validate_topology(contents):
+        # patterns are compiled into the topology while they are validated
+        topology = Topology()
+        if not validate_topology(contents, topology, previous):
             log.info('Unable to load neighbordb due to validation failure')
             return
 
-        topology = Topology()
-
-        if 'variables' in contents:
-            topology.add_variables(contents['variables'])
-
-        topology.add_patterns(contents['patterns'])
-
         log.info('Loaded topology: %r', topology)
         return topology
     except TopologyError:
@@ -100,6 +114,359 @@ def load_topology(filename=None, contents=None):
     except SerializerError:
         log.error('Unable to load topology file %s', filename)
 
+
+TopologyDiff = collections.namedtuple('TopologyDiff',
+                                      ['added', 'removed', 'changed'])
+
+def diff_topology(previous, topology):
+    ''' Returns the names of the patterns that were added, removed or
+    changed between two compiled topologies
+    '''
+
+    def digests(obj):
+        result = collections.defaultdict(set)
+        for pattern in obj.get_patterns(lambda _: True):
+            result[pattern.name].add(pattern.digest)
+        return result
+
+    (before, after) = (digests(previous), digests(topology))
+    return TopologyDiff(
+        added=sorted(set(after).difference(before)),
+        removed=sorted(set(before).difference(after)),
+        changed=sorted(name for name in set(before).intersection(after)
+                       if before[name] != after[name] or None in after[name]))
+
+def provisioned_changes(topology, diff, data_root=None):
+    ''' Returns the already provisioned nodes that would match a different
+    or modified pattern in topology, as a list of (systemmac, previous,
+    current) tuples of pattern names.  current is None if the node would
+    not match any pattern.  previous and current are the same name if the
+    node still matches the pattern it was provisioned with, but that
+    pattern was modified.
+
+    A node is only run through the matcher if the pattern stored for it
+    was removed or changed, or if one of the patterns that were added or
+    changed is a candidate for it and matches it.
+    '''
+
+    data_root = data_root or ztpserver.config.runtime.default.data_root
+    folder = os.path.join(data_root, 'nodes')
+    modified = set(diff.added).union(diff.changed)
+
+    try:
+        systemmacs = sorted(os.listdir(folder))
+    except OSError:
+        log.debug('No provisioned nodes found in %s', folder)
+        return list()
+
+    result = list()
+    for systemmac in systemmacs:
+        try:
+            stored = load(os.path.join(folder, systemmac, 'pattern'),
+                          CONTENT_TYPE_YAML)['name']
+            nodeattrs = load(os.path.join(folder, systemmac, '.node'),
+                             CONTENT_TYPE_JSON)
+            node = create_node(nodeattrs)
+        except (OSError, IOError, SerializerError, KeyError, TypeError):
+            continue
+        if node is None:
+            continue
+
+        affected = stored in diff.removed or stored in diff.changed
+        if not affected:
+            affected = any(pattern.name in modified and
+                           pattern.match_node(node)
+                           for pattern in topology.find_patterns(node))
+        if not affected:
+            continue
+
+        matches = topology.match_node(node)
+        current = matches[0].name if matches else None
+        if current != stored or stored in diff.changed:
+            result.append((node.systemmac, stored, current))
+    return result
+
+def artifact_filename(filename):
+    ''' Returns the path of the compiled topology for filename '''
+
+    (dirname, basename) = os.path.split(filename)
+    return os.path.join(dirname, '.%s.compiled' % basename)
+
+def artifact_header(digest):
+    return '%s %d %s %s\n' % (ARTIFACT_MAGIC, ARTIFACT_VERSION,
+                              ztpserver.__version__, digest)
+
+def dump_artifact(topology, filename, digest):
+    ''' Writes the compiled topology for filename.  The artifact is
+    keyed on the sha1 digest of the contents it was compiled from.
+
+    The topology is written as JSON (see
+    :py:func:`ztpserver.topology.dump_compiled`) so loading an artifact
+    cannot execute code.
+
+    :raises: OSError, IOError, TopologyError
+    '''
+
+    contents = ztpserver.topology.dump_compiled(topology)
+    artifact = artifact_filename(filename)
+    tmpfile = '%s.%d.tmp' % (artifact, os.getpid())
+    with open(tmpfile, 'wb') as fhandle:
+        fhandle.write(artifact_header(digest))
+        fhandle.write(contents)
+    os.rename(tmpfile, artifact)
+    log.debug('Wrote compiled topology %s', artifact)
+    return artifact
+
+def load_artifact(filename, digest):
+    ''' Returns the compiled topology for filename or None if there is
+    no artifact or it was not compiled from contents matching digest
+    '''
+
+    artifact = artifact_filename(filename)
+    try:
+        with open(artifact, 'rb') as fhandle:
+            if fhandle.readline() != artifact_header(digest):
+                log.info('Ignoring out of date compiled topology %s',
+                         artifact)
+                return
+            contents = fhandle.read()
+    except (OSError, IOError):
+        log.debug('No compiled topology found for %s', filename)
+        return
+
+    try:
+        return ztpserver.topology.load_compiled(contents)
+    except TopologyError:
+        log.warning('Invalid compiled topology %s', artifact)
+
+def compile_topology(filename=None):
+    ''' Validates and compiles neighbordb and writes the compiled
+    topology next to it.  Returns the topology or None if neighbordb
+    could not be loaded.
+
+    :raises: OSError, IOError, TopologyError
+    '''
+
+    filename = filename or default_filename()
+    data = open(filename).read()
+    try:
+        topology = load_topology(contents=loads(data, CONTENT_TYPE_YAML))
+    except SerializerError:
+        log.error('Unable to load topology file %s', filename)
+        return
+
+    if topology is not None:
+        dump_artifact(topology, filename, hashlib.sha1(data).hexdigest())
+    return topology
+
+
+class TopologyCache(object):
+    ''' Process wide cache of the compiled neighbordb topology.
+
+    The compiled :py:class:`Topology` is keyed on the identity of the
+    neighbordb file (mtime, size and content hash) and is only rebuilt
+    when the file actually changes.  A file that is touched without
+    changing its contents is not recompiled.
+    '''
+
+    def __init__(self):
+        self.topology = None
+        self.identity = None
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.rebuild_time = None
+        self.artifacts = 0
+        self.diff = None
+        self.report = None
+        self.reporter = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TopologyCache(hits=%d, misses=%d, rebuilds=%d)' % \
+               (self.hits, self.misses, self.rebuilds)
+
+    def stats(self):
+        ''' Returns a dict of the current cache statistics '''
+
+        return dict(hits=self.hits, misses=self.misses,
+                    rebuilds=self.rebuilds, rebuild_time=self.rebuild_time,
+                    artifacts=self.artifacts, identity=self.identity,
+                    diff=self.diff and self.diff._asdict(),
+                    report=self.report)
+
+    def metrics(self):
+        ''' Returns the cache statistics as metrics counters '''
+
+        return [('ztps_topology_lookups_total', (('result', 'hit'),),
+                 self.hits),
+                ('ztps_topology_lookups_total', (('result', 'miss'),),
+                 self.misses),
+                ('ztps_topology_rebuilds_total', (), self.rebuilds),
+                ('ztps_topology_artifact_loads_total', (), self.artifacts)]
+
+    def clear(self):
+        with self.lock:
+            self.topology = None
+            self.identity = None
+
+    def get(self, filename=None, force=False):
+        ''' Returns the compiled topology for filename, rebuilding it only
+        if the file has changed since it was last compiled (or if force is
+        True)
+        '''
+
+        filename = filename or default_filename()
+
+        with self.lock:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                log.error('Unable to access neighbordb file %s', filename)
+                return
+
+            identity = self.identity
+            if not force and identity is not None and \
+               identity[:3] == (filename, stat.st_mtime, stat.st_size):
+                self.hits += 1
+                return self.topology
+
+            try:
+                data = open(filename).read()
+            except (OSError, IOError):
+                log.error('Unable to read neighbordb file %s', filename)
+                return
+
+            digest = hashlib.sha1(data).hexdigest()
+            if not force and identity is not None and \
+               identity[0] == filename and identity[3] == digest:
+                log.debug('Neighbordb %s touched but not modified', filename)
+                self.identity = (filename, stat.st_mtime, stat.st_size,
+                                 digest)
+                self.hits += 1
+                return self.topology
+
+            self.misses += 1
+            previous = None
+            if not force and identity is not None and identity[0] == filename:
+                previous = self.topology
+
+            # the new topology replaces the previous one in a single step
+            topology = self.compile(filename, data, digest, force, previous)
+            if previous is not None and topology is not None:
+                self.compare(previous, topology)
+            self.topology = topology
+            self.identity = (filename, stat.st_mtime, stat.st_size, digest)
+            return self.topology
+
+    def compare(self, previous, topology):
+        ''' Records the patterns that changed between the previous and the
+        new topology.  The provisioned nodes they affect are found by a
+        background thread (see :py:meth:`check_provisioned`), so the
+        request that reloaded neighbordb does not scan the nodes folder
+        while holding the cache lock.  The report is None until then.
+        '''
+
+        self.diff = diff_topology(previous, topology)
+        log.info('Neighbordb patterns added: %d, removed: %d, changed: %d',
+                 len(self.diff.added), len(self.diff.removed),
+                 len(self.diff.changed))
+
+        self.generation += 1
+        if not any(self.diff):
+            self.report = list()
+            return
+
+        self.report = None
+        data_root = ztpserver.config.runtime.default.data_root
+        self.reporter = threading.Thread(target=self.check_provisioned,
+                                         args=(self.generation, topology,
+                                               self.diff, data_root),
+                                         name='ztps-topology-report')
+        self.reporter.daemon = True
+        self.reporter.start()
+
+    def check_provisioned(self, generation, topology, diff, data_root):
+        ''' Records the provisioned nodes affected by diff, unless
+        neighbordb has been reloaded again in the meantime
+        '''
+
+        try:
+            report = provisioned_changes(topology, diff, data_root)
+        except Exception:       # pylint: disable=W0703
+            log.exception('Unable to check provisioned nodes against '
+                          'neighbordb')
+            return
+
+        for (systemmac, provisioned, current) in report:
+            if current == provisioned:
+                log.warning('Pattern %s of provisioned node %s was '
+                            'modified', provisioned, systemmac)
+            else:
+                log.warning('Provisioned node %s would now match pattern '
+                            '%s (provisioned with %s)', systemmac, current,
+                            provisioned)
+        with self.lock:
+            if generation == self.generation:
+                self.report = report
+
+    def reload(self, filename=None):
+        ''' Forces the topology to be recompiled from filename, ignoring
+        any compiled topology written for it
+        '''
+
+        return self.get(filename, force=True)
+
+    def compile(self, filename, data, digest=None, force=False,
+                previous=None):
+        start = time.time()
+        digest = digest or hashlib.sha1(data).hexdigest()
+        enabled = ztpserver.config.runtime.neighbordb.compile
+
+        topology = None
+        if enabled and not force:
+            topology = load_artifact(filename, digest)
+        if topology is not None:
+            self.artifacts += 1
+            self.rebuild_time = time.time() - start
+            log.info('Loaded compiled topology for %s in %.3f seconds',
+                     filename, self.rebuild_time)
+            return topology
+
+        try:
+            contents = loads(data, CONTENT_TYPE_YAML)
+        except SerializerError:
+            log.error('Unable to load topology file %s', filename)
+            contents = None
+
+        topology = load_topology(contents=contents, previous=previous) \
+                   if contents is not None else None
+
+        if enabled and topology is not None:
+            try:
+                dump_artifact(topology, filename, digest)
+            except Exception:       # pylint: disable=W0703
+                log.warning('Unable to write compiled topology for %s',
+                            filename)
+
+        self.rebuilds += 1
+        self.rebuild_time = time.time() - start
+        log.info('Compiled topology from %s in %.3f seconds',
+                 filename, self.rebuild_time)
+        return topology
+
+topology_cache = TopologyCache()     # pylint: disable=C0103
+ztpserver.metrics.register(topology_cache.metrics)
+
+def get_topology(filename=None):
+    ''' Returns the cached topology for neighbordb '''
+    return topology_cache.get(filename)
+
+def reload_topology(filename=None):
+    ''' Forces neighbordb to be reloaded into the topology cache '''
+    return topology_cache.reload(filename)
+
 def load_pattern(kwargs, content_type=CONTENT_TYPE_YAML):
     """ Returns an instance of Pattern """
     try:
@@ -138,36 +505,154 @@ def create_node(nodeattrs):
     except KeyError:
         log.warning("Unable to create node, missing required attribute(s)")
 
-def resources(attributes, node):
+def load_inventory(contents):
+    ''' Returns the list of node descriptions in contents.  contents is
+    either a YAML (or JSON) list or a JSON object per line.
+
+    :raises: SerializerError
+    '''
+
+    if contents.lstrip().startswith('{'):
+        return [loads(line, CONTENT_TYPE_JSON)
+                for line in contents.splitlines() if line.strip()]
+
+    nodes = loads(contents, CONTENT_TYPE_YAML)
+    if not isinstance(nodes, list):
+        log.error('Inventory must be a list of nodes')
+        raise SerializerError
+    return nodes
+
+def match_inventory_node(topology, index, nodeattrs):
+    ''' Matches a single node description against topology and returns
+    the result as a dict.  nodeattrs has the same format as the body of
+    POST /nodes.
+    '''
+
+    result = dict(index=index)
+    try:
+        node = create_node(dict(nodeattrs))
+        if node is None:
+            raise ValueError('missing required attribute systemmac')
+        result['systemmac'] = node.systemmac
+
+        matches = topology.match_node(node)
+        result['matches'] = [pattern.name for pattern in matches]
+        result['pattern'] = matches[0].name if matches else None
+        result['definition'] = matches[0].definition if matches else None
+    except Exception as exc:        # pylint: disable=W0703
+        result['error'] = str(exc) or exc.__class__.__name__
+    return result
+
+_inventory_topology = None
+
+def _init_inventory(topology):
+    # runs in each pool process, see match_inventory
+    global _inventory_topology      # pylint: disable=W0603
+    _inventory_topology = topology
+
+def _match_inventory(item):
+    return match_inventory_node(_inventory_topology, *item)
+
+def match_inventory(nodes, topology, jobs=1):
+    ''' Matches an iterable of node descriptions against topology and
+    yields the result of :py:func:`match_inventory_node` for each of them
+    in order.  If jobs is greater than one the nodes are matched by a pool
+    of jobs processes.
+    '''
+
+    if jobs <= 1:
+        for (index, nodeattrs) in enumerate(nodes):
+            yield match_inventory_node(topology, index, nodeattrs)
+        return
+
+    pool = multiprocessing.Pool(jobs, _init_inventory, (topology,))
+    try:
+        for result in pool.imap(_match_inventory, enumerate(nodes),
+                                INVENTORY_CHUNKSIZE):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def resources(attributes, node, allocations=None):
+    ''' Returns a copy of attributes with the resource functions replaced
+    by the resources they resolve to for node.
+
+    The optional allocations argument maps pool names to resources that
+    have already been allocated to node (see :py:func:`allocate_resources`)
+    and is used to resolve allocate() functions for those pools.
+    '''
+
     log.debug('Start processing resources with attributes: %s', attributes)
 
     _attributes = dict()
     _resources = ResourcePool()
 
+    def resolve(match):
+        function = match.group('function')
+        pool = match.group('arg')
+        if function == 'allocate' and allocations and pool in allocations:
+            return allocations[pool]
+        method = getattr(_resources, function)
+        return method(pool, node)
+
     for key, value in attributes.items():
         if hasattr(value, 'items'):
-            value = resources(value, node)
+            value = resources(value, node, allocations)
         elif hasattr(value, '__iter__'):
             _value = list()
             for item in value:
                 match = ztpserver.topology.FUNC_RE.match(item)
                 if match:
-                    method = getattr(_resources, match.group('function'))
-                    _value.append(method(match.group('arg'), node))
+                    _value.append(resolve(match))
                 else:
                     _value.append(item)
             value = _value
         else:
             match = ztpserver.topology.FUNC_RE.match(str(value))
             if match:
-                method = getattr(_resources, match.group('function'))
-                value = method(match.group('arg'), node)
+                value = resolve(match)
                 log.debug('Allocated value %s for attribute %s from pool %s',
                           value, key, match.group('arg'))
         log.debug('Setting %s to %s', key, value)
         _attributes[key] = value
     return _attributes
 
+def resource_pools(attributes, function=None):
+    ''' Returns the set of resource pools referenced by attributes.  If
+    function is specified only pools referenced by that function are
+    returned.
+    '''
+
+    pools = set()
+    for value in attributes.values():
+        if hasattr(value, 'items'):
+            pools.update(resource_pools(value, function))
+            continue
+        elif not hasattr(value, '__iter__'):
+            value = [value]
+        for item in value:
+            match = ztpserver.topology.FUNC_RE.match(str(item))
+            if match and function in (None, match.group('function')):
+                pools.add(match.group('arg'))
+    return pools
+
+def allocate_resources(attributes, node):
+    ''' Allocates a resource to node from every pool referenced by an
+    allocate() function in the list of attributes.  Each pool is read and
+    written once.  If any pool is exhausted, the resources allocated by
+    this call are released and ResourcePoolError is raised.
+
+    :returns: dict mapping pool names to the allocated resources
+    '''
+
+    pools = set()
+    for item in attributes:
+        pools.update(resource_pools(item, 'allocate'))
+    if not pools:
+        return dict()
+    return ResourcePool().allocate_all(pools, node)
+
 def replace_config_action(resource, filename=None):
     ''' manually build a definition with a single action replace_config '''
 
@@ -0,0 +1,216 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+'''
+    MODULE:
+        ztpserver.profiler
+
+    AUTHOR:
+        Arista Networks
+
+    DESCRIPTION:
+        The profiler module profiles every Nth request handled by a
+        controller with cProfile.  The stats of the profiled requests are
+        aggregated into a window which is written to a rotating pstats
+        file under data_root/profiles once it holds the configured number
+        of requests, or when profiling is stopped.
+
+    :copyright: Copyright (c) 2014, Arista Networks
+    :license: BSD, see LICENSE for more details
+
+'''
+import os
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import itertools
+
+import ztpserver.config
+
+log = logging.getLogger(__name__)   #pylint: disable=C0103
+
+PROFILES_FOLDER = 'profiles'
+
+# interval used when profiling is started without one and none is
+# configured
+DEFAULT_INTERVAL = 100
+
+
+class ProfilerError(Exception):
+    ''' Base error raised by the profiler '''
+    pass
+
+
+class SamplingProfiler(object):
+    ''' Profiles every interval-th request passed to :py:meth:`sample`
+
+    The profiler is shared by all the threads of a process.  Each sampled
+    request is profiled on its own cProfile.Profile, whose stats are added
+    to the current window under a lock.
+    '''
+
+    def __init__(self):
+        self.active = False
+        self.interval = 0
+        self.requests = itertools.count()
+        self.window = None
+        self.profiled = 0
+        self.started = None
+        self.filename = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SamplingProfiler(active=%s, interval=%d)' % \
+               (self.active, self.interval)
+
+    def configure(self):
+        ''' Starts profiling if an interval is configured '''
+
+        interval = ztpserver.config.runtime.profiling.interval
+        if interval:
+            self.start(interval)
+
+    def start(self, interval=None):
+        ''' Starts a new profile window, profiling every interval-th
+        request '''
+
+        interval = interval or ztpserver.config.runtime.profiling.interval \
+                   or DEFAULT_INTERVAL
+        with self.lock:
+            self.interval = interval
+            self.requests = itertools.count()
+            self.window = None
+            self.profiled = 0
+            self.started = time.time()
+            self.active = True
+        log.info('Profiling every %d requests', interval)
+
+    def stop(self):
+        ''' Stops profiling and writes the current window.  Returns the
+        filename written, if any '''
+
+        with self.lock:
+            self.active = False
+            filename = self.flush()
+        log.info('Profiling stopped')
+        return filename
+
+    def sample(self):
+        ''' Returns True if the next request should be profiled '''
+
+        return self.active and next(self.requests) % self.interval == 0
+
+    def runcall(self, func, *args, **kwargs):
+        ''' Calls func, profiling the call into the current window '''
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.create_stats()
+            with self.lock:
+                if self.window is None:
+                    self.window = pstats.Stats(profile)
+                else:
+                    self.window.add(profile)
+                self.profiled += 1
+                if self.profiled >= \
+                   ztpserver.config.runtime.profiling.window:
+                    try:
+                        self.flush()
+                    except ProfilerError:
+                        # already logged, the request must not fail
+                        pass
+
+    def status(self):
+        return dict(active=self.active, interval=self.interval,
+                    profiled=self.profiled, started=self.started,
+                    filename=self.filename, pid=os.getpid())
+
+    def flush(self):
+        ''' Writes the current window to the profile file, rotating the
+        previous files.  Must be called with the lock held. '''
+
+        if self.window is None:
+            return None
+
+        directory = os.path.join(ztpserver.config.runtime.default.data_root,
+                                 PROFILES_FOLDER)
+        filename = os.path.join(directory, 'ztps-%d.pstats' % os.getpid())
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            rotate(filename, ztpserver.config.runtime.profiling.files)
+            self.window.dump_stats(filename)
+        except (IOError, OSError) as exc:
+            log.error('Unable to write profile %s: %s', filename, exc)
+            raise ProfilerError(exc)
+        finally:
+            self.window = None
+            self.profiled = 0
+            self.started = time.time()
+
+        log.info('Wrote profile %s', filename)
+        self.filename = filename
+        return filename
+
+    def download(self):
+        ''' Writes the current window and returns the contents of the
+        latest profile file
+
+        :raises: ProfilerError if no profile has been written
+        '''
+
+        with self.lock:
+            self.flush()
+            if self.filename is None:
+                raise ProfilerError('no profile available')
+            try:
+                with open(self.filename, 'rb') as fhandle:
+                    return fhandle.read()
+            except IOError as exc:
+                raise ProfilerError(exc)
+
+profiler = SamplingProfiler()   # pylint: disable=C0103
+
+
+def rotate(filename, count):
+    ''' Renames filename to filename.1, filename.1 to filename.2 and so on,
+    keeping at most count files '''
+
+    for index in range(count - 1, 0, -1):
+        source = '%s.%d' % (filename, index - 1) if index > 1 else filename
+        if os.path.exists(source):
+            os.rename(source, '%s.%d' % (filename, index))
@@ -49,10 +49,15 @@
 
 '''
 import os
+import copy
 import mimetypes
 import logging
+import threading
+import time
+import collections
 
 import ztpserver.config
+import ztpserver.metrics
 import ztpserver.serializers
 
 log = logging.getLogger(__name__)   #pylint: disable=C0103
@@ -71,6 +76,96 @@ class FileObjectNotFound(RepositoryError):
     '''
     pass
 
+class RepositoryCache(object):
+    ''' LRU cache of deserialized file contents shared by
+    :py:class:`Repository` instances.
+
+    Entries are keyed on the file path and content type and are only
+    returned while the file's mtime and size are unchanged.  Callers get a
+    copy of the cached object so they are free to modify it.  The memory
+    limit is approximated by the size of the cached files.
+    '''
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'RepositoryCache(maxsize=%d, size=%d, entries=%d)' % \
+               (self.maxsize, self.size, len(self.entries))
+
+    def stats(self):
+        ''' Returns a dict of the current cache statistics '''
+
+        requests = self.hits + self.misses
+        ratio = float(self.hits) / requests if requests else 0.0
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.entries),
+                    size=self.size, maxsize=self.maxsize, hit_ratio=ratio)
+
+    def read(self, filepath, content_type=None, cls=None):
+        ''' Returns the deserialized contents of filepath
+
+        :raises: SerializerError, OSError, IOError
+        '''
+
+        key = (filepath, content_type)
+        stat = os.stat(filepath)
+        identity = (stat.st_mtime, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == identity:
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+                obj = entry[1]
+            else:
+                self.misses += 1
+                obj = None
+
+        if obj is None:
+            obj = ztpserver.serializers.load(filepath, content_type)
+            self.add(key, identity, obj)
+
+        if not isinstance(obj, basestring):
+            obj = copy.deepcopy(obj)
+        if cls:
+            obj = cls(**obj)    #pylint: disable=W0142
+        return obj
+
+    def add(self, key, identity, obj):
+        cost = identity[1]
+        if cost > self.maxsize:
+            return
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[0][1]
+            while self.entries and self.size + cost > self.maxsize:
+                (_, entry) = self.entries.popitem(last=False)
+                self.size -= entry[0][1]
+                self.evictions += 1
+            self.entries[key] = (identity, obj)
+            self.size += cost
+
+    def invalidate(self, filepath=None):
+        ''' Removes the entries for filepath or all entries if filepath
+        is None
+        '''
+
+        with self.lock:
+            for key in list(self.entries):
+                if filepath is None or key[0] == filepath:
+                    (identity, _) = self.entries.pop(key)
+                    self.size -= identity[1]
+
+
 class FileObject(object):
     ''' The :py:class:`FileObject` represents a single file entity in the
     repository.   The instance provides convienent methods to read and write
@@ -95,6 +190,7 @@ class FileObject(object):
 
         self.type, self.encoding = mimetypes.guess_type(self.name)
         self.content_type = kwargs.get('content_type')
+        self.cache = kwargs.get('cache')
 
     def __repr__(self):
         return 'FileObject(name=%s)' % self.name
@@ -118,12 +214,18 @@ class FileObject(object):
         any errors occur, a FileObjectError is raised
 
         '''
+        start = time.time()
         try:
             self.content_type = content_type
+            if self.cache is not None:
+                return self.cache.read(self.name, content_type, cls)
             return ztpserver.serializers.load(self.name, content_type, cls)
         except ztpserver.serializers.SerializerError:
             log.error('Could not access file %s', self.name)
             raise FileObjectError
+        finally:
+            ztpserver.metrics.observe('repository', 'read',
+                                      time.time() - start)
 
     def write(self, contents, content_type=None):
         ''' Writes the contents to the file
@@ -150,6 +252,9 @@ class FileObject(object):
         except ztpserver.serializers.SerializerError:
             log.error('Unable to write file %s', self.name)
             raise FileObjectError
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(self.name)
 
 
 class Repository(object):
@@ -158,15 +263,18 @@ class Repository(object):
     with persistently stored files.
     '''
 
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         ''' The initialize method for :py:class:`Repository`
 
         :param path: the base path of the repository
         :type path: str
+        :param cache: an optional cache for file contents
+        :type cache: :py:class:`RepositoryCache`
         :returns: object
 
         '''
         self.path = path
+        self.cache = cache
 
     def __repr__(self):
         return "Repository(path=%s)" % self.path
@@ -228,7 +336,7 @@ class Repository(object):
         '''
         try:
             filepath = self.expand(filepath)
-            obj = FileObject(filepath)
+            obj = FileObject(filepath, cache=self.cache)
             if contents:
                 obj.write(contents, content_type)
             return obj
@@ -246,6 +354,25 @@ class Repository(object):
         filepath = self.expand(filepath)
         return os.path.exists(filepath)
 
+    def stat(self, filepath):
+        ''' Returns the identity of a file in the repository
+
+        :param filepath: the file path to stat
+        :type filepath: str
+        :returns: tuple -- (mtime, size, inode) or None if the file does
+                  not exist
+
+        The identity changes whenever the file is modified, replaced or
+        removed and is used to detect when cached content derived from
+        the file needs to be recomputed.
+
+        '''
+        try:
+            result = os.stat(self.expand(filepath))
+            return (result.st_mtime, result.st_size, result.st_ino)
+        except OSError:
+            return None
+
     def get_file(self, filepath):
         ''' Returns an intance of :py:class:`FileObject` if it exists
 
@@ -261,7 +388,7 @@ class Repository(object):
         filepath = self.expand(filepath)
         if not self.exists(filepath):
             raise FileObjectNotFound(filepath)
-        return FileObject(filepath)
+        return FileObject(filepath, cache=self.cache)
 
     def delete_file(self, filepath):
         ''' Deletes an existing file in the respository
@@ -278,13 +405,25 @@ class Repository(object):
         except (OSError, IOError):
             log.exception('Unable to delete file %s', filepath)
             raise RepositoryError
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(filepath)
+
 
 
+cache = RepositoryCache()   #pylint: disable=C0103
 
 def create_repository(path):
     if not os.path.exists(path):
         raise RepositoryError
-    return Repository(path)
+
+    # the cache is shared by all repositories and is disabled if the
+    # configured size is 0
+    maxsize = ztpserver.config.runtime.default.repository_cache_size
+    cache.maxsize = maxsize * 1024 * 1024
+    if not maxsize:
+        return Repository(path)
+    return Repository(path, cache=cache)
 
 
 
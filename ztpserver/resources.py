@@ -30,21 +30,556 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 import os
+import re
+import fcntl
+import shutil
+import socket
+import bisect
 import logging
+import binascii
+import threading
+import contextlib
+import collections
 
 import ztpserver.config
 
-from ztpserver.serializers import load, dump
+from ztpserver.serializers import loads, dumps
 from ztpserver.constants import CONTENT_TYPE_YAML
 
 log = logging.getLogger(__name__)   #pylint: disable=C0103
 
+# minimum number of entries appended to a pool file before it is compacted
+COMPACT_THRESHOLD = 64
+
+# number of bytes at the end of a pool file used to detect rewrites
+MARK_SIZE = 64
+
+RANGE_POOL_TYPES = ['cidr', 'range', 'vlan']
+
+# largest number of resources in a range pool (a 2MB bitmap)
+MAX_RANGE_POOL_SIZE = 1 << 24
+
+FREE_BYTE_RE = re.compile(r'[^\xff]')
+
 
 class ResourcePoolError(Exception):
     ''' base error raised by :py:class:`Resource` '''
     pass
 
 
+class ValuePool(object):
+    ''' A pool listing every resource as a key of the pool file, with the
+    node it is allocated to (or null) as the value::
+
+        192.168.1.1/24: null
+        192.168.1.2/24: 001c73abcdef
+    '''
+
+    def __init__(self, contents=None):
+        self.data = collections.OrderedDict()
+        self.owners = dict()
+        self.free = collections.deque()
+        self.used = 0
+        for key, owner in (contents or dict()).items():
+            self.update(key, owner)
+
+    def __len__(self):
+        return len(self.data)
+
+    def available(self):
+        ''' Returns the number of free resources '''
+        return len(self.data) - self.used
+
+    def contents(self):
+        return dict(self.data)
+
+    def owner(self, key):
+        return self.data.get(key)
+
+    def lookup(self, owner):
+        return self.owners.get(owner)
+
+    def update(self, key, owner):
+        ''' Sets the owner of key, or frees key if owner is None '''
+
+        owner = str(owner) if owner is not None else None
+        previous = self.data.get(key)
+        if previous is not None:
+            self.used -= 1
+            if self.owners.get(previous) == key:
+                del self.owners[previous]
+
+        self.data[key] = owner
+        if owner is None:
+            self.free.append(key)
+        else:
+            self.used += 1
+            self.owners.setdefault(owner, key)
+
+    def next_free(self):
+        ''' Returns a free resource or None if the pool is exhausted '''
+
+        while self.free:
+            key = self.free.popleft()
+            if key in self.data and self.data[key] is None:
+                return key
+
+    @staticmethod
+    def appendable(data):
+        # pools written in flow style cannot be appended to
+        return not data.lstrip().startswith('{')
+
+    @staticmethod
+    def entry(key, owner):
+        return dumps({key: owner}, CONTENT_TYPE_YAML, safe_dump=True)
+
+    def dump(self):
+        return dumps(dict(self.data), CONTENT_TYPE_YAML, safe_dump=True)
+
+
+class RangePool(object):
+    ''' A pool declaring its resources as one or more CIDR blocks, integer
+    ranges or VLAN ranges::
+
+        type: cidr
+        pool: 10.1.0.0/16
+        allocations:
+          10.1.0.1: 001c73abcdef
+
+    Allocated resources are tracked in a bitmap with an index of nodes to
+    resources, so the resources in the pool are never enumerated.  The
+    network and broadcast addresses of IPv4 blocks are not allocated.
+    '''
+
+    def __init__(self, contents):
+        self.type = contents['type']
+        self.spec = str(contents['pool'])
+        self.family = None
+
+        intervals = sorted(self.parse(token.strip())
+                           for token in self.spec.split(','))
+        self.starts = list()
+        self.ends = list()
+        self.offsets = list()
+        self.size = 0
+        for start, end in intervals:
+            if self.ends and start <= self.ends[-1] + 1:
+                self.size += max(end - self.ends[-1], 0)
+                self.ends[-1] = max(end, self.ends[-1])
+                continue
+            self.starts.append(start)
+            self.ends.append(end)
+            self.offsets.append(self.size)
+            self.size += end - start + 1
+
+        if not self.size or self.size > MAX_RANGE_POOL_SIZE:
+            log.error('Invalid size for resource pool %s', self.spec)
+            raise ResourcePoolError
+
+        self.bitmap = bytearray((self.size + 7) // 8)
+        for index in range(self.size, len(self.bitmap) * 8):
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.cursor = 0
+
+        self.allocated = dict()
+        self.owners = dict()
+        for key, owner in (contents.get('allocations') or dict()).items():
+            self.update(key, owner)
+
+    def __len__(self):
+        return len(self.allocated)
+
+    def available(self):
+        ''' Returns the number of free resources '''
+        return self.size - len(self.allocated)
+
+    def parse(self, token):
+        ''' Returns the (start, end) values of a pool token '''
+
+        try:
+            if self.type == 'cidr':
+                (address, prefixlen) = token.split('/')
+                family = socket.AF_INET6 if ':' in address else socket.AF_INET
+                if self.family not in (None, family):
+                    raise ValueError('mixed address families')
+                self.family = family
+
+                bits = 32 if family == socket.AF_INET else 128
+                prefixlen = int(prefixlen)
+                if not 0 <= prefixlen <= bits:
+                    raise ValueError('invalid prefix length')
+                hostmask = (1 << (bits - prefixlen)) - 1
+                start = self.to_int(address) & ~hostmask
+                end = start | hostmask
+                if family == socket.AF_INET and prefixlen < 31:
+                    start, end = start + 1, end - 1
+            else:
+                (start, _, end) = token.partition('-')
+                (start, end) = (int(start), int(end or start))
+                if self.type == 'vlan' and not 1 <= start <= end <= 4094:
+                    raise ValueError('invalid vlan range')
+            if start > end:
+                raise ValueError('invalid range')
+            return (start, end)
+        except (ValueError, socket.error):
+            log.error('Invalid %s pool %s', self.type, token)
+            raise ResourcePoolError
+
+    def to_int(self, key):
+        if self.type != 'cidr':
+            return int(key)
+        packed = socket.inet_pton(self.family, str(key).split('/')[0])
+        return int(binascii.hexlify(packed), 16)
+
+    def from_int(self, value):
+        if self.type != 'cidr':
+            return value
+        width = 8 if self.family == socket.AF_INET else 32
+        packed = binascii.unhexlify('%0*x' % (width, value))
+        return socket.inet_ntop(self.family, packed)
+
+    def index(self, key):
+        ''' Returns the bitmap index of key or None if key is not in the
+        pool
+        '''
+
+        try:
+            value = self.to_int(key)
+        except (ValueError, TypeError, socket.error):
+            return None
+        pos = bisect.bisect_right(self.starts, value) - 1
+        if pos < 0 or value > self.ends[pos]:
+            return None
+        return self.offsets[pos] + value - self.starts[pos]
+
+    def key(self, index):
+        pos = bisect.bisect_right(self.offsets, index) - 1
+        return self.from_int(self.starts[pos] + index - self.offsets[pos])
+
+    def contents(self):
+        allocations = dict((self.key(i), o) for i, o in self.allocated.items())
+        return dict(type=self.type, pool=self.spec, allocations=allocations)
+
+    def owner(self, key):
+        return self.allocated.get(self.index(key))
+
+    def lookup(self, owner):
+        index = self.owners.get(owner)
+        return self.key(index) if index is not None else None
+
+    def update(self, key, owner):
+        ''' Sets the owner of key, or frees key if owner is None '''
+
+        index = self.index(key)
+        if index is None:
+            log.warning('Ignoring %s which is not in pool %s', key, self.spec)
+            return
+
+        previous = self.allocated.pop(index, None)
+        if previous is not None and self.owners.get(previous) == index:
+            del self.owners[previous]
+
+        if owner is None:
+            self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+            self.cursor = min(self.cursor, index)
+        else:
+            owner = str(owner)
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+            self.allocated[index] = owner
+            self.owners.setdefault(owner, index)
+
+    def next_free(self):
+        ''' Returns the first free resource or None if the pool is
+        exhausted
+        '''
+
+        match = FREE_BYTE_RE.search(self.bitmap, self.cursor >> 3)
+        if match is None:
+            return None
+        pos = match.start()
+        byte = self.bitmap[pos]
+        index = pos * 8 + ((~byte & (byte + 1)) & 0xff).bit_length() - 1
+        self.cursor = index
+        return self.key(index)
+
+    @staticmethod
+    def appendable(data):
+        # allocations can only be appended when they are the last block
+        # and are indented the way entry() writes them
+        lines = [l.rstrip() for l in data.splitlines() if l.strip()]
+        if 'allocations:' not in lines:
+            return False
+        block = lines[len(lines) - lines[::-1].index('allocations:'):]
+        return all(l.startswith('  ') and not l[2].isspace() for l in block)
+
+    @staticmethod
+    def entry(key, owner):
+        return '  %s' % dumps({key: owner}, CONTENT_TYPE_YAML, safe_dump=True)
+
+    def dump(self):
+        header = dumps(dict(type=self.type, pool=self.spec),
+                       CONTENT_TYPE_YAML, safe_dump=True)
+        entries = [self.entry(self.key(i), self.allocated[i])
+                   for i in sorted(self.allocated)]
+        return '%sallocations:\n%s' % (header, ''.join(entries))
+
+
+def create_pool(contents):
+    ''' Returns the pool for the contents of a pool file '''
+
+    contents = contents or dict()
+    if contents.get('type') in RANGE_POOL_TYPES and 'pool' in contents:
+        return RangePool(contents)
+    return ValuePool(contents)
+
+
+class PoolStore(object):
+    ''' Storage for a single resource pool file.
+
+    The pool (a :py:class:`ValuePool` or :py:class:`RangePool`) is kept in
+    memory with an index of nodes to resources so lookups and allocations
+    do not have to scan the pool.
+
+    Changes are persisted by appending ``resource: node`` entries to the
+    pool file, where a later entry for a resource overrides an earlier one.
+    The file is compacted once the appended entries outnumber the
+    resources in the pool.
+
+    Until then the pool file repeats the keys of the resources that were
+    allocated or released since the last compaction.  Duplicate keys are
+    not valid YAML 1.2; the file is only read correctly by a loader that
+    keeps the last of duplicate keys, as PyYAML does.  Tools that reject
+    duplicate keys, or keep the first one, must not be used to read pool
+    files.  Editing a pool file is safe: the next operation reloads it.  Every operation holds an exclusive flock on
+    ``.<pool>.lock`` and first reads any entries appended by other
+    processes, so the store is safe to use from multiple workers.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        (dirname, basename) = os.path.split(filepath)
+        self.lockpath = os.path.join(dirname, '.%s.lock' % basename)
+
+        self.pool = ValuePool()
+
+        # identity of the pool file contents loaded into memory
+        self.identity = None
+        self.appended = 0
+        self.compacted = True
+
+        self.lock = threading.Lock()
+        self.lockfile = None
+        self.pid = None
+
+    def __repr__(self):
+        return 'PoolStore(filepath=%s, pool=%s)' % \
+               (self.filepath, type(self.pool).__name__)
+
+    @contextlib.contextmanager
+    def locked(self):
+        ''' Holds the process and file lock and refreshes the pool '''
+
+        with self.lock:
+            if self.pid != os.getpid():
+                # a lock file inherited across fork shares the lock
+                self.lockfile = open(self.lockpath, 'a')
+                self.pid = os.getpid()
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def items(self):
+        ''' Returns a copy of the pool file contents '''
+
+        with self.locked():
+            return self.pool.contents()
+
+    def lookup(self, owner):
+        ''' Returns the resource allocated to owner or None '''
+
+        with self.locked():
+            return self.pool.lookup(owner)
+
+    def available(self):
+        ''' Returns the number of free resources in the pool '''
+
+        with self.locked():
+            return self.pool.available()
+
+    def allocate(self, owner):
+        ''' Returns the resource allocated to owner, allocating a free
+        resource if owner does not have one.
+
+        :raises: ResourcePoolError if there are no free resources
+        '''
+
+        return self.reserve(owner)[0]
+
+    def reserve(self, owner):
+        ''' Same as :py:meth:`allocate` but returns a tuple of the resource
+        and whether it was newly allocated to owner
+        '''
+
+        with self.locked():
+            key = self.pool.lookup(owner)
+            if key is not None:
+                log.info('Found allocated resource, returning %s', key)
+                return (key, False)
+
+            key = self.pool.next_free()
+            if key is None:
+                log.warning('No resources available in pool %s',
+                            self.filepath)
+                raise ResourcePoolError
+
+            log.info('Assigning %s from pool %s to node %s',
+                     key, self.filepath, owner)
+            self.write(key, owner)
+            return (key, True)
+
+    def release(self, key, owner=None):
+        ''' Frees key.  If owner is specified the key is only released if
+        it is still allocated to owner.
+        '''
+
+        with self.locked():
+            current = self.pool.owner(key)
+            if current is None:
+                return
+            if owner is not None and current != owner:
+                return
+            log.info('Releasing %s in pool %s', key, self.filepath)
+            self.write(key, None)
+
+    def replace(self, contents):
+        ''' Replaces the contents of the pool '''
+
+        with self.locked():
+            self.pool = create_pool(contents)
+            self.compact()
+
+    def refresh(self):
+        ''' Loads changes made to the pool file since it was last read.
+        Entries appended to the file are read incrementally, any other
+        change causes the whole file to be reloaded.
+        '''
+
+        stat = os.stat(self.filepath)
+        if self.identity is not None:
+            (inode, size, mtime, mark) = self.identity
+            if (stat.st_ino, stat.st_size, stat.st_mtime) == \
+               (inode, size, mtime):
+                return
+
+            if stat.st_ino == inode and stat.st_size > size:
+                with open(self.filepath) as fhandle:
+                    fhandle.seek(max(size - len(mark), 0))
+                    if fhandle.read(len(mark)) == mark:
+                        contents = loads(fhandle.read(), CONTENT_TYPE_YAML)
+                        if hasattr(contents, 'items'):
+                            log.debug('Loading %d entries appended to %s',
+                                      len(contents), self.filepath)
+                            for key, owner in contents.items():
+                                self.pool.update(key, owner)
+                            self.appended += len(contents)
+                            self.identity = self.stat()
+                            return
+
+        log.debug('Loading resource pool %s', self.filepath)
+        with open(self.filepath) as fhandle:
+            data = fhandle.read()
+        self.pool = create_pool(loads(data, CONTENT_TYPE_YAML))
+        self.compacted = self.pool.appendable(data)
+        self.appended = 0
+        self.identity = self.stat()
+
+    def stat(self):
+        ''' Returns the identity of the pool file '''
+
+        with open(self.filepath) as fhandle:
+            stat = os.fstat(fhandle.fileno())
+            fhandle.seek(max(stat.st_size - MARK_SIZE, 0))
+            mark = fhandle.read(MARK_SIZE)
+        return (stat.st_ino, stat.st_size, stat.st_mtime, mark)
+
+    def write(self, key, owner):
+        ''' Updates key and persists the change '''
+
+        self.pool.update(key, owner)
+        if not self.compacted or \
+           self.appended >= max(COMPACT_THRESHOLD, len(self.pool)):
+            self.compact()
+            return
+
+        entry = self.pool.entry(key, owner)
+        with open(self.filepath, 'a+') as fhandle:
+            fhandle.seek(0, os.SEEK_END)
+            if fhandle.tell() > 0:
+                fhandle.seek(-1, os.SEEK_END)
+                if fhandle.read(1) != '\n':
+                    entry = '\n' + entry
+            fhandle.write(entry)
+        self.appended += 1
+        self.identity = self.stat()
+
+    def compact(self):
+        ''' Rewrites the pool file with one entry per resource '''
+
+        log.debug('Compacting resource pool %s', self.filepath)
+        tmpfile = '%s.tmp' % self.lockpath[:-len('.lock')]
+        with open(tmpfile, 'w') as fhandle:
+            fhandle.write(self.pool.dump())
+            fhandle.flush()
+            os.fsync(fhandle.fileno())
+        if os.path.exists(self.filepath):
+            shutil.copymode(self.filepath, tmpfile)
+        os.rename(tmpfile, self.filepath)
+
+        self.appended = 0
+        self.compacted = True
+        self.identity = self.stat()
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+def pool_store(filepath):
+    ''' Returns the :py:class:`PoolStore` for filepath '''
+
+    filepath = os.path.abspath(filepath)
+    with _stores_lock:
+        store = _stores.get(filepath)
+        if store is None:
+            store = PoolStore(filepath)
+            _stores[filepath] = store
+        return store
+
+
+def pool_usage(dirname):
+    ''' Returns a list of (pool, free resources) for the pool files in
+    dirname.  Pools that cannot be loaded are skipped.
+    '''
+
+    usage = list()
+    try:
+        filenames = sorted(os.listdir(dirname))
+    except OSError:
+        return usage
+
+    for filename in filenames:
+        filepath = os.path.join(dirname, filename)
+        if filename.startswith('.') or not os.path.isfile(filepath):
+            continue
+        try:
+            usage.append((filename, pool_store(filepath).available()))
+        except Exception:       #pylint: disable=W0703
+            log.warning('Unable to load resource pool %s', filepath)
+    return usage
+
+
 class ResourcePool(object):
 
     def __init__(self):
@@ -58,53 +593,61 @@ class ResourcePool(object):
             data[key] = str(value) if value is not None else None
         return data
 
+    def store(self, pool):
+        return pool_store(os.path.join(self.filepath, pool))
+
     def load(self, pool):
-        self.data = dict()
-        filepath = os.path.join(self.filepath, pool)
-        contents = load(filepath, CONTENT_TYPE_YAML)
-        for key, value in contents.items():
-            self.data[key] = str(value) if value is not None else None
+        self.data = self.store(pool).items()
 
     def dump(self, pool):
-        filepath = os.path.join(self.filepath, pool)
-        dump(self, filepath, CONTENT_TYPE_YAML)
+        self.store(pool).replace(self.data)
 
     def allocate(self, pool, node):
         try:
-            match = self.lookup(pool, node)
-            if match:
-                log.info('Found allocated resource, returning %s', match)
-                return match
+            return self.store(pool).allocate(node.systemmac)
+        except ResourcePoolError:
+            raise
+        except Exception:
+            log.exception('Unable to allocate resource')
+            raise ResourcePoolError
 
-            self.load(pool)
-            key = next(x[0] for x in self.data.items() if x[1] is None)
+    def allocate_all(self, pools, node):
+        ''' Allocates a resource from each pool to node.  If any pool is
+        exhausted, the resources newly allocated by this call are released
+        again.
 
-            log.info('Assigning %s from pool %s to node %s',
-                     key, pool, node.systemmac)
+        :returns: dict mapping pool names to the allocated resources
+        :raises: ResourcePoolError
+        '''
 
-            self.data[key] = node.systemmac
-            self.dump(pool)
-        except StopIteration:
-            log.warning('No resources available in pool %s', pool)
-            raise ResourcePoolError
-        except Exception:
-            log.exception('Unable to allocate resource')
+        allocations = dict()
+        reserved = list()
+        try:
+            for pool in sorted(pools):
+                store = self.store(pool)
+                (key, created) = store.reserve(node.systemmac)
+                allocations[pool] = key
+                if created:
+                    reserved.append((store, key))
+        except Exception as exc:
+            if not isinstance(exc, ResourcePoolError):
+                log.exception('Unable to allocate resources')
+            for store, key in reversed(reserved):
+                try:
+                    store.release(key, node.systemmac)
+                except Exception:       #pylint: disable=W0703
+                    log.exception('Unable to release %s in %s',
+                                  key, store.filepath)
             raise ResourcePoolError
-        return key
+        return allocations
 
     def lookup(self, pool, node):
         ''' Return an existing allocated resource if one exists '''
 
         try:
             log.info('Looking up resource for node %s', node.systemmac)
-            self.load(pool)
-            matches = [m[0] for m in self.data.iteritems()
-                       if m[1] == node.systemmac]
-            key = matches[0] if matches else None
-            return key
+            return self.store(pool).lookup(node.systemmac)
         except Exception:
             log.exception('An error occurred trying to lookup existing '
                           'resource for node %s', node.systemmac)
             raise ResourcePoolError
-
-
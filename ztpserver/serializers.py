@@ -43,6 +43,32 @@ try:
 except ImportError:
     YAML_AVAILABLE = False
 
+if YAML_AVAILABLE:
+    # use the libyaml bindings when PyYAML was built with them
+    try:
+        from yaml import CSafeLoader as YAMLSafeLoader
+        from yaml import CSafeDumper as YAMLSafeDumper
+        from yaml import CDumper as YAMLDumper
+        LIBYAML_AVAILABLE = True
+    except ImportError:
+        from yaml import SafeLoader as YAMLSafeLoader
+        from yaml import SafeDumper as YAMLSafeDumper
+        from yaml import Dumper as YAMLDumper
+        LIBYAML_AVAILABLE = False
+
+    class YAMLLoader(YAMLSafeLoader):       #pylint: disable=R0901
+        ''' Safe YAML loader which constructs native str objects '''
+
+        def construct_yaml_str(self, node):
+            ''' Returns the scalar as str
+
+            :raises: UnicodeEncodeError if it is not ASCII
+            '''
+            return str(self.construct_scalar(node))
+
+    YAMLLoader.add_constructor(u'tag:yaml.org,2002:str',
+                               YAMLLoader.construct_yaml_str)
+
 
 log = logging.getLogger(__name__)   #pylint: disable=C0103
 
@@ -54,6 +80,9 @@ class SerializerError(Exception):
 class SerializerMixin(object):
     ''' Base serializer object '''
 
+    # True if deserialize already returns str rather than unicode objects
+    native_str = False
+
     def serialize(self, data, **kwargs):
         ''' Serialize a dict to object '''
         raise NotImplementedError
@@ -64,6 +93,8 @@ class SerializerMixin(object):
 
 class TextSerializer(SerializerMixin):
 
+    native_str = True
+
     def deserialize(self, data, **kwargs):
         ''' Deserialize a text object and return a dict '''
         return str(data)
@@ -75,6 +106,8 @@ class TextSerializer(SerializerMixin):
 
 class YAMLSerializer(SerializerMixin):
 
+    native_str = True
+
     def __new__(cls):
         if not YAML_AVAILABLE:
             warnings.warn('Unable to import YAML', RuntimeWarning)
@@ -86,7 +119,7 @@ class YAMLSerializer(SerializerMixin):
         ''' Deserialize a YAML object and return a dict '''
 
         try:
-            return yaml.safe_load(data)
+            return yaml.load(data, Loader=YAMLLoader)
         except yaml.YAMLError:
             log.exception('Unable to deserialize YAML data')
             raise
@@ -95,9 +128,8 @@ class YAMLSerializer(SerializerMixin):
         ''' Serialize a dict object and return YAML '''
 
         try:
-            if safe_dump:
-                return yaml.safe_dump(data, default_flow_style=False)
-            return yaml.dump(data, default_flow_style=False)
+            dumper = YAMLSafeDumper if safe_dump else YAMLDumper
+            return yaml.dump(data, Dumper=dumper, default_flow_style=False)
         except yaml.YAMLError:
             log.exception('Unable to serialize YAML data')
             raise
@@ -156,7 +188,9 @@ class Serializer(object):
 
         try:
             handler = self.handlers.get(content_type, TextSerializer())
-            obj = self._convert_from_unicode(handler.deserialize(obj, **kwargs))
+            obj = handler.deserialize(obj, **kwargs)
+            if not handler.native_str:
+                obj = self._convert_from_unicode(obj)
             if cls:
                 obj = cls(**obj)    #pylint: disable=W0142
             return obj
@@ -0,0 +1,410 @@
+#
+# Copyright (c) 2014, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+import os
+import time
+import errno
+import signal
+import Queue
+import shutil
+import logging
+import threading
+import tempfile
+import SocketServer
+
+from wsgiref import simple_server
+from wsgiref.simple_server import make_server, WSGIServer
+
+import ztpserver.config
+import ztpserver.metrics
+
+from ztpserver.wsgiapp import FileWrapper
+
+try:
+    # optional, see INSTALL.md
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+log = logging.getLogger(__name__)   #pylint: disable=C0103
+
+SERVER_MODES = ['single', 'threads', 'prefork']
+
+
+class ServerHandler(simple_server.ServerHandler):
+    ''' Transmits :py:class:`FileWrapper` responses using sendfile if the
+    optional pysendfile package is installed, otherwise the file is sent by
+    iterating over it.
+    '''
+
+    wsgi_file_wrapper = FileWrapper
+
+    def sendfile(self):
+        if sendfile is None:
+            return False
+
+        try:
+            infd = self.result.file.fileno()
+            outfd = self.stdout.fileno()
+        except (AttributeError, IOError, ValueError):
+            return False
+
+        offset = self.result.offset
+        length = self.result.length
+        if length is None:
+            length = os.fstat(infd).st_size - offset
+
+        if not self.headers_sent:
+            self.send_headers()
+        self.stdout.flush()
+
+        while length > 0:
+            sent = sendfile(outfd, infd, offset, length)
+            if not sent:
+                break
+            offset += sent
+            length -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class WSGIRequestHandler(simple_server.WSGIRequestHandler):
+    ''' Request handler using :py:class:`ServerHandler` '''
+
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                                self.get_environ())
+        handler.request_handler = self      #pylint: disable=W0201
+        handler.run(self.server.get_app())
+
+
+class ThreadPoolMixIn:
+    ''' Handles requests using a bounded pool of worker threads.  Like
+    :py:class:`SocketServer.ThreadingMixIn` this is an old style class so
+    it can be mixed in with the SocketServer classes.
+
+    Accepted connections are queued for the workers.  Once the queue is
+    full the server stops accepting connections until a worker is
+    available, leaving further connections in the listen backlog.
+    '''
+
+    threads = 16
+    shutdown_timeout = 30
+
+    workers = None
+    requests = None
+
+    def start_workers(self):
+        ''' Starts the worker threads.  Workers are started separately from
+        the server so that pre-forked processes can start their own.
+        '''
+
+        self.requests = Queue.Queue(self.threads * 4)
+        self.workers = list()
+        for index in range(self.threads):
+            worker = threading.Thread(target=self.process_request_thread,
+                                      name='ztps-worker-%d' % index)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        log.debug('Started %d worker threads', self.threads)
+
+    def stop_workers(self):
+        ''' Waits up to shutdown_timeout seconds for the queued requests
+        to complete and stops the worker threads
+        '''
+
+        if not self.workers:
+            return
+
+        # the queue is bounded, so queueing the stop markers may block
+        # on busy workers and counts towards the shutdown timeout too
+        deadline = time.time() + self.shutdown_timeout
+        try:
+            for _ in self.workers:
+                self.requests.put(None, True, max(deadline - time.time(), 0))
+        except Queue.Full:
+            log.warning('Request queue still full after %d seconds',
+                        self.shutdown_timeout)
+
+        for worker in self.workers:
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                # workers are daemon threads and are abandoned
+                log.warning('Worker %s did not complete within %d seconds',
+                            worker.name, self.shutdown_timeout)
+        self.workers = None
+
+    def process_request_thread(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:       #pylint: disable=W0703
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if self.workers is None:
+            self.start_workers()
+        self.requests.put((request, client_address))
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.stop_workers()
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    ''' WSGI server handling requests with a pool of worker threads '''
+    pass
+
+
+class PreforkServer(object):
+    ''' Runs a number of worker processes that share the listening socket
+    of a bound server.   Worker processes that exit are restarted.  On
+    SIGTERM or SIGINT the workers are asked to complete their current
+    requests and are killed if they have not exited within the shutdown
+    timeout.
+
+    A worker that exits within min_lifetime seconds of being started is
+    restarted after a delay, which doubles with every consecutive early
+    exit up to max_restart_delay seconds, so a worker that cannot start
+    does not fork in a loop.
+
+    The workers serve their metrics to each other on unix sockets in a
+    temporary directory, so a scrape of /metrics handled by any worker
+    reports the totals of all of them.
+    '''
+
+    # how often a worker checks whether it has been asked to stop
+    poll_interval = 0.5
+
+    min_lifetime = 1
+    restart_delay = 0.5
+    max_restart_delay = 30
+
+    def __init__(self, httpd, workers, shutdown_timeout=30):
+        self.httpd = httpd
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        # pid of each worker process and the time it was started
+        self.children = dict()
+        self.running = False
+        self.metrics_dir = None
+        self.delay = 0
+
+    def __repr__(self):
+        return 'PreforkServer(workers=%d)' % self.workers
+
+    def stop(self, *args):
+        self.running = False
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.metrics_dir = tempfile.mkdtemp(prefix='ztps-metrics-')
+
+        self.running = True
+        try:
+            while self.running:
+                while self.running and len(self.children) < self.workers:
+                    self.spawn()
+                try:
+                    (pid, status) = os.wait()
+                except OSError as exc:
+                    if exc.errno != errno.EINTR:
+                        raise
+                    continue
+                started = self.children.pop(pid, None)
+                if self.running and started is not None:
+                    self.restarted(pid, status, time.time() - started)
+        finally:
+            self.shutdown()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            log.debug('Started worker process %d', pid)
+            self.children[pid] = time.time()
+            return
+
+        status = 0
+        try:
+            self.run_worker()
+        except Exception:       #pylint: disable=W0703
+            log.exception('Unexpected error in worker process')
+            status = 1
+        finally:
+            os._exit(status)     #pylint: disable=W0212
+
+    def restarted(self, pid, status, lifetime):
+        ''' Logs the exit of a worker and waits before it is restarted if
+        it exited too soon after being started
+        '''
+
+        if os.WIFSIGNALED(status):
+            reason = 'was killed by signal %d' % os.WTERMSIG(status)
+        else:
+            reason = 'exited with status %d' % os.WEXITSTATUS(status)
+
+        if lifetime >= self.min_lifetime:
+            self.delay = 0
+            log.warning('Worker %d %s, restarting', pid, reason)
+            return
+
+        self.delay = min(max(self.delay * 2, self.restart_delay),
+                         self.max_restart_delay)
+        log.warning('Worker %d %s after %.2f seconds, restarting in %.1f '
+                    'seconds', pid, reason, lifetime, self.delay)
+        # interrupted by SIGTERM and SIGINT
+        time.sleep(self.delay)
+
+    def run_worker(self):
+        ''' Serves requests until the worker is asked to stop '''
+
+        self.children = dict()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        self.httpd.timeout = self.poll_interval
+        if isinstance(self.httpd, ThreadPoolMixIn):
+            self.httpd.start_workers()
+
+        if self.metrics_dir is not None:
+            ztpserver.metrics.start_exporter(self.metrics_dir)
+        try:
+            while self.running:
+                self.httpd.handle_request()
+        finally:
+            ztpserver.metrics.stop_exporter()
+        self.httpd.server_close()
+
+    def shutdown(self):
+        ''' Stops all worker processes and closes the listening socket '''
+
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.shutdown_timeout
+        while self.children and time.time() < deadline:
+            try:
+                (pid, _) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+
+        for pid in self.children:
+            log.warning('Worker %d did not exit within %d seconds',
+                        pid, self.shutdown_timeout)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        self.children = dict()
+        self.httpd.server_close()
+
+        if self.metrics_dir is not None:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+            self.metrics_dir = None
+
+
+def create_server(host, port, app, threads=1, shutdown_timeout=30):
+    ''' Returns a bound WSGI server for app.  If threads is greater than 1
+    requests are handled by a pool of that many worker threads.
+    '''
+
+    if threads > 1:
+        httpd = make_server(host, port, app,
+                            server_class=ThreadPoolWSGIServer,
+                            handler_class=WSGIRequestHandler)
+        httpd.threads = threads
+        httpd.shutdown_timeout = shutdown_timeout
+    else:
+        httpd = make_server(host, port, app,
+                            handler_class=WSGIRequestHandler)
+    return httpd
+
+
+def _terminate(*args):
+    raise SystemExit()
+
+def serve(app, host=None, port=None):
+    ''' Runs app using the mode configured in the [server] section of the
+    runtime config.   This function blocks until the server is stopped.
+    '''
+
+    config = ztpserver.config.runtime.server
+    host = host or config.interface
+    port = port or config.port
+
+    threads = config.threads if config.mode != 'single' else 1
+    httpd = create_server(host, port, app, threads, config.shutdown_timeout)
+
+    log.info('Starting server on http://%s:%s (mode=%s, workers=%d, '
+             'threads=%d)', host, port, config.mode,
+             config.workers if config.mode == 'prefork' else 1, threads)
+
+    if config.mode == 'prefork':
+        PreforkServer(httpd, config.workers,
+                      config.shutdown_timeout).serve_forever()
+        return
+
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
@@ -33,12 +33,19 @@
 # pylint: disable=W0614,C0103,W0142
 #
 import collections
+import hashlib
+import json
 import logging
 import re
 import string # pylint: disable=W0402
+import threading
+import time
+import weakref
+
+import ztpserver.metrics
 
 from ztpserver.serializers import Serializer
-from ztpserver.utils import expand_range
+from ztpserver.utils import parse_range, maximum_matching
 
 ANY_DEVICE_PARSER_RE = re.compile(r':(?=[any])')
 NONE_DEVICE_PARSER_RE = re.compile(r':(?=[none])')
@@ -80,34 +87,127 @@ class OrderedCollection(collections.OrderedDict):
 
 
 class Function(object):
+    __slots__ = ('value', '__weakref__')
+
     def __init__(self, value):
         self.value = value
 
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.value)
+
+    def __reduce__(self):
+        # unpickled functions are shared through intern_function
+        return (intern_function, (_FUNCTION_KINDS[type(self)], self.value))
+
     def match(self, arg):
         raise NotImplementedError
 
 
 class IncludesFunction(Function):
+    __slots__ = ()
+
     def match(self, arg):
         return self.value in arg
 
 
 class ExcludesFunction(Function):
+    __slots__ = ()
+
     def match(self, arg):
         return self.value not in arg
 
 
 class RegexFunction(Function):
+    __slots__ = ('regex',)
+
+    def __init__(self, value):
+        super(RegexFunction, self).__init__(value)
+        self.regex = re.compile(value)
+
     def match(self, arg):
-        match = re.match(self.value, arg)
-        return match is not None
+        return self.regex.match(arg) is not None
 
 
 class ExactFunction(Function):
+    __slots__ = ()
+
     def match(self, arg):
         return arg == self.value
 
 
+class RangeFunction(Function):
+    ''' Matches interface names against a range expression such as
+    Ethernet1-48,49/1-4 without expanding it '''
+
+    __slots__ = ('ranges',)
+
+    def __init__(self, value):
+        super(RangeFunction, self).__init__(value)
+        self.ranges = parse_range(value)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def match(self, arg):
+        return arg in self.ranges
+
+
+FUNCTIONS = {
+    'exact': ExactFunction,
+    'includes': IncludesFunction,
+    'excludes': ExcludesFunction,
+    'regex': RegexFunction
+}
+
+# range functions are only created for interface names and are not
+# available as neighbordb functions
+_FUNCTION_TYPES = dict(FUNCTIONS, range=RangeFunction)
+_FUNCTION_KINDS = dict((v, k) for (k, v) in _FUNCTION_TYPES.items())
+
+# Function instances are immutable so identical matchers are shared
+# across every interface pattern in the process
+_functions = weakref.WeakValueDictionary()
+
+def intern_function(kind, value):
+    ''' Returns the shared :py:class:`Function` instance of type kind for
+    value, creating it if it does not exist.
+
+    :raises: KeyError if kind is not a known function
+    :raises: re.error if a regex function value cannot be compiled
+    :raises: TypeError if a range function value cannot be parsed
+    '''
+
+    key = (kind, value)
+    function = _functions.get(key)
+    if function is None:
+        function = _FUNCTION_TYPES[kind](value)
+        _functions[key] = function
+    return function
+
+
+def _normalize(obj):
+    ''' Returns obj with dicts replaced by sorted tuples of their items and
+    lists replaced by tuples '''
+
+    kind = type(obj)
+    if kind is dict:
+        return tuple([(k, _normalize(v)) if type(v) in (dict, list)
+                      else (k, v) for (k, v) in sorted(obj.iteritems())])
+    elif kind is list:
+        return tuple([_normalize(v) if type(v) in (dict, list) else v
+                      for v in obj])
+    return obj
+
+def pattern_digest(entry):
+    ''' Returns the sha1 digest of a neighbordb pattern entry.  Entries
+    with the same contents have the same digest regardless of key order.
+    '''
+
+    # hashing the repr of the normalized entry is about twice as fast as
+    # serializing it with json.dumps(sort_keys=True)
+    return hashlib.sha1(repr(_normalize(entry))).hexdigest()
+
+
 Neighbor = collections.namedtuple('Neighbor', ['device', 'port'])
 
 
@@ -172,13 +272,106 @@ class Node(object):
         return result
 
 
+class PatternIndex(object):
+    ''' Indexes global patterns by the exact interface, device and port
+    names they require from a node.  Patterns whose requirements are not
+    present in a node's LLDP neighbors are pruned before any of their
+    interface patterns are evaluated.  Candidates are always returned in
+    the order the patterns were added.
+    '''
+
+    def __init__(self):
+        self.entries = list()
+        self.anchors = dict()
+        self.unanchored = list()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, pattern):
+        position = len(self.entries)
+        constraints = pattern.constraints()
+        self.entries.append((constraints, pattern))
+
+        # device names are the most selective requirement so they are
+        # preferred as the anchor (('device', ...) sorts first)
+        if constraints:
+            anchor = min(constraints)
+            self.anchors.setdefault(anchor, list()).append(position)
+        else:
+            self.unanchored.append(position)
+
+    @staticmethod
+    def node_tokens(node):
+        tokens = set()
+        for interface, neighbors in node.neighbors.items():
+            tokens.add(('interface', interface))
+            for neighbor in neighbors:
+                tokens.add(('device', neighbor.device))
+                tokens.add(('port', neighbor.port))
+        return tokens
+
+    def candidates(self, node):
+        tokens = self.node_tokens(node)
+
+        positions = list(self.unanchored)
+        for token in tokens:
+            if token in self.anchors:
+                positions.extend(self.anchors[token])
+        positions.sort()
+
+        result = list()
+        for position in positions:
+            constraints, pattern = self.entries[position]
+            if constraints.issubset(tokens):
+                result.append(pattern)
+        return result
+
+
 class Topology(object):
+    ''' The compiled neighbordb patterns.
+
+    The results of match_node are memoized in a bounded LRU cache keyed
+    on the neighbors of the node (and its systemmac if there is a node
+    specific pattern for it), so nodes with identical neighbors are only
+    matched once.  The cache belongs to the instance and is discarded
+    along with it when neighbordb is reloaded.
+    '''
 
     RESERVED_VARIABLES = ['any', 'none']
 
+    # maximum number of match_node results kept
+    MATCH_CACHE_SIZE = 4096
+
     def __init__(self, **kwargs):
         self.variables = kwargs.get('variables', dict())
         self.patterns = {'globals': list(), 'nodes': dict()}
+        self.index = PatternIndex()
+        self.init_match_cache()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['match_cache', 'match_lock', 'match_hits',
+                    'match_misses']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_match_cache()
+
+    def init_match_cache(self):
+        self.match_cache = collections.OrderedDict()
+        self.match_lock = threading.Lock()
+        self.match_hits = 0
+        self.match_misses = 0
+
+    def match_stats(self):
+        ''' Returns a dict of the match_node cache statistics '''
+
+        return dict(entries=len(self.match_cache), hits=self.match_hits,
+                    misses=self.match_misses,
+                    maxsize=self.MATCH_CACHE_SIZE)
 
     def __repr__(self):
         return 'Topology(variables=%d, globals=%d, nodes=%d)' % \
@@ -209,6 +402,12 @@ class Topology(object):
     def add_pattern(self, name, **kwargs):
 
         try:
+            # the digest identifies the pattern entry as it appears in
+            # neighbordb, so it is taken before any defaults are added
+            parsed = kwargs.pop('parsed_interfaces', None)
+            digest = kwargs.pop('digest', None) or \
+                     pattern_digest(dict(kwargs, name=name))
+
             kwargs['node'] = kwargs.get('node')
             kwargs['definition'] = kwargs.get('definition')
             kwargs['interfaces'] = kwargs.get('interfaces', list())
@@ -217,16 +416,21 @@ class Topology(object):
             for key in set(self.variables).difference(kwargs['variables']):
                 kwargs['variables'][key] = self.variables[key]
 
-            pattern = Pattern(name, **kwargs)
+            # interfaces parsed while validating the pattern are added
+            # without parsing them again
+            if parsed is not None:
+                pattern = Pattern(name, **dict(kwargs, interfaces=None))
+                for item in parsed:
+                    pattern.append_interface(*item)
+                pattern.variable_substitution()
+            else:
+                pattern = Pattern(name, **kwargs)
+            pattern.digest = digest
 
             log.info('Pattern \'%s\' parsed successfully', pattern.name)
             log.debug('%r', pattern)
 
-            # Add pattern to topology
-            if kwargs['node'] is not None:
-                self.patterns['nodes'][pattern.node] = pattern
-            else:
-                self.patterns['globals'].append(pattern)
+            self.insert_pattern(pattern)
         except KeyError:
             log.error('Unable to add pattern \'%s\' due to missing attributes',
                       pattern.get('name'))
@@ -238,6 +442,18 @@ class Topology(object):
             log.exception('Unexpected exception during add_pattern')
             raise TopologyError
 
+    def insert_pattern(self, pattern):
+        ''' Adds a compiled pattern to the topology '''
+
+        with self.match_lock:
+            self.match_cache.clear()
+
+        if pattern.node is not None:
+            self.patterns['nodes'][pattern.node] = pattern
+        else:
+            self.patterns['globals'].append(pattern)
+            self.index.add(pattern)
+
     def add_patterns(self, patterns, continue_on_error=True):
         for pattern in patterns:
             try:
@@ -269,10 +485,48 @@ class Topology(object):
             log.info('Eligible pattern: %s', pattern.name)
             return [pattern]
         except KeyError:
-            log.info('Eligible patterns: all global patterns')
-            return self.get_patterns(predicate=self.isglobalpattern)
+            patterns = self.index.candidates(node)
+            log.info('Eligible patterns: %d of %d global patterns',
+                     len(patterns), len(self.index))
+            return patterns
+
+    def fingerprint(self, node):
+        ''' Returns the key of node in the match_node cache '''
+
+        neighbors = tuple(sorted((interface, tuple(peers))
+                                 for (interface, peers)
+                                 in node.neighbors.items()))
+        if node.systemmac in self.patterns['nodes']:
+            return (node.systemmac, neighbors)
+        return (None, neighbors)
 
     def match_node(self, node):
+        ''' Returns the list of patterns node matches, in order '''
+
+        start = time.time()
+        key = self.fingerprint(node)
+        with self.match_lock:
+            result = self.match_cache.pop(key, None)
+            if result is not None:
+                self.match_cache[key] = result
+                self.match_hits += 1
+                ztpserver.metrics.observe('topology', 'match',
+                                          time.time() - start)
+                return list(result)
+
+        result = self.evaluate_node(node)
+
+        with self.match_lock:
+            self.match_misses += 1
+            self.match_cache[key] = tuple(result)
+            while len(self.match_cache) > self.MATCH_CACHE_SIZE:
+                self.match_cache.popitem(last=False)
+        ztpserver.metrics.observe('topology', 'match', time.time() - start)
+        return result
+
+    def evaluate_node(self, node):
+        ''' Matches node against every eligible pattern '''
+
         try:
             result = list()
             for pattern in self.find_patterns(node):
@@ -296,6 +550,9 @@ class Pattern(object):
         self.name = name
         self.definition = definition
 
+        # digest of the neighbordb entry the pattern was compiled from
+        self.digest = None
+
         self.node = node
         self.variables = variables or dict()
 
@@ -313,17 +570,38 @@ class Pattern(object):
             log.info('Checking pattern entries for variable substitution')
             for entry in self.interfaces:
                 for item in entry['patterns']:
+                    substituted = False
                     for attr in ['device', 'port']:
                         value = getattr(item, attr)
                         if value.startswith('$'):
                             newvalue = self.variables[value[1:]]
                             setattr(item, attr, newvalue)
-                    item.refresh()
+                            substituted = True
+                    if substituted:
+                        item.refresh()
             log.info('Variable substitution is complete')
         except KeyError:
             log.error('Variable substitution failed due to unknown variable')
             raise PatternError
 
+    def constraints(self):
+        ''' Returns the set of exact (kind, name) tokens that a node must
+        present in its neighbors in order to match this pattern.  Only
+        interface patterns that are not wildcards are considered since
+        those are the only ones that must be matched.
+        '''
+
+        constraints = set()
+        for entry in self.interfaces:
+            for item in entry['patterns']:
+                if item.is_wildcard():
+                    continue
+                for kind in ['interface', 'device', 'port']:
+                    function = getattr(item, '%s_re' % kind)
+                    if isinstance(function, ExactFunction):
+                        constraints.add((kind, function.value))
+        return frozenset(constraints)
+
     def serialize(self):
         try:
             data = dict(name=self.name, definition=self.definition)
@@ -350,16 +628,10 @@ class Pattern(object):
             for key, value in interface.items():
                 (interface, device, port) = self.parse_interface(key, value)
 
-                metadata = dict(interface=interface, neighbors=value)
-                if interface in ['none', 'any']:
-                    patterns = [InterfacePattern(interface, device, port)]
-                else:
-                    patterns = list()
-                    for item in expand_range(interface):
-                        pattern = InterfacePattern(item, device, port)
-                        patterns.append(pattern)
-                self.interfaces.append(dict(metadata=metadata,
-                                            patterns=patterns))
+                if interface not in ['none', 'any']:
+                    # raises TypeError if the interface range is invalid
+                    parse_range(interface)
+                self.append_interface(interface, device, port, value)
 
         except ValueError:
             log.error('Unable to parse interface \'%s\'', key)
@@ -371,6 +643,16 @@ class Pattern(object):
             log.exception('Unexpected error trying to execute add_interface')
             raise PatternError
 
+    def append_interface(self, interface, device, port, neighbors):
+        ''' Adds an interface pattern that has already been parsed
+
+        :raises: InterfacePatternError
+        '''
+
+        metadata = dict(interface=interface, neighbors=neighbors)
+        patterns = [InterfacePattern(interface, device, port)]
+        self.interfaces.append(dict(metadata=metadata, patterns=patterns))
+
     def add_interfaces(self, interfaces, continue_on_error=False):
         try:
             for interface in interfaces:
@@ -421,6 +703,20 @@ class Pattern(object):
             raise PatternError
 
     def match_node(self, node):
+        ''' Returns True if the node matches this pattern.
+
+        A compatibility graph is built between the node's interfaces and
+        the pattern's interface patterns, and a maximum bipartite matching
+        is computed over it.  The node matches when:
+
+            * every interface pattern that is not a wildcard is matched
+              to one of the node's interfaces, and
+            * every interface pattern that accepts an interface name but
+              rejects the neighbors on it (for instance ``Ethernet1: none``
+              when Ethernet1 has a neighbor) is consumed by another
+              interface of the node.
+
+        '''
 
         log.info('Attempting to match node %s', node.systemmac)
 
@@ -429,33 +725,86 @@ class Pattern(object):
             for entry in self.interfaces:
                 for pattern in entry['patterns']:
                     patterns.append(pattern)
-            matches = list()
+
+            # interface patterns for a named interface only need to be
+            # evaluated against that interface.  Each interface in a range
+            # is a separate (index, interface) vertex in the graph.
+            named = dict()
+            ranged = list()
+            generic = list()
+            for index, pattern in enumerate(patterns):
+                if pattern.interface == 'none':
+                    continue
+                elif isinstance(pattern.interface_re, ExactFunction):
+                    named.setdefault(pattern.interface_re.value,
+                                     list()).append(index)
+                elif isinstance(pattern.interface_re, RangeFunction):
+                    ranged.append(index)
+                else:
+                    generic.append(index)
+
+            required = collections.OrderedDict()
+            optional = collections.OrderedDict()
+            claims = collections.OrderedDict()
 
             for interface, neighbors in node.neighbors.items():
-                matched_index = None
-                for index, pattern in enumerate(patterns):
+                required[interface] = list()
+                optional[interface] = list()
+
+                indexes = named.get(interface, list()) + generic
+                indexes.extend([i for i in ranged
+                                if patterns[i].interface_re.match(interface)])
+
+                for index in sorted(indexes):
+                    pattern = patterns[index]
+                    vertex = index
+                    if isinstance(pattern.interface_re, RangeFunction):
+                        vertex = (index, interface)
+
                     try:
-                        if pattern.match(interface, neighbors):
-                            matched_index = index
-                            break
+                        if not pattern.match(interface, neighbors):
+                            continue
                     except InterfacePatternError:
-                        log.warning('Interface %s matched but neighbors were '
-                                    'invalid', interface)
-                        return False
+                        log.debug('Interface %s matched %r but neighbors '
+                                  'were invalid', interface, pattern)
+                        claims.setdefault(vertex, list()).append(interface)
+                        continue
+
+                    if pattern.is_wildcard():
+                        optional[interface].append(vertex)
+                    else:
+                        required[interface].append(vertex)
+
+            matches = maximum_matching(required)
 
-                if matched_index is not None:
-                    log.debug('Removing pattern %r from available patterns',
-                              patterns[matched_index])
-                    matches.append(patterns[matched_index])
-                    del patterns[matched_index]
-                if matched_index is None:
-                    log.warning('Pattern was not matched')
-
-            for pattern in patterns:
-                log.debug('Checking remaining patterns for positive contraint')
-                if not pattern.is_wildcard():
+            counts = collections.defaultdict(int)
+            for vertex in matches.values():
+                counts[vertex[0] if isinstance(vertex, tuple) else vertex] += 1
+
+            for index, pattern in enumerate(patterns):
+                if pattern.is_wildcard():
+                    continue
+                if counts[index] < pattern.slots():
                     log.debug('pattern %s has positive contraint', pattern)
                     return False
+
+            if claims:
+                # wildcard patterns that rejected the neighbors on an
+                # interface must be consumed by one of the remaining ones
+                remaining = collections.OrderedDict()
+                for interface, vertices in optional.items():
+                    if interface not in matches:
+                        remaining[interface] = [v for v in vertices
+                                                if v in claims]
+                matched = set(matches.values())
+                matched.update(maximum_matching(remaining).values())
+
+                for vertex, interfaces in claims.items():
+                    if vertex not in matched:
+                        log.warning('Interface %s matched but neighbors '
+                                    'were invalid', interfaces[0])
+                        return False
+
             return True
 
         except Exception:
@@ -466,16 +815,11 @@ class Pattern(object):
 class InterfacePattern(object):
 
     KEYWORDS = {
-        'any': RegexFunction('.*'),
-        'none': RegexFunction('[^a-zA-Z0-9]')
+        'any': intern_function('regex', '.*'),
+        'none': intern_function('regex', '[^a-zA-Z0-9]')
     }
 
-    FUNCTIONS = {
-        'exact': ExactFunction,
-        'includes': IncludesFunction,
-        'excludes': ExcludesFunction,
-        'regex': RegexFunction
-    }
+    FUNCTIONS = FUNCTIONS
 
     def __init__(self, interface, device, port):
 
@@ -483,7 +827,7 @@ class InterfacePattern(object):
         self.device = device
         self.port = port
 
-        self.interface_re = self.compile(interface)
+        self.interface_re = self.compile_interface(interface)
         self.device_re = self.compile(device)
         self.port_re = self.compile(port)
 
@@ -492,10 +836,32 @@ class InterfacePattern(object):
                 (self.interface, self.device, self.port)
 
     def refresh(self):
-        self.interface_re = self.compile(self.interface)
+        self.interface_re = self.compile_interface(self.interface)
         self.device_re = self.compile(self.device)
         self.port_re = self.compile(self.port)
 
+    def slots(self):
+        ''' Returns the number of node interfaces this pattern matches,
+        which is the size of the range for interface ranges '''
+
+        if isinstance(self.interface_re, RangeFunction):
+            return len(self.interface_re)
+        return 1
+
+    def compile_interface(self, value):
+        ''' Compiles the interface name.  Range expressions are compiled
+        to a :py:class:`RangeFunction` instead of being expanded. '''
+
+        if (',' in value or '-' in value) and not FUNC_RE.match(value):
+            try:
+                function = intern_function('range', value)
+                if len(function) != 1:
+                    return function
+                return intern_function('exact', next(iter(function.ranges)))
+            except TypeError:
+                log.debug('Interface %s is not a range', value)
+        return self.compile(value)
+
     def match(self, interface, neighbors):
         log.debug('%r', self)
         log.debug('match interface: %s, neighbors: %s', interface, neighbors)
@@ -511,7 +877,7 @@ class InterfacePattern(object):
             match_neighbors = False
 
         if match_interface and not match_neighbors:
-            log.warning('Interface matches but neighbors are invalid')
+            log.debug('Interface matches but neighbors are invalid')
             raise InterfacePatternError
 
         return match_interface and match_neighbors
@@ -520,18 +886,24 @@ class InterfacePattern(object):
         if value in self.KEYWORDS:
             return self.KEYWORDS[value]
 
+        match = FUNC_RE.match(value)
+        if match:
+            function = match.group('function')
+            arg = match.group('arg')
+            log.debug('Found function %s with arg %s', function, arg)
+        else:
+            function, arg = 'exact', value
+
         try:
-            match = FUNC_RE.match(value)
-            if match:
-                function = match.group('function')
-                arg = match.group('arg')
-                log.debug('Found function %s with arg %s', function, arg)
-                return self.FUNCTIONS[function](arg)
-            else:
-                return ExactFunction(value)
+            if function not in self.FUNCTIONS:
+                raise KeyError(function)
+            return intern_function(function, arg)
         except KeyError:
             log.error('Unknown function \'%s\'', function)
             raise InterfacePatternError
+        except re.error:
+            log.error('Invalid regular expression \'%s\'', arg)
+            raise InterfacePatternError
 
     def match_neighbors(self, neighbors):
         for neighbor in neighbors:
@@ -570,9 +942,91 @@ class InterfacePattern(object):
                self.device in ['any', 'none']
 
 
+def _native(obj):
+    ''' Returns obj with the unicode strings decoded from JSON converted
+    to str where possible, the same as they are loaded from YAML '''
 
+    kind = type(obj)
+    if kind is unicode:
+        try:
+            return obj.encode('ascii')
+        except UnicodeError:
+            return obj
+    elif kind is list:
+        return [_native(item) for item in obj]
+    elif kind is dict:
+        return dict([(_native(k), _native(v)) for (k, v) in obj.iteritems()])
+    return obj
+
+def dump_compiled(topology):
+    ''' Returns the compiled topology serialized to JSON, which is loaded
+    again with :py:func:`load_compiled`.  Interface patterns are stored
+    along with the kind and value of the functions they were compiled to,
+    so they are not parsed again when loaded.
+
+    :raises: TopologyError if the topology contains values that do not
+             round trip through JSON (for instance non string keys)
+    '''
 
+    def function(obj):
+        return [_FUNCTION_KINDS[type(obj)], obj.value]
+
+    patterns = list()
+    for pattern in topology.get_patterns(lambda _: True):
+        interfaces = list()
+        for entry in pattern.interfaces:
+            items = [[item.interface, item.device, item.port,
+                      function(item.interface_re), function(item.device_re),
+                      function(item.port_re)]
+                     for item in entry['patterns']]
+            interfaces.append([entry['metadata'], items])
+        patterns.append(dict(name=pattern.name, node=pattern.node,
+                             definition=pattern.definition,
+                             variables=pattern.variables,
+                             digest=pattern.digest,
+                             interfaces=interfaces))
+
+    data = dict(variables=topology.variables, patterns=patterns)
+    try:
+        contents = json.dumps(data, separators=(',', ':'))
+        if _native(json.loads(contents)) != data:
+            raise ValueError('topology does not round trip through JSON')
+    except (TypeError, ValueError) as exc:
+        log.warning('Unable to serialize topology: %s', exc)
+        raise TopologyError
+    return contents
+
+def load_compiled(contents):
+    ''' Returns the :py:class:`Topology` for contents returned by
+    :py:func:`dump_compiled`.  The contents are only ever loaded into
+    patterns and functions, they are never executed.
+
+    :raises: TopologyError if contents is not a compiled topology
+    '''
 
-
-
-
+    try:
+        data = _native(json.loads(contents))
+        topology = Topology(variables=data['variables'])
+        for item in data['patterns']:
+            pattern = Pattern(item['name'], definition=item['definition'],
+                              node=item['node'], variables=item['variables'])
+            pattern.digest = item['digest']
+            for (metadata, items) in item['interfaces']:
+                patterns = list()
+                for (interface, device, port, interface_re, device_re,
+                     port_re) in items:
+                    obj = InterfacePattern.__new__(InterfacePattern)
+                    obj.interface = interface
+                    obj.device = device
+                    obj.port = port
+                    obj.interface_re = intern_function(*interface_re)
+                    obj.device_re = intern_function(*device_re)
+                    obj.port_re = intern_function(*port_re)
+                    patterns.append(obj)
+                pattern.interfaces.append(dict(metadata=metadata,
+                                               patterns=patterns))
+            topology.insert_pattern(pattern)
+        return topology
+    except (KeyError, TypeError, ValueError, re.error):
+        log.warning('Invalid compiled topology')
+        raise TopologyError
@@ -30,6 +30,8 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 import re
+import bisect
+import collections
 
 def atoi(text):
     return int(text) if text.isdigit() else text
@@ -37,8 +39,72 @@ def atoi(text):
 def natural_keys(text):
     return [atoi(c) for c in re.split(r'(\d+)', text)]
 
-def expand_range(text, match_prefix=None, replace_prefix=None):
-    ''' Returns a naturally sorted list of items expanded from text. '''
+RANGE_TOKEN_RE = re.compile(r'^(?P<prefix>(?:\d+/)*)(?P<start>\d+)'
+                            r'(?:-(?P<end>\d+))?$')
+NAME_RE = re.compile(r'^(?P<prefix>.*?)(?P<index>\d+)$')
+
+class RangeSet(object):
+    ''' A compact set of interface names built from a range expression
+    such as ``Ethernet1-48,49/1-4``.
+
+    Names are stored as sorted, merged integer intervals per prefix
+    (``Ethernet`` and ``Ethernet49/`` in the example above) so membership
+    is tested in O(log n) without materializing every name.
+    '''
+
+    __slots__ = ('ranges', 'size')
+
+    def __init__(self, intervals):
+        self.ranges = dict()
+        self.size = 0
+
+        for prefix, items in intervals.items():
+            starts, ends = list(), list()
+            for start, end in sorted(items):
+                if starts and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.ranges[prefix] = (starts, ends)
+            self.size += sum(e - s + 1 for s, e in zip(starts, ends))
+
+    def __repr__(self):
+        items = list()
+        for prefix in sorted(self.ranges, key=natural_keys):
+            for start, end in zip(*self.ranges[prefix]):
+                items.append('%s%d-%d' % (prefix, start, end))
+        return 'RangeSet(%s)' % ','.join(items)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for prefix in sorted(self.ranges, key=natural_keys):
+            for start, end in zip(*self.ranges[prefix]):
+                for index in range(start, end + 1):
+                    yield '%s%d' % (prefix, index)
+
+    def __contains__(self, name):
+        match = NAME_RE.match(name)
+        if not match or match.group('index')[0] == '0':
+            return False
+
+        try:
+            starts, ends = self.ranges[match.group('prefix')]
+        except KeyError:
+            return False
+
+        index = int(match.group('index'))
+        position = bisect.bisect_right(starts, index) - 1
+        return position >= 0 and index <= ends[position]
+
+def parse_range(text, match_prefix=None, replace_prefix=None):
+    ''' Returns a :py:class:`RangeSet` for a range expression such as
+    ``Ethernet1-48,49/1-4``.
+
+    :raises: TypeError if the expression cannot be parsed
+    '''
 
     match_prefix = match_prefix or '[a-zA-Z]'
     prefix_match_re = r'^(?P<prefix>%s+)(?=\d)' % match_prefix
@@ -46,33 +112,84 @@ def expand_range(text, match_prefix=None, replace_prefix=None):
 
     if not match:
         raise TypeError('unable to match prefix: %s' % text)
-    elif match and not replace_prefix:
-        prefix = match.group('prefix')
-    elif match and replace_prefix:
-        prefix = replace_prefix
 
-    indicies_re = re.compile(r'\d+')
+    prefix = replace_prefix or match.group('prefix')
 
-    indicies_re = re.compile(r'[Ethernet|,](\d+)(?!-)')
-    range_re = re.compile(r'(\d+)\-(\d+)')
+    intervals = dict()
+    for token in text[match.end():].split(','):
+        token = token.strip()
+        match = RANGE_TOKEN_RE.match(token)
+        if not match:
+            raise TypeError('unable to parse range: %s' % text)
 
-    indicies = indicies_re.findall(text)
-    ranges = range_re.findall(text)
+        start = int(match.group('start'))
+        end = int(match.group('end') or start)
+        if start > end:
+            raise TypeError('invalid range: %s' % text)
 
-    items = set()
+        key = '%s%s' % (prefix, match.group('prefix'))
+        intervals.setdefault(key, list()).append((start, end))
 
-    for start, end in ranges:
-        start = int(start)
-        end = int(end) + 1
-        for index in range(start, end):
-            items.add('%s%s' % (prefix, index))
+    return RangeSet(intervals)
 
-    for index in indicies:
-        items.add('%s%s' % (prefix, index))
+def expand_range(text, match_prefix=None, replace_prefix=None):
+    ''' Returns a naturally sorted list of items expanded from text. '''
 
-    items = list(items)
+    items = list(parse_range(text, match_prefix, replace_prefix))
     items.sort(key=natural_keys)
     return items
 
+def maximum_matching(graph):
+    ''' Returns a maximum matching of a bipartite graph as a dict mapping
+    left vertices to right vertices.
+
+    The graph is a mapping of each left vertex to an ordered list of the
+    right vertices it is connected to.  The matching is computed using the
+    Hopcroft-Karp algorithm in O(E * sqrt(V)).  Vertices are visited in
+    iteration order so the result is deterministic for an ordered graph.
+    '''
+
+    left = list(graph)
+    match_left = dict()
+    match_right = dict()
+
+    def bfs():
+        dist = dict()
+        queue = collections.deque()
+        for vertex in left:
+            if vertex not in match_left:
+                dist[vertex] = 0
+                queue.append(vertex)
+
+        found = False
+        while queue:
+            vertex = queue.popleft()
+            for other in graph[vertex]:
+                mate = match_right.get(other)
+                if mate is None:
+                    found = True
+                elif mate not in dist:
+                    dist[mate] = dist[vertex] + 1
+                    queue.append(mate)
+        return found, dist
+
+    def dfs(vertex, dist):
+        for other in graph[vertex]:
+            mate = match_right.get(other)
+            if mate is None or \
+               (dist.get(mate) == dist[vertex] + 1 and dfs(mate, dist)):
+                match_left[vertex] = other
+                match_right[other] = vertex
+                return True
+        dist[vertex] = None
+        return False
 
+    while True:
+        found, dist = bfs()
+        if not found:
+            break
+        for vertex in left:
+            if vertex not in match_left:
+                dfs(vertex, dist)
 
+    return match_left
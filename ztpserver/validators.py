@@ -33,12 +33,16 @@
 
 import string
 import re
+import time
+import math
 import inspect
 import logging
+import itertools
 import collections
+import multiprocessing
 
-from ztpserver.topology import Pattern, PatternError
-from ztpserver.utils import expand_range
+from ztpserver.topology import Pattern, PatternError, TopologyError
+from ztpserver.topology import pattern_digest, intern_function
 
 REQUIRED_PATTERN_ATTRIBUTES = ['name']
 OPTIONAL_PATTERN_ATTRIBUTES = ['definition', 'interfaces', 'node', 'variables']
@@ -62,6 +66,9 @@ INVALID_INTERFACE_PATTERNS = [(KW_ANY_RE, KW_ANY_RE, KW_NONE_RE),
 
 log = logging.getLogger(__name__)   #pylint: disable=C0103
 
+# validate_* method names of each Validator class
+_validators = dict()
+
 class ValidationError(Exception):
     ''' Base error class for validation failures '''
     pass
@@ -75,25 +82,56 @@ class Validator(object):
 
     def validate(self, data):
         self.data = data
-        methods = inspect.getmembers(self, predicate=inspect.ismethod)
-        for name in methods:
-            if name[0].startswith('validate_'):
-                try:
-                    getattr(self, name[0])()
-                except ValidationError as exc:
-                    self.error(exc)
+        for name in self.validators():
+            try:
+                getattr(self, name)()
+            except ValidationError as exc:
+                self.error(exc)
         return not self.fail
 
+    @classmethod
+    def validators(cls):
+        ''' Returns the sorted names of the validate_* methods of cls.
+        The names are looked up once per class.
+        '''
+
+        names = _validators.get(cls)
+        if names is None:
+            methods = inspect.getmembers(cls, predicate=inspect.ismethod)
+            names = [name for (name, _) in methods
+                     if name.startswith('validate_')]
+            _validators[cls] = names
+        return names
+
     def error(self, msg, *args, **kwargs):
         #pylint: disable=W0613
         log.error(msg, *args)
         self.fail = True
 
 class TopologyValidator(Validator):
+    ''' Validates the contents of neighbordb.  If a topology is given,
+    every valid pattern is also added to it as soon as it is validated
+    so the patterns are only parsed once.  Otherwise, if jobs is greater
+    than one, the patterns are validated by a pool of jobs processes.
 
-    def __init__(self):
+    If the previous topology compiled from neighbordb is also given, the
+    compiled patterns of entries that have not changed since are added
+    to the topology as they are instead of validating and compiling them
+    again.  Patterns are only reused if the global variables are the same.
+
+    The time spent validating each pattern is kept in timings, keyed on
+    the same (index, name) tuples as valid_patterns and failed_patterns.
+    '''
+
+    def __init__(self, topology=None, jobs=1, previous=None):
         self.failed_patterns = set()
         self.valid_patterns = set()
+        self.timings = dict()
+        self.topology = topology
+        self.jobs = jobs
+        self.previous = previous
+        self.reusable = dict()
+        self.reused = 0
         super(TopologyValidator, self).__init__()
 
     def validate_variables(self):
@@ -106,16 +144,31 @@ class TopologyValidator(Validator):
         if not self.data.get('patterns'):
             raise ValidationError('missing required \'patterns\' attribute')
 
-        for index, entry in enumerate(self.data.get('patterns')):
+        # global variables must be known before any pattern is compiled
+        variables = self.data.get('variables')
+        if self.topology is not None and variables is not None:
             try:
-                name = entry.get('name')
-                hash(name)
-            except TypeError:
-                name = str(name)
+                self.topology.add_variables(variables)
+            except TopologyError:
+                raise ValidationError('invalid global variables value')
+
+        if self.topology is not None and self.previous is not None and \
+           self.previous.variables == self.topology.variables:
+            for pattern in self.previous.get_patterns(lambda _: True):
+                if pattern.digest is not None:
+                    key = (pattern.name, pattern.digest)
+                    self.reusable.setdefault(key, pattern)
 
-            validator = PatternValidator()
+        patterns = self.data.get('patterns')
+        if self.jobs > 1 and self.topology is None:
+            results = self.pool_validate(patterns)
+        else:
+            results = (self.check_pattern(index, entry)
+                       for (index, entry) in enumerate(patterns))
 
-            if validator.validate(entry):
+        for (index, name, valid, elapsed) in results:
+            self.timings[(index, name)] = elapsed
+            if valid:
                 log.info('Add pattern %s to valid patterns', name)
                 self.valid_patterns.add((index, name))
             else:
@@ -123,12 +176,73 @@ class TopologyValidator(Validator):
                 self.error('Unable to validate pattern %s (%d)', name, index)
                 self.failed_patterns.add((index, name))
 
+    def check_pattern(self, index, entry):
+        ''' Validates a single pattern and returns (index, name, valid,
+        elapsed).  Valid patterns are added to the topology if there is
+        one.
+        '''
+
+        start = time.time()
+        try:
+            name = entry.get('name')
+            hash(name)
+        except TypeError:
+            name = str(name)
+
+        digest = None
+        if self.topology is not None:
+            digest = pattern_digest(entry)
+            pattern = self.reusable.get((name, digest))
+            if pattern is not None:
+                self.topology.insert_pattern(pattern)
+                self.reused += 1
+                return (index, name, True, time.time() - start)
+
+        validator = PatternValidator()
+        valid = validator.validate(entry)
+        if valid and self.topology is not None:
+            self.compile_pattern(entry, validator.interfaces, digest)
+        return (index, name, valid, time.time() - start)
+
+    def pool_validate(self, patterns):
+        ''' Validates patterns using a pool of processes and returns the
+        results of check_pattern in pattern order
+        '''
+
+        size = max(1, int(math.ceil(len(patterns) / (self.jobs * 4.0))))
+        chunks = [(offset, patterns[offset:offset + size])
+                  for offset in range(0, len(patterns), size)]
+
+        log.debug('Validating %d patterns in %d chunks using %d jobs',
+                  len(patterns), len(chunks), self.jobs)
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            results = pool.map(_validate_chunk, chunks)
+        finally:
+            pool.terminate()
+            pool.join()
+        return itertools.chain.from_iterable(results)
+
+    def compile_pattern(self, entry, interfaces=None, digest=None):
+        ''' Adds a valid pattern to the topology.  Patterns that cannot be
+        compiled are skipped.
+        '''
+
+        try:
+            self.topology.add_pattern(parsed_interfaces=interfaces,
+                                      digest=digest, **entry)
+        except TopologyError:
+            pass
+
 
 class PatternValidator(Validator):
 
     def __init__(self):
         self.failed_interface_patterns = set()
         self.passed_interface_patterns = set()
+        # the parsed (interface, device, port, neighbors) of each
+        # interface pattern or None if they were not all parsed
+        self.interfaces = list()
         super(PatternValidator, self).__init__()
 
     def validate_attributes(self):
@@ -154,9 +268,12 @@ class PatternValidator(Validator):
         if 'interfaces' not in self.data:
             return
 
+        self.interfaces = None
+
         if not isinstance(self.data['interfaces'], collections.Iterable):
             raise ValidationError('interface attribute is not iterable')
 
+        parsed = list()
         for index, pattern in enumerate(self.data['interfaces']):
             if not isinstance(pattern, collections.Mapping):
                 raise ValidationError('invalid value for interfaces')
@@ -165,9 +282,16 @@ class PatternValidator(Validator):
             if validator.validate(pattern):
                 log.info('Interface pattern at index %d passed', index)
                 self.passed_interface_patterns.add((index, repr(pattern)))
+                if parsed is not None and validator.parsed is not None:
+                    parsed.append(validator.parsed)
+                else:
+                    parsed = None
             else:
                 self.error('Interface pattern at index %d failed', index)
                 self.failed_interface_patterns.add((index, repr(pattern)))
+                parsed = None
+
+        self.interfaces = parsed
 
     def validate_definition(self):
         if 'definition' not in self.data:
@@ -209,6 +333,12 @@ class PatternValidator(Validator):
 
 class InterfacePatternValidator(Validator):
 
+    def __init__(self):
+        # the parsed (interface, device, port, neighbors) if the pattern
+        # is valid and has a single interface
+        self.parsed = None
+        super(InterfacePatternValidator, self).__init__()
+
     def validate_interface_pattern(self):
 
         for interface, peer in self.data.items():
@@ -220,18 +350,30 @@ class InterfacePatternValidator(Validator):
         except PatternError:
             raise ValidationError('Validation failed due to PatternError')
 
-        if not VALID_INTERFACE_RE.match(interface):
-            if interface not in INTERFACE_PATTERN_KEYWORDS:
-                try:
-                    expand_range(interface)
-                except Exception:
-                    raise ValidationError('invalid interface name: %s' % intf)
+        # a single interface name does not need to be parsed as a range.
+        # Ranges are parsed through intern_function so the range is only
+        # parsed once when the pattern is compiled, and only once for all
+        # the patterns that share it.
+        single = VALID_INTERFACE_RE.match(intf) is not None
+        ranges = None
+        if not single:
+            try:
+                ranges = intern_function('range', intf).ranges
+            except Exception:
+                ranges = None
 
-        try:
-            for entry in expand_range(intf):
-                self._validate_pattern(entry, device, port)
-        except TypeError:
-            self._validate_pattern(intf, device, port)
+            if ranges is None and intf not in INTERFACE_PATTERN_KEYWORDS:
+                raise ValidationError('invalid interface name: %s' % intf)
+
+        # every interface in a range shares the same name prefix and the
+        # invalid patterns only look at the start of the name, so checking
+        # a single entry is equivalent to checking the expanded range
+        entry = next(iter(ranges), intf) if ranges is not None else intf
+        self._validate_pattern(entry, device, port)
+
+        if len(self.data) == 1 and (single or ranges is not None or
+                                    intf in INTERFACE_PATTERN_KEYWORDS):
+            self.parsed = (intf, device, port, peer)
 
     def _validate_pattern(self, interface, device, port):
         # pylint: disable=R0201
@@ -241,9 +383,16 @@ class InterfacePatternValidator(Validator):
                 raise ValidationError('invalid interface pattern found')
 
 
-def _validator(contents, cls):
+def _validate_chunk(chunk):
+    # runs in a pool process, see TopologyValidator.pool_validate
+    (offset, patterns) = chunk
+    validator = TopologyValidator()
+    return [validator.check_pattern(offset + index, entry)
+            for (index, entry) in enumerate(patterns)]
+
+def _validator(contents, cls, *args):
     try:
-        validator = cls()
+        validator = cls(*args)
         result = validator.validate(contents)
         if result:
             log.info('Validation was successful')
@@ -254,8 +403,8 @@ def _validator(contents, cls):
         log.exception('Unrecoverable error occured trying to run validator')
         raise
 
-def validate_topology(contents):
-    return _validator(contents, TopologyValidator)
+def validate_topology(contents, topology=None, previous=None):
+    return _validator(contents, TopologyValidator, topology, 1, previous)
 
 def validate_pattern(contents):
     return _validator(contents, PatternValidator)
@@ -32,21 +32,143 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 # pylint: disable=W0613,C0103,R0201,W0622,W0614
 #
+import os
 import logging
+import mimetypes
+import threading
+import time
 
 import webob
 import webob.dec
 import webob.exc
+import webob.static
 
 from routes.middleware import RoutesMiddleware
 
+import ztpserver.config
+import ztpserver.metrics
+import ztpserver.profiler
+
 from ztpserver.serializers import dumps
 from ztpserver.constants import CONTENT_TYPE_HTML, HTTP_STATUS_OK
 
 log = logging.getLogger(__name__)
 
+BLOCK_SIZE = 1 << 16
+
+class FileWrapper(object):
+    ''' Iterates over a region of an open file.   This class is used as
+    ``wsgi.file_wrapper`` by the standalone server, which transmits
+    instances using sendfile instead of iterating over them.
+
+    :param fileobj: the open file object
+    :param blksize: the size of the blocks returned when iterating
+    :param offset: the offset of the region in the file
+    :param length: the length of the region or None for the rest of the file
+    '''
+
+    def __init__(self, fileobj, blksize=BLOCK_SIZE, offset=0, length=None):
+        self.file = fileobj
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return 'FileWrapper(file=%s, offset=%d, length=%s)' % \
+               (getattr(self.file, 'name', None), self.offset, self.length)
+
+    def __iter__(self):
+        self.file.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize
+            if remaining is not None:
+                size = min(size, remaining)
+            data = self.file.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def app_iter_range(self, start, stop):
+        ''' Returns a wrapper for the region start:stop of this region.
+        Called by webob to handle byte range requests.
+        '''
+
+        if stop is None:
+            stop = self.length
+        elif self.length is not None:
+            stop = min(stop, self.length)
+        length = stop - start if stop is not None else None
+        return FileWrapper(self.file, self.blksize, self.offset + start,
+                           length)
+
+    def close(self):
+        self.file.close()
+
+
+class StaticFileApp(object):
+    ''' WSGI application serving a single file.  The response sets
+    Content-Length, ETag and Last-Modified and supports conditional and
+    byte range requests.  The body is returned as a :py:class:`FileWrapper`
+    (or the server's ``wsgi.file_wrapper``) so that servers able to
+    transmit files directly do not have to read them through Python.
+    '''
+
+    def __init__(self, filename, content_type=None):
+        self.filename = filename
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0]
+        self.content_type = content_type or 'application/octet-stream'
+
+    def __repr__(self):
+        return 'StaticFileApp(filename=%s)' % self.filename
+
+    def __call__(self, environ, start_response):
+        request = webob.Request(environ)
+        if request.method not in ('GET', 'HEAD'):
+            response = webob.exc.HTTPMethodNotAllowed()
+            return response(environ, start_response)
+
+        try:
+            fileobj = open(self.filename, 'rb')
+            stat = os.fstat(fileobj.fileno())
+        except (IOError, OSError):
+            log.error('Unable to open file %s', self.filename)
+            return webob.exc.HTTPNotFound()(environ, start_response)
+
+        # the server's file wrapper can only send whole files
+        file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+        if request.range is not None:
+            file_wrapper = FileWrapper
+
+        response = webob.Response(app_iter=file_wrapper(fileobj, BLOCK_SIZE),
+                                  content_type=self.content_type,
+                                  conditional_response=True)
+        response.content_length = stat.st_size
+        response.last_modified = stat.st_mtime
+        response.etag = '%x-%x-%x' % (int(stat.st_mtime), stat.st_size,
+                                      stat.st_ino)
+        response.accept_ranges = 'bytes'
+        return response(environ, start_response)
+
+
 class WSGIController(object):
 
+    def __init__(self):
+        # action name -> bound method, filled in by the router from its
+        # route map so requests do not resolve the handler every time
+        self.actions = dict()
+
+    def bind(self, actions):
+        ''' Precomputes the bound methods for the named actions '''
+
+        for action in actions:
+            method = getattr(self, action, None)
+            if callable(method):
+                self.actions[action] = method
+
     def index(self, request, **kwargs):
         return webob.exc.HTTPNoContent()
 
@@ -76,8 +198,14 @@ class WSGIController(object):
         action = request.urlvars['action']
 
         try:
-            method = getattr(self, action)    #pylint: disable=R0921
-            result = method(request, **request.urlvars)
+            method = self.actions.get(action)
+            if method is None:
+                method = getattr(self, action)    #pylint: disable=R0921
+            profiler = ztpserver.profiler.profiler
+            if profiler.active and profiler.sample():
+                result = profiler.runcall(method, request, **request.urlvars)
+            else:
+                result = method(request, **request.urlvars)
 
         except Exception:
             log.exception('An unrecoverable error was detected')
@@ -98,31 +226,138 @@ class WSGIController(object):
             result = self.response(**result)   #pylint: disable=W0142
 
         elif not isinstance(result, webob.Response) and \
-             not isinstance(result, webob.static.FileApp):
+             not isinstance(result, webob.static.FileApp) and \
+             not isinstance(result, StaticFileApp):
             result = webob.exc.HTTPInternalServerError()
 
         return result
 
+class TimingMiddleware(object):
+    ''' Records the wall time of every request in the route histograms,
+    counts requests and response bytes per route and status, and logs a
+    one-line breakdown of requests slower than threshold
+
+    The route is named after the controller class and action matched by
+    the routes middleware it wraps.  Time spent iterating over a streamed
+    response body happens after the application returns and is not
+    included.
+
+    :param app: the wsgi application to time
+    :param threshold: the slow request threshold in milliseconds (0
+                      disables logging slow requests)
+    '''
+
+    def __init__(self, app, threshold=0):
+        self.app = app
+        self.threshold = threshold
+
+    @staticmethod
+    def route(environ):
+        ''' Returns the (controller, action) names of the route matched
+        for the request or (None, None) '''
+
+        try:
+            urlvars = environ['wsgiorg.routing_args'][1]
+            controller = urlvars['controller']
+            action = urlvars['action']
+        except (KeyError, IndexError, TypeError):
+            return (None, None)
+        return (getattr(controller, '__name__', controller), action)
+
+    def __call__(self, environ, start_response):
+        response = list()
+
+        def _start_response(status, headers, *args):
+            response.append((status, headers))
+            return start_response(status, headers, *args)
+
+        ztpserver.metrics.begin()
+        start = time.time()
+        try:
+            return self.app(environ, _start_response)
+        finally:
+            elapsed = time.time() - start
+            records = ztpserver.metrics.end()
+
+            (controller, action) = self.route(environ)
+            route = '%s.%s' % (controller, action) if controller \
+                    else 'unmatched'
+            ztpserver.metrics.observe('route', route, elapsed)
+
+            (status, headers) = response[0] if response else ('500', [])
+            status = status.split()[0]
+            labels = dict(controller=controller or 'unmatched',
+                          action=action or '')
+            ztpserver.metrics.increment('ztps_requests_total',
+                                        status=status, **labels)
+            for name, value in headers:
+                if name.lower() == 'content-length' and value.isdigit():
+                    ztpserver.metrics.increment('ztps_response_bytes_total',
+                                                int(value), **labels)
+
+            if self.threshold and elapsed * 1000 >= self.threshold:
+                log.warning('slow request: method=%s path=%s route=%s '
+                            'status=%s elapsed=%.1fms %s',
+                            environ.get('REQUEST_METHOD'),
+                            environ.get('PATH_INFO'), route, status,
+                            elapsed * 1000,
+                            ztpserver.metrics.summarize(records))
+
 class WSGIRouter(object):
+    ''' Routes requests to long-lived controller instances
+
+    Each controller class referenced by the mapper is instantiated once, on
+    its first request, and reused for every request after that.  Controllers
+    must therefore not keep per-request state on the instance.
+    '''
 
     def __init__(self, mapper):
         self.map = mapper
-        self.router = RoutesMiddleware(self.route, self.map)
+        threshold = ztpserver.config.runtime.default.slow_request_threshold
+        self.router = TimingMiddleware(RoutesMiddleware(self.route, self.map),
+                                       threshold)
+
+        self.controllers = dict()
+        self.lock = threading.Lock()
+
+        # controller class -> set of action names found in the route map
+        self.actions = dict()
+        for route in self.map.matchlist:
+            controller = route.defaults.get('controller')
+            action = route.defaults.get('action')
+            if controller is not None and action is not None:
+                self.actions.setdefault(controller, set()).add(action)
 
     @webob.dec.wsgify
     def __call__(self, request):
         return self.router
 
+    def create_controller(self, cls):
+        ''' Returns a new instance of the controller class cls '''
+
+        return cls()
+
+    def controller(self, cls):
+        ''' Returns the shared instance of the controller class cls '''
+
+        instance = self.controllers.get(cls)
+        if instance is None:
+            with self.lock:
+                instance = self.controllers.get(cls)
+                if instance is None:
+                    instance = self.create_controller(cls)
+                    instance.bind(self.actions.get(cls, ()))
+                    self.controllers[cls] = instance
+        return instance
+
     @webob.dec.wsgify
     def route(self, request):
         ''' Routes the incoming request to the appropriate controller '''
 
         try:
             controller = request.urlvars['controller']
-            return controller()
         except KeyError:
             log.debug('WSGIRouter: controller not found, returning 404')
             return webob.exc.HTTPNotFound()
-
-
+        return self.controller(controller)
 